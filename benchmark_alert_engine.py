@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Benchmark vyhodnocení alertů: průchod všemi odběry vs. index prahů vs. NumPy engine.
+
+    python benchmark_alert_engine.py                 # 10k, 100k a 1M odběrů
+    python benchmark_alert_engine.py --sizes 10000 --symbols 50
+
+Měří zvlášť výběr kandidátů (alert_candidates, tj. průchod configem nebo index.triggered; nejlepší
+z --repeat běhů) a celý cyklus evaluate_alerts (odeslání zpráv je no-op). Ověřuje, že všechny způsoby
+pošlou stejné alerty a stejně změní stav.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import random
+import time
+from types import SimpleNamespace
+
+import eth_price_alert
+
+def generate(size, symbols, seed=1):
+    """Náhodní uživatelé po 1-5 odběrech; ceny se za cyklus pohnou o max. 1 %, takže alert spustí jen malá část."""
+    rng = random.Random(seed)
+    names = [f"SYM{i}" for i in range(symbols)]
+    base = {name: rng.uniform(1, 1000) for name in names}
+    config, state, count, chat_id = {}, {}, 0, 1000
+    while count < size:
+        chat_id += 1
+        for name in rng.sample(names, min(rng.randint(1, 5), size - count, symbols)):
+            config.setdefault(str(chat_id), {})[name] = {'name': name, 'threshold': rng.choice([0.01, 0.02, 0.05, 0.1])}
+            if rng.random() > 0.001:
+                last = base[name] * rng.uniform(0.99, 1.01)
+                state.setdefault(str(chat_id), {})[name] = {'last_notification_price': last}
+            count += 1
+    prices = {name: price * rng.uniform(0.99, 1.01) for name, price in base.items()}
+    return config, state, prices
+
+class NullBot:
+    def __init__(self):
+        self.sent = 0
+    
+    async def send_message(self, **kwargs):
+        self.sent += 1
+
+async def run_cycle(config, state, prices, index):
+    app = SimpleNamespace(bot=NullBot())
+    # Měříme vyhodnocení, ne limity Telegramu
+    eth_price_alert.NOTIFIER = eth_price_alert.NotificationDispatcher(global_rate=1e9, chat_rate=1e9)
+    full_state = json.loads(json.dumps(state))
+    delivered = set()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        changed = await eth_price_alert.evaluate_alerts(app, prices, config, full_state, verbose=False, index=index,
+                                                        on_delivered=delivered.update)
+    elapsed = time.perf_counter() - started
+    return elapsed, changed | delivered, full_state, app.bot.sent
+
+def time_selection(config, prices, index, repeat):
+    """Nejlepší čas výběru kandidátů z repeat běhů."""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        eth_price_alert.alert_candidates(prices, config, index, verbose=False)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def build(engine, config, state):
+    started = time.perf_counter()
+    engine.rebuild(config, state)
+    return engine, time.perf_counter() - started
+
+async def benchmark(size, symbols, repeat):
+    config, state, prices = generate(size, symbols)
+    engines = [('loop', None, 0.0), ('index', *build(eth_price_alert.ThresholdIndex(), config, state))]
+    if eth_price_alert.np is not None:
+        engines.append(('numpy', *build(eth_price_alert.NumpyAlertEngine(), config, state)))
+    
+    results = {}
+    for name, index, build_time in engines:
+        selection = time_selection(config, prices, index, repeat)
+        elapsed, changed, full_state, sent = await run_cycle(config, state, prices, index)
+        results[name] = (selection, elapsed, build_time, changed, full_state, sent)
+    
+    reference = results['loop']
+    for name, (selection, elapsed, build_time, changed, full_state, sent) in results.items():
+        same = (changed, full_state, sent) == reference[3:]
+        print(f"{size:>9,} | {name:<6} | výběr {selection * 1000:9.2f} ms {reference[0] / selection:7.1f}x "
+              f"| cyklus {elapsed * 1000:9.1f} ms {reference[1] / elapsed:6.1f}x | sestavení {build_time * 1000:8.1f} ms "
+              f"| alertů {sent:>6} | {'✅' if same else '❌ jiný výsledek'}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark vyhodnocení alertů')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--symbols', type=int, default=200, help='Počet různých symbolů')
+    parser.add_argument('--repeat', type=int, default=5, help='Kolikrát změřit výběr kandidátů (bere se nejlepší)')
+    args = parser.parse_args()
+    if eth_price_alert.np is None:
+        print("⚠️  numpy není nainstalované, NumPy engine se přeskočí")
+    for size in args.sizes:
+        asyncio.run(benchmark(size, args.symbols, args.repeat))
+
+if __name__ == '__main__':
+    main()
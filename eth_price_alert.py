@@ -6,17 +6,43 @@ Podporuje více uživatelů (každý má vlastní nastavení).
 """
 import json
 import os
+import sys
 import time
+import bisect
+import math
+import mmap
+import shutil
+import struct
+import zlib
 import requests
+import requests.adapters
+import httpx
+import threading
+from collections import deque, Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
 import atexit
+import multiprocessing
+import multiprocessing.connection
 import random
+import sqlite3
 import psycopg2
 from psycopg2 import OperationalError, Error as Psycopg2Error
+from psycopg2.extras import execute_batch, execute_values
 from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from types import SimpleNamespace
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes, ConversationHandler
-from telegram.error import Conflict, NetworkError, TimedOut
+from telegram.error import Conflict, NetworkError, RetryAfter, TimedOut
+
+try:
+    import websockets  # Volitelné, jen pro streamovací režim (PRICE_STREAM_MODE)
+except ImportError:
+    websockets = None
+try:
+    import numpy as np  # Volitelné, jen pro vektorové vyhodnocení alertů (ALERT_ENGINE=numpy)
+except ImportError:
+    np = None
 
 # Konfigurace
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -25,9 +51,49 @@ ADMIN_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
 
 STATE_FILE = 'crypto_price_state.json'
 CONFIG_FILE = 'crypto_config.json'
+SCHEMA_META_FILE = 'schema_meta.json'  # Verze dat (dokončené migrace) bez DB
+SCHEMA_VERSION = 2  # 1 = řádkové tabulky, 2 = všechny odběry mají asset_type
+JOURNAL_COMPACT_EVERY = 1000  # Po kolika změnách v journalu se souborový fallback zkompaktuje
+STORAGE_FILE_FORMAT = os.getenv('STORAGE_FILE_FORMAT', 'json').lower()  # 'json' nebo 'binary' (.bin s hlavičkou a CRC)
+WRITE_BEHIND_WINDOW = float(os.getenv('WRITE_BEHIND_WINDOW', '0.25'))  # Okno pro sloučení zápisů (s)
+PRICE_HISTORY_SQLITE = os.getenv('PRICE_HISTORY_SQLITE', 'price_history.sqlite3')  # Historie cen bez DB
+PRICE_HISTORY_RAW_HORIZON = int(os.getenv('PRICE_HISTORY_RAW_HORIZON', str(7 * 86400)))  # Jak dlouho držet surové ticky (s)
+PRICE_HISTORY_ROLLUP_EVERY = 300  # Jak často agregovat ticky do 1m/1h/1d (s)
+LOOP_LAG_INTERVAL = 0.5  # Jak často měřit zpoždění event loopu (s)
 CHECK_INTERVAL = 60  # Kontrola každou minutu
+ALERT_ENGINE = os.getenv('ALERT_ENGINE', 'index').lower()  # index = bisekce po symbolech, numpy = vektorově
 CRYPTOCOMPARE_API_KEY = os.getenv('CRYPTOCOMPARE_API_KEY', '7ffa2f0b80215a9e12406537b44f7dafc8deda54354efcfda93fac2eaaaeaf20')
+CRYPTOCOMPARE_FSYMS_MAX_LEN = 300  # Limit délky parametru fsyms u pricemulti endpointu
+BINANCE_SNAPSHOT_MAX_AGE = CHECK_INTERVAL  # Jak dlouho je snapshot Binance dost čerstvý i pro jednotlivé dotazy (s)
+BINANCE_EXCHANGE_INFO_TTL = 6 * 3600  # Jak často obnovit mapování párů z exchangeInfo (s)
+PRICE_STREAM_MODE = os.getenv('PRICE_STREAM_MODE', '').lower() in ('1', 'true', 'yes')  # Ceny kryptoměn z WebSocket streamu
+PRICE_STREAM_URL = os.getenv('PRICE_STREAM_URL', 'wss://stream.binance.com:9443/ws')
+STREAM_STALE_AFTER = 2 * CHECK_INTERVAL  # Po jaké době bez ticku se symbol vrací do pollingu (s)
+YAHOO_QUOTE_SYMBOLS_MAX_LEN = 1000  # Max. délka parametru symbols u Yahoo quote endpointu
 DATABASE_URL = os.getenv('DATABASE_URL')
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))  # Spojení k DB otevřená předem
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '5'))  # Max. souběžných spojení k DB, další volající čekají
+DB_POOL_TIMEOUT = 10  # Max. čekání na volné spojení z poolu (s)
+DB_HEALTHCHECK_IDLE = 30  # Spojení nečinné déle než tohle se před použitím ověří (s)
+HTTP_TIMEOUT = 10  # Timeout HTTP requestů na poskytovatele cen (s)
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))  # Max. keep-alive spojení na poskytovatele
+SHARD_COUNT = os.getenv('SHARD_COUNT', '0')  # Počet procesů pro vyhodnocení alertů (0 = vše v hlavním procesu), ověří parse_shard_count
+SHARD_COUNT_MAX = 32
+SHARD_RESTART_DELAY = 5  # Minimální odstup restartů téhož shardu, aby padající shard nezahltil hlavní proces (s)
+NOTIFY_GLOBAL_RATE = 30  # Telegram: max. ~30 zpráv za sekundu celkem
+NOTIFY_CHAT_RATE = 1  # Telegram: max. ~1 zpráva za sekundu do jednoho chatu
+NOTIFY_MAX_RETRIES = 3  # Kolikrát zkusit znovu po RetryAfter
+NOTIFY_CHAT_BUCKETS_MAX = 10000  # Nad tolik per-chat bucketů se nečinné zahodí
+NOTIFY_CLOSE_TIMEOUT = 10  # Jak dlouho při ukončení čekat na odeslání zpráv z fronty (s)
+PRICE_FETCH_CONCURRENCY = int(os.getenv('PRICE_FETCH_CONCURRENCY', '5'))  # Max. souběžně stahovaných symbolů
+PRICE_CACHE_TTL = int(os.getenv('PRICE_CACHE_TTL', '30'))  # Jak dlouho je cena v cache platná (s)
+PRICE_CACHE_MAX_SIZE = int(os.getenv('PRICE_CACHE_MAX_SIZE', '5000'))  # Max. počet cen v cache (LRU)
+PROVIDER_STATS_WINDOW = 50  # Počet posledních requestů pro latenci a úspěšnost poskytovatele
+PROVIDER_MIN_SUCCESS_RATE = 0.5  # Pod touto úspěšností je poskytovatel považován za nezdravý
+HEDGE_DEFAULT_DELAY = 1.0  # Zpoždění hedged requestu, dokud nemáme naměřenou latenci (s)
+HEDGE_MIN_DELAY = 0.2  # Minimální zpoždění hedged requestu (s)
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))  # Chyb za sebou, po kterých se jistič otevře
+CIRCUIT_COOLDOWN = int(os.getenv('CIRCUIT_COOLDOWN', '60'))  # Po kolika sekundách jistič zkusí zkušební request
 
 # Stavy konverzace
 WAITING_TICKER, WAITING_THRESHOLD, WAITING_UPDATE_THRESHOLD = range(3)
@@ -61,14 +127,10 @@ def load_crypto_list_from_coingecko():
     try:
         print("📡 Načítám seznam kryptoměn z CoinGecko...")
         url = 'https://api.coingecko.com/api/v3/coins/list'
-        response = requests.get(url, timeout=30)
+        response = get_provider_session('coingecko').get(url)
         
         if response.status_code == 200:
-            data = response.json()
-            for coin in data:
-                symbol = coin.get('symbol', '').upper()
-                if symbol and symbol not in STOCK_BLACKLIST:
-                    crypto_symbols.add(symbol)
+            crypto_symbols = _parse_coingecko_list(response.json())
             print(f"✅ Načteno {len(crypto_symbols)} kryptoměn z CoinGecko")
         else:
             print(f"⚠️  Chyba při načítání z CoinGecko: Status {response.status_code}")
@@ -96,350 +158,2197 @@ def is_crypto_ticker(symbol):
         load_crypto_list_from_coingecko()
     return symbol_upper in KNOWN_CRYPTO
 
-def get_db_connection():
-    """Vytvoří připojení k databázi."""
-    if not DATABASE_URL:
-        return None
-    try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require', connect_timeout=10)
+class DatabasePoolTimeout(Exception):
+    """Žádné spojení z poolu se neuvolnilo do DB_POOL_TIMEOUT."""
+
+class DatabasePool:
+    """Pool spojení k PostgreSQL. Drží otevřených alespoň minconn spojení, nejvýš maxconn;
+    když jsou všechna půjčená, volající čeká (max. timeout), místo aby otevíral další SSL spojení."""
+    
+    def __init__(self, dsn, minconn, maxconn, timeout=None):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = max(maxconn, minconn, 1)
+        self.timeout = DB_POOL_TIMEOUT if timeout is None else timeout
+        self._idle = deque()  # (spojení, kdy bylo vráceno)
+        self._size = 0  # otevřená spojení včetně půjčených
+        self._cond = threading.Condition()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.connects = 0
+        self.reconnects = 0
+    
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, sslmode='require', connect_timeout=10)
+        with self._cond:
+            self.connects += 1
         return conn
-    except Exception as e:
-        print(f"⚠️  Chyba při připojení k databázi: {e}")
-        return None
+    
+    def open(self):
+        """Otevře minconn spojení předem (při startu), ať první příkazy nečekají na handshake."""
+        conns = [self.getconn() for _ in range(max(self.minconn - self._size, 0))]
+        for conn in conns:
+            self.putconn(conn)
+    
+    def _healthy(self, conn, idle_since):
+        """Spojení, které leželo déle než DB_HEALTHCHECK_IDLE, ověří dotazem SELECT 1."""
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < DB_HEALTHCHECK_IDLE:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            while not self._idle and self._size >= self.maxconn:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DatabasePoolTimeout(f"Žádné volné spojení do {self.timeout}s (max {self.maxconn})")
+                self._cond.wait(remaining)
+            waited = time.monotonic() - started
+            self.checkouts += 1
+            if waited >= 0.001:
+                self.waits += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+            if self._idle:
+                conn, idle_since = self._idle.pop()
+            else:
+                conn, idle_since = None, None
+                self._size += 1  # Slot rezervujeme hned, spojení otevřeme mimo zámek
+        if conn is not None:
+            if self._healthy(conn, idle_since):
+                return conn
+            print("⚠️  DB spojení z poolu neprošlo kontrolou, otevírám nové")
+            self._close(conn)
+            self.record_reconnect()
+        try:
+            return self._connect()
+        except Exception:
+            self._release_slot()
+            raise
+    
+    def putconn(self, conn, broken=False):
+        """Vrátí spojení do poolu. Rozbité (OperationalError) nebo zavřené spojení zahodí."""
+        if broken or conn.closed:
+            self._close(conn)
+            self._release_slot()
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+    
+    def record_reconnect(self):
+        with self._cond:
+            self.reconnects += 1
+    
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+    
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+        for conn, _ in idle:
+            self._close(conn)
+    
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'max': self.maxconn,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_avg_ms': round(self.wait_total / self.waits * 1000, 1) if self.waits else 0.0,
+                'wait_max_ms': round(self.wait_max * 1000, 1),
+                'connects': self.connects,
+                'reconnects': self.reconnects,
+            }
+
+DB_POOL = DatabasePool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX) if DATABASE_URL else None
+
+def db_transaction(fn):
+    """Spustí fn(cursor) v jedné transakci nad spojením z DB_POOL a vrátí její výsledek.
+    Při OperationalError (spadlé spojení, restart DB) před commitem spojení zahodí a jednou to zkusí s novým.
+    Chyba při commitu se neopakuje: commit mohl na server dojít a dávka by se zapsala podruhé."""
+    for attempt in range(2):
+        conn = None
+        broken = False
+        committing = False
+        try:
+            conn = DB_POOL.getconn()
+            cur = conn.cursor()
+            result = fn(cur)
+            committing = True
+            conn.commit()
+            cur.close()
+            return result
+        except OperationalError as e:
+            broken = True
+            if attempt or committing:
+                raise
+            print(f"⚠️  DB spojení selhalo ({e}), zkouším znovu")
+            DB_POOL.record_reconnect()
+        except Exception:
+            if conn is not None:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            raise
+        finally:
+            if conn is not None:
+                DB_POOL.putconn(conn, broken=broken)
+
+def get_db_pool_stats():
+    return DB_POOL.stats() if DB_POOL else {}
+
+# Normalizované schéma: jeden řádek na (chat_id, symbol). Logická jména 'crypto_config'/'crypto_state'
+# zůstávají jako API (a jména JSON souborů), v DB jim odpovídají tabulky subscriptions/alert_state.
+DB_TABLES = {
+    'crypto_config': ('subscriptions', ('threshold', 'asset_type', 'name')),
+    'crypto_state': ('alert_state', ('last_notification_price',)),
+}
+DB_COLUMN_DEFAULTS = {'threshold': 0.05}
+DB_COLUMN_TYPES = {'threshold': 'double precision', 'asset_type': 'text', 'name': 'text',
+                   'last_notification_price': 'double precision'}
+DB_CAS_RETRIES = 3  # Kolikrát zkusit zápis řádku znovu po konfliktu verzí
+
+class WriteConflictError(Exception):
+    """Řádek se kvůli souběžným změnám nepodařilo zapsat ani po DB_CAS_RETRIES pokusech."""
 
 def init_database():
-    """Inicializuje databázové tabulky."""
-    conn = get_db_connection()
-    if not conn:
+    """Inicializuje databázové tabulky a jednorázově zmigruje data z původních JSONB tabulek."""
+    if not DB_POOL:
         return False
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS crypto_config (
-                id SERIAL PRIMARY KEY,
-                data JSONB NOT NULL,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS crypto_state (
-                id SERIAL PRIMARY KEY,
-                data JSONB NOT NULL,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.commit()
-        cur.close()
-        conn.close()
+        DB_POOL.open()
+        db_transaction(create_schema)
         return True
     except Exception as e:
         print(f"❌ Chyba při inicializaci databáze: {e}")
-        if conn: conn.close()
         return False
 
+def create_schema(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            chat_id BIGINT NOT NULL,
+            symbol TEXT NOT NULL,
+            threshold DOUBLE PRECISION NOT NULL,
+            asset_type TEXT,
+            name TEXT,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, symbol)
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS alert_state (
+            chat_id BIGINT NOT NULL,
+            symbol TEXT NOT NULL,
+            last_notification_price DOUBLE PRECISION,
+            version INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (chat_id, symbol)
+        )
+    """)
+    # Verze řádku pro optimistickou kontrolu souběhu (tabulky z doby před jejím zavedením)
+    cur.execute("ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0")
+    cur.execute("ALTER TABLE alert_state ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 0")
+    # Dotazy podle uživatele pokrývá primární klíč, podle symbolu (kdo sleduje BTC) tyto indexy
+    cur.execute("CREATE INDEX IF NOT EXISTS subscriptions_symbol_idx ON subscriptions (symbol)")
+    cur.execute("CREATE INDEX IF NOT EXISTS alert_state_symbol_idx ON alert_state (symbol)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    """)
+    migrate_jsonb_tables(cur)
+
+def get_schema_version():
+    """Verze dat (dokončené migrace). V DB v tabulce schema_meta, bez DB v SCHEMA_META_FILE."""
+    if DB_POOL:
+        def read(cur):
+            cur.execute("SELECT value FROM schema_meta WHERE key = 'schema_version'")
+            row = cur.fetchone()
+            return int(row[0]) if row else 0
+        return db_transaction(read)
+    if os.path.exists(SCHEMA_META_FILE):
+        return int(read_snapshot(SCHEMA_META_FILE).get('schema_version', 0))
+    return 0
+
+def set_schema_version(version):
+    if DB_POOL:
+        db_transaction(lambda cur: cur.execute("""
+            INSERT INTO schema_meta (key, value) VALUES ('schema_version', %s)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+        """, (str(version),)))
+    else:
+        write_snapshot(SCHEMA_META_FILE, {'schema_version': version})
+
+def migrate_asset_types(store, force=False):
+    """Dávková migrace všech uživatelů najednou: doplní asset_type odběrům, které ho nemají
+    (crypto podle seznamu CoinGecko, jinak stock). Je idempotentní; po doběhnutí zapíše SCHEMA_VERSION,
+    takže další start ji přeskočí (force=True ji spustí znovu, viz --migrate). Vrací počet doplněných."""
+    if not force and get_schema_version() >= SCHEMA_VERSION:
+        return 0
+    changes = {}
+    for chat_id, symbols in store.config.items():
+        for symbol, settings in symbols.items():
+            if 'asset_type' not in settings:
+                changes[(chat_id, symbol)] = dict(settings, asset_type='crypto' if is_crypto_ticker(symbol) else 'stock')
+    if changes:
+        store.update_config(changes)
+    set_schema_version(SCHEMA_VERSION)
+    print(f"🔄 Migrace asset_type: doplněno {len(changes)} odběrů, schéma verze {SCHEMA_VERSION}")
+    return len(changes)
+
+def migrate_jsonb_tables(cur):
+    """Jednorázová migrace z crypto_config/crypto_state (jeden JSONB řádek se všemi uživateli) do řádků.
+    Bez původních tabulek se zkusí JSON soubory. Původní tabulky zůstávají jako záloha."""
+    cur.execute("SELECT value FROM schema_meta WHERE key = 'jsonb_migrated'")
+    if cur.fetchone():
+        return
+    for legacy_table, (table, _) in DB_TABLES.items():
+        data = {}
+        cur.execute("SELECT to_regclass(%s)", (legacy_table,))
+        if cur.fetchone()[0] is not None:
+            cur.execute(f"SELECT data FROM {legacy_table} ORDER BY id DESC LIMIT 1")
+            row = cur.fetchone()
+            if row and row[0]:
+                data = row[0]
+        if not data:
+            data = load_data_file(CONFIG_FILE if legacy_table == 'crypto_config' else STATE_FILE)
+        data, _ = wrap_legacy_format(data)
+        changes = data_to_rows(data)
+        db_apply_rows(cur, legacy_table, changes)
+        print(f"🔄 Migrace {legacy_table} → {table}: {len(changes)} řádků")
+    cur.execute("INSERT INTO schema_meta (key, value) VALUES ('jsonb_migrated', %s)", (datetime.now().isoformat(),))
+
 # --- Správa dat (Load/Save) s podporou více uživatelů ---
 # Struktura dat: { "chat_id_string": { "SYMBOL": { ... } } }
+# Změny se ukládají po řádcích: { ("chat_id_string", "SYMBOL"): { ... } nebo None = smazat }
 
-def load_data(table_name, file_name):
-    """Obecná funkce pro načtení JSON dat (config nebo state)."""
-    conn = get_db_connection()
+def data_to_rows(data):
+    """Převede vnořený slovník {chat_id: {symbol: hodnota}} na řádky {(chat_id, symbol): hodnota}."""
+    return {(str(chat_id), symbol): value for chat_id, symbols in data.items() for symbol, value in symbols.items()}
+
+def apply_rows(data, changes):
+    """Provede změny řádků {(chat_id, symbol): hodnota nebo None = smazat} ve vnořeném slovníku."""
+    for (chat_id, symbol), value in changes.items():
+        if value is None:
+            data.get(chat_id, {}).pop(symbol, None)
+        else:
+            data.setdefault(chat_id, {})[symbol] = value
+
+def wrap_legacy_format(data):
+    """Migrace starého formátu (root klíče nejsou chat_id, ale přímo tickery jako 'BTC').
+    Předpokládáme, že stará data patří adminovi (z env var). Vrací (data, zda_migrováno)."""
+    if not data or not ADMIN_CHAT_ID:
+        return data, False
+    first_key = next(iter(data))
+    # Pokud klíč vypadá jako ticker (krátký, písmena) a ne jako ID (čísla)
+    if isinstance(first_key, str) and not first_key.isdigit() and len(first_key) < 10:
+        print(f"🔄 Migrace dat pro uživatele {ADMIN_CHAT_ID}...")
+        return {str(ADMIN_CHAT_ID): data}, True
+    return data, False
+
+def db_load_rows(cur, table_name, versions=None):
+    """Načte tabulku do vnořeného slovníku. Prázdné sloupce (NULL) ve výsledku vynechá.
+    Do versions (pokud je zadán) doplní verze řádků {(chat_id, symbol): verze}."""
+    table, columns = DB_TABLES[table_name]
+    cur.execute(f"SELECT chat_id, symbol, version, {', '.join(columns)} FROM {table}")
     data = {}
+    for chat_id, symbol, version, *values in cur.fetchall():
+        data.setdefault(str(chat_id), {})[symbol] = {c: v for c, v in zip(columns, values) if v is not None}
+        if versions is not None:
+            versions[(str(chat_id), symbol)] = version
+    return data
+
+def valid_row_changes(table_name, changes):
+    """Vynechá řádky s chat_id, které nejde uložit do BIGINT sloupce."""
+    valid = {}
+    for (chat_id, symbol), value in changes.items():
+        if str(chat_id).lstrip('-').isdigit():
+            valid[(chat_id, symbol)] = value
+        else:
+            print(f"⚠️  Přeskakuji neplatné chat_id {chat_id!r} ({table_name})")
+    return valid
+
+def db_row_values(value, columns):
+    return tuple(value.get(c, DB_COLUMN_DEFAULTS.get(c)) for c in columns)
+
+def db_apply_rows(cur, table_name, changes):
+    """Provede změny řádků jako UPSERT/DELETE (bez commitu)."""
+    table, columns = DB_TABLES[table_name]
+    upserts, deletes = [], []
+    for (chat_id, symbol), value in valid_row_changes(table_name, changes).items():
+        if value is None:
+            deletes.append((int(chat_id), symbol))
+        else:
+            upserts.append((int(chat_id), symbol) + db_row_values(value, columns))
+    if upserts:
+        placeholders = ', '.join(['%s'] * (len(columns) + 2))
+        updates = ', '.join(f"{c} = EXCLUDED.{c}" for c in columns)
+        execute_batch(cur, f"""
+            INSERT INTO {table} (chat_id, symbol, {', '.join(columns)}) VALUES ({placeholders})
+            ON CONFLICT (chat_id, symbol) DO UPDATE SET {updates}, version = {table}.version + 1,
+                updated_at = CURRENT_TIMESTAMP
+        """, upserts)
+    if deletes:
+        execute_batch(cur, f"DELETE FROM {table} WHERE chat_id = %s AND symbol = %s", deletes)
+
+def db_cas_rows(cur, table_name, changes, versions, fields):
+    """Zápis s optimistickou kontrolou souběhu (compare-and-swap, bez commitu): řádek se změní jen tehdy,
+    když má v DB stále verzi, kterou jsme naposledy viděli (versions; žádná = nový řádek). Při konfliktu
+    se aktuální řádek načte, naše změněná pole (fields, None = všechna) se do něj promítnou a zápis se
+    zopakuje. Vrací {(chat_id, symbol): (nová verze nebo None = smazáno, pole převzatá z DB)}."""
+    table, columns = DB_TABLES[table_name]
+    changes = valid_row_changes(table_name, changes)
+    typed = ', '.join(f'%s::{DB_COLUMN_TYPES[c]}' for c in columns)
+    results = {}
+    from_db = {}
+    pending = {key: (versions.get(key), value) for key, value in changes.items() if value is not None}
+    for _ in range(DB_CAS_RETRIES):
+        written = []
+        updates = [(int(c), s, version) + db_row_values(value, columns)
+                   for (c, s), (version, value) in pending.items() if version is not None]
+        if updates:
+            written += execute_values(cur, f"""
+                UPDATE {table} AS t SET {', '.join(f'{c} = v.{c}' for c in columns)},
+                    version = t.version + 1, updated_at = CURRENT_TIMESTAMP
+                FROM (VALUES %s) AS v (chat_id, symbol, expected, {', '.join(columns)})
+                WHERE t.chat_id = v.chat_id AND t.symbol = v.symbol AND t.version = v.expected
+                RETURNING t.chat_id, t.symbol, t.version
+            """, updates, template=f"(%s::bigint, %s::text, %s::integer, {typed})", fetch=True)
+        inserts = [(int(c), s) + db_row_values(value, columns)
+                   for (c, s), (version, value) in pending.items() if version is None]
+        if inserts:
+            written += execute_values(cur, f"""
+                INSERT INTO {table} (chat_id, symbol, {', '.join(columns)}) VALUES %s
+                ON CONFLICT (chat_id, symbol) DO NOTHING
+                RETURNING chat_id, symbol, version
+            """, inserts, fetch=True)
+        for chat_id, symbol, version in written:
+            key = (str(chat_id), symbol)
+            pending.pop(key, None)
+            results[key] = (version, from_db.get(key, {}))
+        if not pending:
+            break
+        
+        # Konflikt: řádek mezitím změnil, založil nebo smazal jiný zapisovatel -> sloučíme s aktuální verzí
+        current = {}
+        for chat_id, symbol, version, *values in execute_values(cur, f"""
+            SELECT t.chat_id, t.symbol, t.version, {', '.join(f't.{c}' for c in columns)}
+            FROM {table} AS t JOIN (VALUES %s) AS k (chat_id, symbol) ON t.chat_id = k.chat_id AND t.symbol = k.symbol
+            FOR UPDATE OF t
+        """, [(int(c), s) for c, s in pending], template="(%s::bigint, %s::text)", fetch=True):
+            current[(str(chat_id), symbol)] = (version, dict(zip(columns, values)))
+        for key, (_, value) in list(pending.items()):
+            if key not in current:
+                pending[key] = (None, value)
+                continue
+            version, db_value = current[key]
+            ours = fields.get(key) or columns
+            merged = {c: value.get(c) if c in ours else db_value.get(c) for c in columns}
+            from_db[key] = {c: db_value.get(c) for c in columns if c not in ours and db_value.get(c) is not None}
+            pending[key] = (version, merged)
+    if pending:
+        raise WriteConflictError(f"{table_name}: {len(pending)} řádků se nepodařilo zapsat kvůli souběžným změnám")
     
+    deletes = [(int(c), s) for (c, s), value in changes.items() if value is None]
+    if deletes:
+        execute_batch(cur, f"DELETE FROM {table} WHERE chat_id = %s AND symbol = %s", deletes)
+        for chat_id, symbol in deletes:
+            results[(str(chat_id), symbol)] = (None, {})
+    return results
+
+# Souborový fallback: snapshot + append-only journal změn (file_name.journal), jeden JSON řádek na změněný
+# řádek. Zápis změny je tak jen append; po JOURNAL_COMPACT_EVERY záznamech se journal přehraje do snapshotu
+# a smaže. Snapshot se zapisuje atomicky (dočasný soubor, fsync, rename) jako JSON, nebo při
+# STORAGE_FILE_FORMAT=binary jako .bin: hlavička (magic, verze, počet řádků, délka jmen, CRC32), pak řádky
+# jako záznamy pevné délky (SNAPSHOT_ROW) a za nimi tabulka jmen. Čte se přímo z mmap bez parsování JSON.
+JOURNAL_SIZES = {}  # {file_name: počet záznamů v journalu}
+SNAPSHOT_MAGIC = b'EPAS'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<4sHIII')  # magic, verze, počet řádků, délka tabulky jmen, CRC32 zbytku souboru
+SNAPSHOT_ROW = struct.Struct('<q16sBdd8sIH')  # chat_id, symbol, příznaky, threshold, cena, asset_type, offset a délka jména
+SNAPSHOT_FIELDS = ('threshold', 'last_notification_price', 'name', 'asset_type')  # bit i = pole v řádku je, bit 4+i = je None
+
+class CorruptDataError(Exception):
+    """Soubor se snapshotem je poškozený (nedopsaný, špatné CRC, neplatný JSON)."""
+
+def journal_path(file_name):
+    return file_name + '.journal'
+
+def snapshot_paths(file_name):
+    """Cesty snapshotu: v nastaveném formátu (sem se zapisuje) a v druhém (po zápisu se smaže)."""
+    binary_path = os.path.splitext(file_name)[0] + '.bin'
+    if STORAGE_FILE_FORMAT == 'binary':
+        return binary_path, file_name
+    return file_name, binary_path
+
+def encode_snapshot_rows(data):
+    """Řádky jako záznamy SNAPSHOT_ROW + tabulka jmen. None, když se některý řádek do záznamu nevejde
+    (jiná pole, dlouhý symbol, nečíselné chat_id); takový snapshot se uloží jako JSON."""
+    records, names = [], bytearray()
+    for chat_id, rows in data.items():
+        for symbol, value in rows.items():
+            symbol_bytes = symbol.encode('utf-8')
+            try:
+                chat_number = int(chat_id)
+            except (TypeError, ValueError):
+                return None
+            if (str(chat_number) != str(chat_id) or len(symbol_bytes) > 16 or b'\0' in symbol_bytes
+                    or not isinstance(value, dict) or set(value) - set(SNAPSHOT_FIELDS)):
+                return None
+            flags = 0
+            for bit, field in enumerate(SNAPSHOT_FIELDS):
+                if field in value:
+                    flags |= 1 << bit
+                    if value[field] is None:
+                        flags |= 16 << bit
+            threshold, price = value.get('threshold'), value.get('last_notification_price')
+            name, asset_type = value.get('name') or '', value.get('asset_type') or ''
+            if (any(x is not None and (isinstance(x, bool) or not isinstance(x, (int, float))) for x in (threshold, price))
+                    or not isinstance(name, str) or not isinstance(asset_type, str)):
+                return None
+            name_bytes, asset_type_bytes = name.encode('utf-8'), asset_type.encode('utf-8')
+            if len(name_bytes) > 0xFFFF or len(asset_type_bytes) > 8 or b'\0' in asset_type_bytes:
+                return None
+            try:
+                records.append(SNAPSHOT_ROW.pack(chat_number, symbol_bytes, flags, threshold or 0.0, price or 0.0,
+                                                 asset_type_bytes, len(names), len(name_bytes)))
+            except struct.error:
+                return None
+            names += name_bytes
+    return len(records), b''.join(records) + bytes(names), len(names)
+
+def decode_snapshot_rows(view, count, names_length):
+    """Přečte záznamy SNAPSHOT_ROW přímo z bufferu (mmap) za hlavičkou zpět do {chat_id: {symbol: hodnota}}."""
+    names_start = SNAPSHOT_HEADER.size + count * SNAPSHOT_ROW.size
+    if names_start + names_length != len(view):
+        raise CorruptDataError("nesouhlasí počet řádků a délka souboru")
+    data, chats = {}, {}
+    try:
+        for offset in range(SNAPSHOT_HEADER.size, names_start, SNAPSHOT_ROW.size):
+            chat_id, symbol, flags, threshold, price, asset_type, name_offset, name_length = SNAPSHOT_ROW.unpack_from(view, offset)
+            value = {}
+            if flags & 1:
+                value['threshold'] = None if flags & 16 else threshold
+            if flags & 2:
+                value['last_notification_price'] = None if flags & 32 else price
+            if flags & 4:
+                if name_offset + name_length > names_length:
+                    raise CorruptDataError("jméno mimo tabulku jmen")
+                value['name'] = None if flags & 64 else str(view[names_start + name_offset:names_start + name_offset + name_length], 'utf-8')
+            if flags & 8:
+                value['asset_type'] = None if flags & 128 else asset_type.rstrip(b'\0').decode('utf-8')
+            rows = chats.get(chat_id)
+            if rows is None:
+                rows = chats[chat_id] = data.setdefault(str(chat_id), {})
+            rows[symbol.rstrip(b'\0').decode('utf-8')] = value
+    except UnicodeDecodeError as e:
+        raise CorruptDataError(f"neplatný text v řádku: {e}")
+    return data
+
+def read_snapshot(path):
+    """Načte snapshot přes mmap. Formát pozná podle magic hlavičky: binární řádky čte přímo z mmap, jinak JSON."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise CorruptDataError("prázdný soubor")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            if view[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                payload = bytes(view)
+            else:
+                if len(view) < SNAPSHOT_HEADER.size:
+                    raise CorruptDataError("nedopsaná hlavička")
+                _, version, count, names_length, crc = SNAPSHOT_HEADER.unpack_from(view, 0)
+                if version != SNAPSHOT_VERSION:
+                    raise CorruptDataError(f"neznámá verze formátu {version}")
+                if zlib.crc32(view[SNAPSHOT_HEADER.size:]) != crc:
+                    raise CorruptDataError("nesouhlasí CRC")
+                return decode_snapshot_rows(view, count, names_length)
+    try:
+        return json.loads(payload)
+    except ValueError as e:
+        raise CorruptDataError(f"neplatný JSON: {e}")
+
+def write_snapshot(path, data):
+    """Atomický zápis: dočasný soubor, fsync, rename. Při pádu zůstane celý starý nebo celý nový soubor."""
+    encoded = encode_snapshot_rows(data) if path.endswith('.bin') else None
+    if encoded is not None:
+        count, body, names_length = encoded
+        payload = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, count, names_length, zlib.crc32(body)) + body
+    else:
+        if path.endswith('.bin'):
+            print(f"⚠️  {path}: data se nevejdou do binárních řádků, ukládám jako JSON")
+        payload = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+def replay_journal(file_name, data):
+    """Přehraje journal do data. Vrací (počet záznamů, zda byl některý řádek poškozený)."""
+    path = journal_path(file_name)
+    if not os.path.exists(path):
+        return 0, False
+    entries, corrupt = 0, False
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                apply_rows(data, {(entry['c'], entry['s']): entry['v']})
+                entries += 1
+            except (ValueError, KeyError, TypeError):
+                # Typicky nedopsaný řádek po pádu uprostřed zápisu
+                corrupt = True
+    return entries, corrupt
+
+def load_data_file(file_name):
+    """Načte snapshot + journal. Poškozený snapshot zkopíruje vedle (.corrupt-<čas>) a vyhodí
+    CorruptDataError, místo aby ho potichu považoval za prázdný a příštím zápisem data přepsal."""
+    data = {}
+    # Po přepnutí formátu může ležet snapshot v obou; platný je ten naposledy zapsaný
+    paths = [p for p in snapshot_paths(file_name) if os.path.exists(p)]
+    path = max(paths, key=os.path.getmtime) if paths else None
+    if path:
+        try:
+            data = read_snapshot(path)
+        except CorruptDataError as e:
+            corrupt_path = f"{path}.corrupt-{int(time.time())}"
+            shutil.copy2(path, corrupt_path)
+            print(f"❌ Soubor {path} je poškozený ({e}), kopie uložena do {corrupt_path}")
+            raise CorruptDataError(f"{path}: {e}")
+    entries, corrupt = replay_journal(file_name, data)
+    JOURNAL_SIZES[file_name] = entries
+    if corrupt:
+        print(f"⚠️  Poškozený záznam v {journal_path(file_name)}, journal kompaktuji")
+        save_data_file(file_name, data)
+    return data
+
+def save_data_file(file_name, data):
+    """Zapíše celý snapshot a smaže journal (jeho změny už snapshot obsahuje)."""
+    path, other_path = snapshot_paths(file_name)
+    try:
+        write_snapshot(path, data)
+        if os.path.exists(other_path):
+            os.remove(other_path)
+        if os.path.exists(journal_path(file_name)):
+            os.remove(journal_path(file_name))
+        JOURNAL_SIZES[file_name] = 0
+    except Exception as e:
+        print(f"⚠️  Chyba zápisu {file_name}: {e}")
+
+def append_journal(file_name, changes):
+    """Připíše změny řádků na konec journalu, při jeho přerůstání ho zkompaktuje."""
+    lines = ''.join(json.dumps({'c': chat_id, 's': symbol, 'v': value}, separators=(',', ':')) + '\n'
+                    for (chat_id, symbol), value in changes.items())
+    try:
+        with open(journal_path(file_name), 'a') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+    except Exception as e:
+        print(f"⚠️  Chyba zápisu {journal_path(file_name)}: {e}")
+        return
+    JOURNAL_SIZES[file_name] = JOURNAL_SIZES.get(file_name, 0) + len(changes)
+    if JOURNAL_SIZES[file_name] >= JOURNAL_COMPACT_EVERY:
+        save_data_file(file_name, load_data_file(file_name))
+
+def load_data(table_name, file_name, versions=None):
+    """Obecná funkce pro načtení dat (config nebo state) jako {chat_id: {symbol: hodnota}}.
+    Z DB doplní do versions verze řádků (viz db_load_rows)."""
     # 1. Zkusíme DB
-    if conn:
+    if DB_POOL:
         try:
-            cur = conn.cursor()
-            cur.execute(f"SELECT data FROM {table_name} ORDER BY id DESC LIMIT 1")
-            row = cur.fetchone()
-            if row and row[0]:
-                data = row[0]
-            cur.close()
-            conn.close()
+            return db_transaction(lambda cur: db_load_rows(cur, table_name, versions))
         except Exception as e:
             print(f"⚠️  Chyba DB load ({table_name}): {e}")
-            if conn: conn.close()
     
-    # 2. Fallback na soubor (pokud je DB prázdná nebo nedostupná a soubor existuje)
-    if not data and os.path.exists(file_name):
+    # 2. Fallback na soubor (bez DB nebo když je DB nedostupná)
+    data, migrated = wrap_legacy_format(load_data_file(file_name))
+    if migrated:
+        # Okamžitě uložíme migrovanou verzi
+        save_data(table_name, file_name, data)
+    return data
+
+def save_rows_batch(batch, versions=None, fields=None):
+    """Uloží změny řádků více tabulek {(table_name, file_name): {(chat_id, symbol): hodnota nebo None = smazat}}.
+    V DB jako UPSERT/DELETE v jedné transakci, cena zápisu tedy odpovídá velikosti změny, ne počtu uživatelů.
+    S versions (a fields) ve stejném tvaru zapisuje přes compare-and-swap (db_cas_rows) a vrací
+    {(table_name, file_name): výsledek db_cas_rows}; jinak a bez DB vrací {}."""
+    batch = {key: changes for key, changes in batch.items() if changes}
+    if not batch:
+        return {}
+    
+    def apply(cur):
+        results = {}
+        for key, changes in batch.items():
+            if versions is None:
+                db_apply_rows(cur, key[0], changes)
+            else:
+                results[key] = db_cas_rows(cur, key[0], changes, versions.get(key, {}), (fields or {}).get(key, {}))
+        return results
+    
+    # 1. DB Save
+    if DB_POOL:
         try:
-            with open(file_name, 'r') as f:
-                data = json.load(f)
-        except:
-            pass
+            return db_transaction(apply)
+        except WriteConflictError:
+            raise
+        except Exception as e:
+            print(f"⚠️  Chyba DB save ({', '.join(table for table, _ in batch)}): {e}")
+    
+    # 2. File Save (lokální běh nebo nedostupná DB)
+    for (_, file_name), changes in batch.items():
+        append_journal(file_name, changes)
+    return {}
+
+def save_rows(table_name, file_name, changes):
+    save_rows_batch({(table_name, file_name): changes})
+
+# Blokující DB/souborové operace běží v jednom vlákně úložiště: event loop (a tím všechny chaty) na ně
+# nečeká a jedno vlákno zachovává pořadí zápisů.
+STORAGE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='storage')
 
-    # 3. Migrace starého formátu (pokud root klíče nejsou čísla/chat_id, ale přímo tickery jako 'BTC')
-    # Předpokládáme, že stará data patří adminovi (z env var)
-    if data and ADMIN_CHAT_ID:
-        # Získáme první klíč bezpečně
+async def run_storage(fn, *args):
+    """Asynchronní API úložiště: spustí blokující fn(*args) ve vlákně úložiště a počká na výsledek."""
+    return await asyncio.get_running_loop().run_in_executor(STORAGE_EXECUTOR, fn, *args)
+
+class WriteBehindQueue:
+    """Odložený zápis: změny řádků se v paměti slučují (poslední hodnota vyhrává) a background task je
+    po WRITE_BEHIND_WINDOW uloží najednou v jedné transakci. Bez běžícího tasku se zapisuje hned.
+    Zapisuje se s verzemi řádků ze STORE (compare-and-swap), výsledky zápisu se do STORE vrací."""
+    
+    def __init__(self, window=None):
+        self.window = WRITE_BEHIND_WINDOW if window is None else window
+        self.pending = {}  # {(table_name, file_name): {(chat_id, symbol): hodnota}}
+        self.pending_fields = {}  # {(table_name, file_name): {(chat_id, symbol): změněná pole nebo None = všechna}}
+        self.running = False
+        self._wakeup = None
+        self.submitted = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_last = 0.0
+        self.flush_total = 0.0
+        self.flush_max = 0.0
+    
+    def depth(self):
+        return sum(len(changes) for changes in self.pending.values())
+    
+    def submit(self, table_name, file_name, changes, fields=None):
+        """Zařadí změny řádků; fields = {(chat_id, symbol): množina změněných polí} pro slučování při konfliktu."""
+        pending = self.pending.setdefault((table_name, file_name), {})
+        pending_fields = self.pending_fields.setdefault((table_name, file_name), {})
+        for key, value in changes.items():
+            key_fields = (fields or {}).get(key)
+            if key in pending:
+                self.coalesced += 1
+                previous = pending_fields.get(key)
+                key_fields = None if previous is None or key_fields is None else previous | key_fields
+            pending[key] = value
+            pending_fields[key] = key_fields
+        self.submitted += len(changes)
+        if not self.running:
+            self.flush()
+            return
+        self._wakeup.set()
+    
+    def take_batch(self):
+        """Vyjme čekající změny s verzemi řádků ze STORE. Hodnoty kopíruje, aby je pozdější úpravy
+        ve STORE nezměnily během zápisu. Vrací (batch, versions, fields) pro save_rows_batch."""
+        batch, self.pending = self.pending, {}
+        fields, self.pending_fields = self.pending_fields, {}
+        batch = {key: {row: dict(value) if value is not None else None for row, value in changes.items()}
+                 for key, changes in batch.items()}
+        return batch, STORE.row_versions(batch), fields
+    
+    def flush(self):
+        """Synchronně uloží vše čekající (zápis skrz bez běžícího tasku, --migrate). Jde přes vlákno úložiště,
+        aby se nepředběhl s právě běžícím asynchronním flushem. V event loopu se ukončuje přes aclose()."""
+        batch, versions, fields = self.take_batch()
+        if not batch:
+            return
+        started = time.monotonic()
         try:
-            first_key = next(iter(data))
-        except StopIteration:
-            first_key = None
-            
-        if first_key:
-            # Pokud klíč vypadá jako ticker (krátký, písmena) a ne jako ID (čísla)
-            if isinstance(first_key, str) and not first_key.isdigit() and len(first_key) < 10:
-                print(f"🔄 Migrace dat pro uživatele {ADMIN_CHAT_ID}...")
-                data = {str(ADMIN_CHAT_ID): data}
-                # Okamžitě uložíme migrovanou verzi
-                save_data(table_name, file_name, data)
+            STORE.apply_written(STORAGE_EXECUTOR.submit(save_rows_batch, batch, versions, fields).result())
+        finally:
+            self._record_flush(batch, time.monotonic() - started)
+    
+    async def async_flush(self):
+        """Uloží vše čekající ve vlákně úložiště, event loop mezitím běží dál."""
+        batch, versions, fields = self.take_batch()
+        if not batch:
+            return
+        started = time.monotonic()
+        try:
+            STORE.apply_written(await run_storage(save_rows_batch, batch, versions, fields))
+        finally:
+            self._record_flush(batch, time.monotonic() - started)
+    
+    def _record_flush(self, batch, elapsed):
+        self.flushes += 1
+        self.flushed_rows += sum(len(changes) for changes in batch.values())
+        self.flush_last = elapsed
+        self.flush_total += elapsed
+        self.flush_max = max(self.flush_max, elapsed)
+    
+    async def run(self, stop_event):
+        """Background task: po první změně počká okno WRITE_BEHIND_WINDOW a vše nasbírané uloží najednou."""
+        self._wakeup = asyncio.Event()
+        self.running = True
+        try:
+            while not stop_event.is_set():
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    continue
+                await asyncio.sleep(self.window)
+                self._wakeup.clear()
+                try:
+                    await self.async_flush()
+                except Exception as e:
+                    print(f"❌ Chyba odloženého zápisu: {e}")
+        finally:
+            await self.aclose()
+    
+    async def aclose(self):
+        """Další změny zapisuje hned a dosud čekající uloží ve vlákně úložiště (post_shutdown)."""
+        self.running = False
+        await self.async_flush()
+    
+    def close(self):
+        """Jako aclose(), ale blokuje - jen mimo event loop (--migrate)."""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.running = False
+            self.flush()
+            return
+        raise RuntimeError("WriteBehindQueue.close() by blokoval event loop, použij await aclose()")
+    
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'submitted': self.submitted,
+            'coalesced': self.coalesced,
+            'flushes': self.flushes,
+            'flushed_rows': self.flushed_rows,
+            'flush_last_ms': round(self.flush_last * 1000, 1),
+            'flush_avg_ms': round(self.flush_total / self.flushes * 1000, 1) if self.flushes else 0.0,
+            'flush_max_ms': round(self.flush_max * 1000, 1),
+        }
 
-    return data
+WRITE_QUEUE = WriteBehindQueue()
 
 def save_data(table_name, file_name, data):
-    """Obecná funkce pro uložení JSON dat."""
-    conn = get_db_connection()
+    """Nahradí celý obsah. V DB jen smaže chybějící řádky a zbytek UPSERTne v jedné transakci,
+    takže tabulka není nikdy ani na okamžik prázdná."""
+    def replace_rows(cur):
+        changes = {key: None for key in data_to_rows(db_load_rows(cur, table_name))}
+        changes.update(data_to_rows(data))
+        db_apply_rows(cur, table_name, changes)
     
     # 1. DB Save
-    if conn:
+    if DB_POOL:
         try:
-            cur = conn.cursor()
-            cur.execute(f"DELETE FROM {table_name}")
-            cur.execute(f"INSERT INTO {table_name} (data) VALUES (%s)", (json.dumps(data),))
-            conn.commit()
-            cur.close()
-            conn.close()
+            db_transaction(replace_rows)
+            return
         except Exception as e:
             print(f"⚠️  Chyba DB save ({table_name}): {e}")
-            if conn: conn.close()
     
-    # 2. File Save (jako záloha nebo pro lokální běh)
+    # 2. File Save (lokální běh nebo nedostupná DB)
+    save_data_file(file_name, data)
+
+# --- Index prahů alertů ---
+# Pro každý symbol dvě seřazené řady spouštěcích cen: horní last*(1+threshold) a dolní last*(1-threshold).
+# Nová cena bisekcí najde jen odběry, které překročila, a ty se přepočítají přesně (change_pct >= threshold).
+# Index udržuje DataStore při každé změně configu nebo stavu (přidání, úprava, smazání, odeslaný alert).
+# S ALERT_ENGINE=numpy místo něj NumpyAlertEngine: všechny odběry ve sloupcích, jeden vektorový průchod na cyklus.
+# Oba mají stejné rozhraní (rebuild/refresh/triggered), viz benchmark_alert_engine.py.
+TRIGGER_SLACK = 1e-9  # Rezerva proti zaokrouhlení: raději o kandidáta víc, přesná kontrola ho vyřadí
+
+class ThresholdIndex:
+    """Spouštěcí ceny odběrů po symbolech, seřazené pro bisekci."""
+    
+    def __init__(self):
+        self.upper = {}  # {symbol: seřazený [(spouštěcí cena, chat_id)]}
+        self.lower = {}  # {symbol: seřazený [(spouštěcí cena, chat_id)]}
+        self.unpriced = {}  # {symbol: {chat_id}} - odběry bez první ceny, kandidáti vždy
+        self.entries = {}  # {(chat_id, symbol): (horní, dolní) nebo None bez ceny}
+    
+    def rebuild(self, config, state):
+        self.upper, self.lower, self.unpriced, self.entries = {}, {}, {}, {}
+        for chat_id, user_conf in config.items():
+            for symbol, settings in user_conf.items():
+                triggers = self._add(chat_id, symbol, settings, state)
+                if triggers is not None:
+                    self.upper.setdefault(symbol, []).append((triggers[0], chat_id))
+                    self.lower.setdefault(symbol, []).append((triggers[1], chat_id))
+        for side in (self.upper, self.lower):
+            for items in side.values():
+                items.sort()
+    
+    def refresh(self, keys, config, state):
+        """Přepočítá spouštěcí ceny odběrů (chat_id, symbol) podle aktuálního configu a stavu."""
+        for chat_id, symbol in keys:
+            self._remove(chat_id, symbol)
+            settings = config.get(chat_id, {}).get(symbol)
+            if settings is None:
+                continue
+            triggers = self._add(chat_id, symbol, settings, state)
+            if triggers is not None:
+                bisect.insort(self.upper.setdefault(symbol, []), (triggers[0], chat_id))
+                bisect.insort(self.lower.setdefault(symbol, []), (triggers[1], chat_id))
+    
+    def _add(self, chat_id, symbol, settings, state):
+        """Zapíše odběr do entries a vrátí jeho spouštěcí ceny (None = zatím bez ceny)."""
+        last_price = (state.get(chat_id, {}).get(symbol) or {}).get('last_notification_price')
+        if last_price is None:
+            self.unpriced.setdefault(symbol, set()).add(chat_id)
+            self.entries[(chat_id, symbol)] = None
+            return None
+        threshold = settings.get('threshold', 0.05)
+        triggers = (last_price * (1 + threshold) * (1 - TRIGGER_SLACK), last_price * (1 - threshold) * (1 + TRIGGER_SLACK))
+        self.entries[(chat_id, symbol)] = triggers
+        return triggers
+    
+    def _remove(self, chat_id, symbol):
+        if (chat_id, symbol) not in self.entries:
+            return
+        triggers = self.entries.pop((chat_id, symbol))
+        if triggers is None:
+            self.unpriced[symbol].discard(chat_id)
+            if not self.unpriced[symbol]:
+                del self.unpriced[symbol]
+            return
+        for side, trigger in ((self.upper, triggers[0]), (self.lower, triggers[1])):
+            items = side[symbol]
+            del items[bisect.bisect_left(items, (trigger, chat_id))]
+            if not items:
+                del side[symbol]
+    
+    def candidates(self, symbol, price):
+        """chat_id odběrů symbolu, jejichž práh cena překročila (nahoru nebo dolů), plus odběry bez ceny."""
+        upper = self.upper.get(symbol, ())
+        lower = self.lower.get(symbol, ())
+        crossed = [chat_id for _, chat_id in upper[:bisect.bisect_left(upper, (math.nextafter(price, math.inf),))]]
+        crossed += [chat_id for _, chat_id in lower[bisect.bisect_left(lower, (price,)):]]
+        crossed += self.unpriced.get(symbol, ())
+        return crossed
+    
+    def triggered(self, current_prices):
+        """[(chat_id, symbol)] kandidátů pro všechny ceny cyklu."""
+        pairs = []
+        for symbol, price in current_prices.items():
+            pairs.extend((chat_id, symbol) for chat_id in dict.fromkeys(self.candidates(symbol, price)))
+        return pairs
+    
+    def subscriptions(self, symbol=None):
+        if symbol is None:
+            return len(self.entries)
+        return len(self.upper.get(symbol, ())) + len(self.unpriced.get(symbol, ()))
+    
+    def stats(self):
+        return {'engine': 'index', 'symbols': len(set(self.upper) | set(self.unpriced)), 'subscriptions': len(self.entries)}
+
+class NumpyAlertEngine:
+    """Odběry ve sloupcových polích (symbol, poslední cena, práh); vyhodnocení jedním vektorovým průchodem.
+    Výsledek je stejný jako u průchodu všemi odběry: change_pct >= threshold, nebo odběr ještě bez ceny."""
+    
+    def __init__(self, capacity=1024):
+        self.symbol_ids = {}  # {symbol: id}
+        self.symbols = []  # [symbol] podle id
+        self.keys = []  # [(chat_id, symbol)] podle řádku, chat_id může být libovolný řetězec
+        self.rows = {}  # {(chat_id, symbol): řádek}
+        self._allocate(capacity)
+    
+    def _allocate(self, capacity):
+        self.symbol_col = np.zeros(capacity, dtype=np.int32)
+        self.last_col = np.full(capacity, np.nan)  # NaN = bez první ceny
+        self.threshold_col = np.zeros(capacity)
+    
+    def _grow(self):
+        old = (self.symbol_col, self.last_col, self.threshold_col)
+        self._allocate(len(self.symbol_col) * 2)
+        n = len(self.keys)
+        for new_col, old_col in zip((self.symbol_col, self.last_col, self.threshold_col), old):
+            new_col[:n] = old_col[:n]
+    
+    def _symbol_id(self, symbol):
+        if symbol not in self.symbol_ids:
+            self.symbol_ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return self.symbol_ids[symbol]
+    
+    @staticmethod
+    def _row_values(chat_id, symbol, settings, state):
+        last_price = (state.get(chat_id, {}).get(symbol) or {}).get('last_notification_price')
+        return (np.nan if last_price is None else last_price), settings.get('threshold', 0.05)
+    
+    def rebuild(self, config, state):
+        self.symbol_ids, self.symbols, self.rows = {}, [], {}
+        self.keys = [(chat_id, symbol) for chat_id, user_conf in config.items() for symbol in user_conf]
+        self._allocate(max(1024, len(self.keys)))
+        n = len(self.keys)
+        values = [self._row_values(chat_id, symbol, config[chat_id][symbol], state) for chat_id, symbol in self.keys]
+        self.symbol_col[:n] = [self._symbol_id(symbol) for _, symbol in self.keys]
+        self.last_col[:n] = [last for last, _ in values]
+        self.threshold_col[:n] = [threshold for _, threshold in values]
+        self.rows = {key: i for i, key in enumerate(self.keys)}
+    
+    def refresh(self, keys, config, state):
+        """Zapíše změněné odběry do sloupců (nový řádek na konec, smazaný nahradí poslední řádek)."""
+        for chat_id, symbol in keys:
+            settings = config.get(chat_id, {}).get(symbol)
+            row = self.rows.get((chat_id, symbol))
+            if settings is None:
+                if row is not None:
+                    self._remove(row)
+                continue
+            if row is None:
+                if len(self.keys) == len(self.symbol_col):
+                    self._grow()
+                row = len(self.keys)
+                self.keys.append((chat_id, symbol))
+                self.rows[(chat_id, symbol)] = row
+                self.symbol_col[row] = self._symbol_id(symbol)
+            self.last_col[row], self.threshold_col[row] = self._row_values(chat_id, symbol, settings, state)
+    
+    def _remove(self, row):
+        last = len(self.keys) - 1
+        del self.rows[self.keys[row]]
+        if row != last:
+            moved = self.keys[last]
+            self.keys[row] = moved
+            self.rows[moved] = row
+            for col in (self.symbol_col, self.last_col, self.threshold_col):
+                col[row] = col[last]
+        self.keys.pop()
+    
+    def triggered(self, current_prices):
+        """[(chat_id, symbol)] odběrů, u kterých cena překročila práh nebo chybí první cena."""
+        n = len(self.keys)
+        if not n:
+            return []
+        prices = np.full(len(self.symbols), np.nan)
+        for symbol, price in current_prices.items():
+            if symbol in self.symbol_ids and price is not None:
+                prices[self.symbol_ids[symbol]] = price
+        price = prices[self.symbol_col[:n]]
+        last = self.last_col[:n]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change_pct = np.abs((price - last) / last)
+        mask = ~np.isnan(price) & (np.isnan(last) | (change_pct >= self.threshold_col[:n]))
+        return [self.keys[i] for i in np.flatnonzero(mask)]
+    
+    def subscriptions(self, symbol=None):
+        if symbol is None:
+            return len(self.keys)
+        if symbol not in self.symbol_ids:
+            return 0
+        return int(np.count_nonzero(self.symbol_col[:len(self.keys)] == self.symbol_ids[symbol]))
+    
+    def stats(self):
+        n = len(self.keys)
+        return {'engine': 'numpy', 'symbols': len(np.unique(self.symbol_col[:n])), 'subscriptions': n}
+
+def create_alert_index():
+    """Výběr odběrů k vyhodnocení podle ALERT_ENGINE (numpy jen s nainstalovaným numpy)."""
+    if ALERT_ENGINE == 'numpy':
+        if np is not None:
+            return NumpyAlertEngine()
+        print("⚠️  ALERT_ENGINE=numpy vyžaduje balíček numpy, používám index prahů")
+    return ThresholdIndex()
+
+# --- Registr sledovaných symbolů ---
+# Symboly všech odběrů s typem a počtem odběratelů. DataStore ho mění při přidání/smazání odběru,
+# smyčka cen si z něj jen přečte hotové {symbol: asset_type} (bez procházení configů všech uživatelů).
+
+class SymbolRegistry:
+    """Počítané reference na sledované symboly: {symbol: počet odběratelů po typech}."""
+    
+    def __init__(self):
+        self.types = {}  # {symbol: Counter({asset_type: počet odběrů})}
+        self.symbol_types = {}  # {symbol: asset_type} pro async_get_prices
+        self.version = 0  # Zvyšuje se při přidání/odebrání symbolu nebo změně jeho typu
+    
+    def rebuild(self, config):
+        self.types, self.symbol_types = {}, {}
+        for user_conf in config.values():
+            for symbol, settings in user_conf.items():
+                self.types.setdefault(symbol, Counter())[settings.get('asset_type')] += 1
+        for symbol in self.types:
+            self._resolve(symbol)
+        self.version += 1
+    
+    def replace(self, symbol, old_settings, new_settings):
+        """Zaznamená změnu jednoho odběru (None = odběr neexistoval / byl smazán)."""
+        if old_settings is not None:
+            counts = self.types[symbol]
+            counts[old_settings.get('asset_type')] -= 1
+            if counts[old_settings.get('asset_type')] <= 0:
+                del counts[old_settings.get('asset_type')]
+        if new_settings is not None:
+            self.types.setdefault(symbol, Counter())[new_settings.get('asset_type')] += 1
+        if symbol in self.types and not self.types[symbol]:
+            del self.types[symbol]  # Poslední odběratel pryč -> symbol se hned přestane sledovat
+        before = self.symbol_types.get(symbol, 'missing')
+        self._resolve(symbol)
+        if self.symbol_types.get(symbol, 'missing') != before:
+            self.version += 1
+    
+    def _resolve(self, symbol):
+        # Typ podle většiny odběrů, které ho mají; None = automatická detekce (odběr před migrací)
+        counts = self.types.get(symbol)
+        if not counts:
+            self.symbol_types.pop(symbol, None)
+            return
+        typed = [(n, t) for t, n in counts.items() if t is not None]
+        self.symbol_types[symbol] = max(typed)[1] if typed else None
+    
+    def subscribers(self, symbol):
+        return sum(self.types.get(symbol, {}).values())
+    
+    def snapshot(self):
+        """[(symbol, asset_type, počet odběratelů)] seřazené podle počtu odběratelů."""
+        return sorted(((symbol, self.symbol_types[symbol], sum(counts.values())) for symbol, counts in self.types.items()),
+                      key=lambda row: (-row[2], row[0]))
+    
+    def stats(self):
+        return {'symbols': len(self.types), 'subscriptions': sum(sum(c.values()) for c in self.types.values()),
+                'version': self.version}
+
+class DataStore:
+    """Autoritativní kopie configu a stavu všech uživatelů v paměti. Načte se jednou při startu,
+    všechna čtení jdou z paměti a změny se zapisují skrz do DB/souboru (přes WRITE_QUEUE)."""
+    
+    def __init__(self):
+        self.config = {}  # {chat_id: {symbol: {'name', 'threshold', 'asset_type'}}}
+        self.state = {}  # {chat_id: {symbol: {'last_notification_price'}}}
+        self.versions = {'crypto_config': {}, 'crypto_state': {}}  # {tabulka: {(chat_id, symbol): verze v DB}}
+        self.loaded = False
+        self.index = create_alert_index()
+        self.symbols = SymbolRegistry()
+        self._derived_from = None  # (config, state), ze kterých jsou index a registr symbolů postavené
+    
+    def load(self):
+        self.versions = {'crypto_config': {}, 'crypto_state': {}}
+        self.config = load_data('crypto_config', CONFIG_FILE, self.versions['crypto_config'])
+        self.state = load_data('crypto_state', STATE_FILE, self.versions['crypto_state'])
+        self.loaded = True
+        self._ensure_derived()
+        print(f"📦 Načteno {sum(len(c) for c in self.config.values())} sledovaných symbolů pro {len(self.config)} uživatelů")
+    
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+    
+    def _ensure_derived(self):
+        """Index alertů a registr symbolů jsou odvozené z config/state; při výměně celých dat se postaví znovu."""
+        if self._derived_from is None or self._derived_from[0] is not self.config or self._derived_from[1] is not self.state:
+            self.index.rebuild(self.config, self.state)
+            self.symbols.rebuild(self.config)
+            self._derived_from = (self.config, self.state)
+    
+    def threshold_index(self):
+        """Index alertů (create_alert_index) nad aktuálními daty."""
+        self._ensure_derived()
+        return self.index
+    
+    def symbol_registry(self):
+        self._ensure_derived()
+        return self.symbols
+    
+    def _reindex(self, keys, old_config=None):
+        """Promítne změněné odběry do indexu; s old_config {(chat_id, symbol): původní nastavení} i do registru."""
+        if self._derived_from is None:
+            return
+        self._ensure_derived()
+        self.index.refresh(keys, self.config, self.state)
+        for chat_id, symbol in (old_config or ()):
+            self.symbols.replace(symbol, old_config[(chat_id, symbol)], self.config.get(chat_id, {}).get(symbol))
+    
+    @staticmethod
+    def _old_settings(data, keys):
+        return {(chat_id, symbol): dict(data[chat_id][symbol]) if symbol in data.get(chat_id, {}) else None
+                for chat_id, symbol in keys}
+    
+    def user_config(self, chat_id):
+        """Kopie configu uživatele (úpravy se ukládají přes update_config)."""
+        self._ensure_loaded()
+        return {symbol: dict(settings) for symbol, settings in self.config.get(str(chat_id), {}).items()}
+    
+    def user_state(self, chat_id):
+        self._ensure_loaded()
+        return {symbol: dict(state) for symbol, state in self.state.get(str(chat_id), {}).items()}
+    
+    @staticmethod
+    def _changed_fields(data, changes):
+        """Pole, která změny skutečně mění (pro sloučení s DB při konfliktu verzí)."""
+        fields = {}
+        for (chat_id, symbol), value in changes.items():
+            old = data.get(chat_id, {}).get(symbol) or {}
+            if value is not None:
+                fields[(chat_id, symbol)] = {c for c in set(value) | set(old) if value.get(c) != old.get(c)}
+        return fields
+    
+    def update_config(self, changes):
+        """Provede změny {(chat_id, symbol): nastavení nebo None = smazat} v paměti a zapíše je skrz."""
+        self._ensure_loaded()
+        fields = self._changed_fields(self.config, changes)
+        old_config = self._old_settings(self.config, changes)
+        apply_rows(self.config, changes)
+        self._reindex(changes, old_config)
+        if SHARDS is not None:
+            SHARDS.publish('config', changes)
+        WRITE_QUEUE.submit('crypto_config', CONFIG_FILE, changes, fields)
+    
+    def update_state(self, changes):
+        self._ensure_loaded()
+        fields = self._changed_fields(self.state, changes)
+        apply_rows(self.state, changes)
+        self._reindex(changes)
+        WRITE_QUEUE.submit('crypto_state', STATE_FILE, changes, fields)
+    
+    def persist_state(self, keys):
+        """Zapíše skrz stav (chat_id, symbol), který smyčka změnila přímo ve self.state."""
+        self._reindex(keys)
+        WRITE_QUEUE.submit('crypto_state', STATE_FILE, {key: self.state[key[0]][key[1]] for key in keys},
+                           {key: {'last_notification_price'} for key in keys})
+    
+    def row_versions(self, batch):
+        """Poslední známé verze řádků dávky {(table_name, file_name): {(chat_id, symbol): verze}}."""
+        return {key: {row: self.versions[key[0]][row] for row in changes if row in self.versions[key[0]]}
+                for key, changes in batch.items()}
+    
+    def apply_written(self, results):
+        """Po zápisu do DB: zapamatuje nové verze řádků a převezme pole, která mezitím změnil jiný zapisovatel."""
+        merged, old_config = [], {}
+        for (table_name, _), rows in results.items():
+            data = self.config if table_name == 'crypto_config' else self.state
+            for (chat_id, symbol), (version, from_db) in rows.items():
+                if version is None:
+                    self.versions[table_name].pop((chat_id, symbol), None)
+                    continue
+                self.versions[table_name][(chat_id, symbol)] = version
+                row = data.get(chat_id, {}).get(symbol)
+                if row is not None and from_db:
+                    if table_name == 'crypto_config':
+                        old_config[(chat_id, symbol)] = dict(row)
+                    row.update(from_db)
+                    merged.append((chat_id, symbol))
+        if merged:
+            self._reindex(merged, old_config)
+            if SHARDS is not None:
+                SHARDS.publish('config', {key: self.config[key[0]][key[1]] for key in old_config})
+
+STORE = DataStore()
+
+# Helpery pro přístup k datům konkrétního uživatele. Handler čte, mění a ukládá bez await mezi tím,
+# takže ho v event loopu nic nepřeruší a zámek po chatech není potřeba. Proti souběžným zápisům
+# jiných procesů/instancí chrání verze řádků (compare-and-swap) a sloučení změněných polí, viz db_cas_rows.
+def get_user_config(chat_id):
+    return STORE.user_config(chat_id)
+
+def save_user_config(chat_id, user_config, symbols):
+    """Uloží změněné symboly uživatele; symbol, který v user_config už není, se smaže."""
+    STORE.update_config({(str(chat_id), s): user_config.get(s) for s in symbols})
+
+def get_user_state(chat_id):
+    return STORE.user_state(chat_id)
+
+def save_user_state(chat_id, user_state, symbols):
+    changes = {(str(chat_id), s): user_state.get(s) for s in symbols}
+    STORE.update_state(changes)
+    if SHARDS is not None:
+        SHARDS.publish('state', changes)
+
+# --- API Funkce ---
+# Parsování odpovědí je společné pro synchronní (requests) i asynchronní (httpx) cestu.
+
+YAHOO_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'application/json',
+    'Accept-Language': 'en-US,en;q=0.9',
+}
+
+# --- Registr HTTP session pro poskytovatele ---
+# Každý poskytovatel má vlastní keep-alive pool (sync requests.Session i async httpx klient),
+# výchozí hlavičky, timeout a velikost poolu. Počítadla ukazují, kolik requestů znovupoužilo spojení.
+
+PROVIDER_CONFIG = {
+    'cryptocompare': {'headers': {'Authorization': f'Apikey {CRYPTOCOMPARE_API_KEY}'}, 'timeout': HTTP_TIMEOUT, 'pool_size': HTTP_POOL_SIZE},
+    'binance': {'headers': {}, 'timeout': HTTP_TIMEOUT, 'pool_size': HTTP_POOL_SIZE},
+    'yahoo': {'headers': YAHOO_HEADERS, 'timeout': HTTP_TIMEOUT, 'pool_size': HTTP_POOL_SIZE},
+    'coingecko': {'headers': {}, 'timeout': 30, 'pool_size': 2},
+}
+
+class ProviderSession:
+    """Keep-alive spojení k jednomu poskytovateli s počítadly requestů a nových spojení."""
+    
+    def __init__(self, name, headers=None, timeout=HTTP_TIMEOUT, pool_size=HTTP_POOL_SIZE):
+        self.name = name
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.headers = dict(headers or {})
+        self.requests = 0
+        self.new_connections = 0
+        self._lock = threading.Lock()
+        
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._adapters = [adapter]
+        self._async_client = None
+    
+    def _sync_connection_count(self):
+        # urllib3 počítá nově otevřená spojení v každém host poolu (num_connections)
+        total = 0
+        for adapter in self._adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    total += pool.num_connections
+        return total
+    
+    def _record(self, new_connections):
+        with self._lock:
+            self.requests += 1
+            self.new_connections += new_connections
+    
+    def _record_outcome(self, started, status_code):
+        # 429 a 5xx znamenají problém poskytovatele, 4xx (např. neznámý ticker) ne
+        success = status_code is not None and status_code != 429 and status_code < 500
+        get_provider_stats(self.name).record(time.monotonic() - started, success)
+        breaker = get_circuit_breaker(self.name)
+        if success:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+    
+    def get(self, url, timeout=None, headers=None, **kwargs):
+        """Synchronní GET přes pool poskytovatele. Při otevřeném jističi vyhodí CircuitOpenError."""
+        get_circuit_breaker(self.name).before_request()
+        get_rate_limiter(self.name).acquire(endpoint_weight(self.name, url))
+        before = self._sync_connection_count()
+        started = time.monotonic()
+        status_code = None
+        try:
+            response = self.session.get(url, timeout=timeout or self.timeout, headers=headers, **kwargs)
+            status_code = response.status_code
+            return response
+        finally:
+            self._record(max(0, self._sync_connection_count() - before))
+            self._record_outcome(started, status_code)
+    
+    def get_async_client(self):
+        if self._async_client is None or self._async_client.is_closed:
+            self._async_client = httpx.AsyncClient(
+                headers=self.headers,
+                timeout=self.timeout,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+        return self._async_client
+    
+    async def async_get(self, url, timeout=None, headers=None):
+        """Asynchronní GET přes pool poskytovatele. Při otevřeném jističi vyhodí CircuitOpenError."""
+        probe = get_circuit_breaker(self.name).before_request()
+        opened = 0
+        
+        async def trace(event_name, info):
+            nonlocal opened
+            # httpcore hlásí otevření nového TCP spojení událostí connection.connect_tcp.complete
+            if event_name.endswith('connect_tcp.complete'):
+                opened += 1
+        
+        started = None
+        status_code = None
+        try:
+            await get_rate_limiter(self.name).async_acquire(endpoint_weight(self.name, url))
+            started = time.monotonic()
+            response = await self.get_async_client().get(
+                url, headers=headers, timeout=timeout or self.timeout, extensions={'trace': trace}
+            )
+            status_code = response.status_code
+            return response
+        except asyncio.CancelledError:
+            started = None  # Zrušený (prohraný hedged) request nezapočítáváme jako chybu
+            if probe:
+                # Jen vlastní zkušební request, jinak bychom pustili další vedle běžícího
+                get_circuit_breaker(self.name).release_probe()
+            raise
+        finally:
+            if started is not None:
+                self._record(opened)
+                self._record_outcome(started, status_code)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'new_connections': self.new_connections,
+                'reused': max(0, self.requests - self.new_connections),
+                'pool_size': self.pool_size,
+            }
+    
+    async def aclose(self):
+        self.session.close()
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+_provider_sessions = {}
+_provider_sessions_lock = threading.Lock()
+
+def get_provider_session(name):
+    """Vrátí (a případně vytvoří) session daného poskytovatele."""
+    with _provider_sessions_lock:
+        if name not in _provider_sessions:
+            _provider_sessions[name] = ProviderSession(name, **PROVIDER_CONFIG.get(name, {}))
+        return _provider_sessions[name]
+
+async def close_provider_sessions():
+    """Zavře všechny session (při ukončení aplikace)."""
+    for session in list(_provider_sessions.values()):
+        await session.aclose()
+    _provider_sessions.clear()
+
+def get_connection_stats():
+    """Počítadla requestů a znovupoužitých spojení pro každého poskytovatele."""
+    return {name: session.stats() for name, session in _provider_sessions.items()}
+
+# --- Circuit breaker poskytovatelů ---
+# Po CIRCUIT_FAILURE_THRESHOLD chybách za sebou se jistič otevře a poskytovatel se přeskakuje bez čekání
+# na timeout. Po CIRCUIT_COOLDOWN sekundách propustí jeden zkušební request (half-open).
+
+class CircuitOpenError(Exception):
+    """Request nebyl odeslán, protože jistič poskytovatele je otevřený."""
+
+class CircuitBreaker:
+    """Jistič jednoho poskytovatele se stavy closed, open a half_open."""
+    
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, cooldown=CIRCUIT_COOLDOWN):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.opens = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+    
+    def _set_state(self, state):
+        if state != self.state:
+            print(f"⚡ Jistič {self.name}: {self.state} -> {state}")
+            self.state = state
+            if state == 'open':
+                self.opened_at = time.monotonic()
+                self.opens += 1
+    
+    def is_open(self):
+        """True, pokud se má poskytovatel přeskočit (otevřeno a cooldown ještě neuplynul)."""
+        with self._lock:
+            if self.state == 'open':
+                return time.monotonic() - self.opened_at < self.cooldown
+            return self.state == 'half_open' and self.probe_in_flight
+    
+    def before_request(self):
+        """Zkontroluje, jestli smí request odejít. Jinak vyhodí CircuitOpenError.
+        Vrací True, pokud je request zkušební (half_open) a volající ho pak musí uzavřít nebo uvolnit."""
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+                self._set_state('half_open')
+            if self.state == 'open' or (self.state == 'half_open' and self.probe_in_flight):
+                self.rejected += 1
+                raise CircuitOpenError(f"Jistič {self.name} je otevřený")
+            if self.state == 'half_open':
+                self.probe_in_flight = True
+                return True
+            return False
+    
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.probe_in_flight = False
+            self._set_state('closed')
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probe_in_flight = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self._set_state('open')
+    
+    def release_probe(self):
+        """Zkušební request skončil bez výsledku (byl zrušen), další může jít hned."""
+        with self._lock:
+            self.probe_in_flight = False
+    
+    def snapshot(self):
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures, 'opens': self.opens, 'rejected': self.rejected}
+
+_circuit_breakers = {}
+
+def get_circuit_breaker(name):
+    if name not in _circuit_breakers:
+        _circuit_breakers[name] = CircuitBreaker(name)
+    return _circuit_breakers[name]
+
+def provider_available(name):
+    """Jestli má smysl poskytovatele volat (jistič není otevřený)."""
+    return not get_circuit_breaker(name).is_open()
+
+def crypto_providers_available():
+    return provider_available('cryptocompare') or provider_available('binance')
+
+def get_circuit_breaker_stats():
+    return {name: breaker.snapshot() for name, breaker in _circuit_breakers.items()}
+
+# --- Rate limiting poskytovatelů (token bucket) ---
+# Každý poskytovatel má jeden bucket sdílený smyčkou i handlery. Request odebere tolik tokenů, kolik
+# váží jeho endpoint, a čeká jen tehdy, když bucket nestačí. Limity lze přepsat proměnnou
+# RATE_LIMIT_<POSKYTOVATEL>="rate/burst" (tokeny za sekundu / velikost bucketu).
+
+DEFAULT_RATE_LIMITS = {
+    'cryptocompare': (5.0, 20),  # ~300 requestů za minutu
+    'binance': (20.0, 200),  # Váhový limit 6000/min, necháváme velkou rezervu
+    'yahoo': (2.0, 5),  # Neoficiální API, raději opatrně
+    'coingecko': (0.5, 5),  # Free tier ~30 requestů za minutu
+}
+
+# Váhy endpointů (první shodný prefix URL), ostatní requesty váží 1
+ENDPOINT_WEIGHTS = {
+    'binance': [
+        ('https://api.binance.com/api/v3/exchangeInfo', 20),
+        ('https://api.binance.com/api/v3/ticker/price?symbol=', 2),
+        ('https://api.binance.com/api/v3/ticker/price', 4),
+    ],
+}
+
+class TokenBucket:
+    """Token bucket s rychlostí rate tokenů za sekundu a kapacitou burst. Bezpečný pro vlákna i event loop."""
+    
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.waits = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+    
+    def reserve(self, weight=1):
+        """Odebere tokeny (i do mínusu) a vrátí, kolik sekund musí volající počkat."""
+        weight = min(float(weight), self.burst)
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= weight
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            if delay > 0:
+                self.waits += 1
+                self.waited += delay
+            return delay
+    
+    def acquire(self, weight=1):
+        delay = self.reserve(weight)
+        if delay > 0:
+            time.sleep(delay)
+    
+    async def async_acquire(self, weight=1):
+        delay = self.reserve(weight)
+        if delay > 0:
+            await asyncio.sleep(delay)
+    
+    def snapshot(self):
+        with self._lock:
+            tokens = min(self.burst, self.tokens + (time.monotonic() - self.updated_at) * self.rate)
+            return {'rate': self.rate, 'tokens': round(tokens, 1), 'waits': self.waits, 'waited_s': round(self.waited, 2)}
+
+def _rate_limit_for(name):
+    override = os.getenv(f'RATE_LIMIT_{name.upper()}')
+    if override:
+        try:
+            rate, burst = override.split('/')
+            return float(rate), float(burst)
+        except ValueError:
+            print(f"⚠️  Neplatný RATE_LIMIT_{name.upper()}={override!r}, očekávám rate/burst")
+    return DEFAULT_RATE_LIMITS.get(name, (5.0, 10))
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(name):
+    with _rate_limiters_lock:
+        if name not in _rate_limiters:
+            rate, burst = _rate_limit_for(name)
+            _rate_limiters[name] = TokenBucket(name, rate, burst)
+        return _rate_limiters[name]
+
+def endpoint_weight(provider, url):
+    for prefix, weight in ENDPOINT_WEIGHTS.get(provider, []):
+        if url.startswith(prefix):
+            return weight
+    return 1
+
+def get_rate_limit_stats():
+    return {name: bucket.snapshot() for name, bucket in _rate_limiters.items()}
+
+# --- Výběr poskytovatele podle latence a hedged requesty ---
+
+class ProviderStats:
+    """Klouzavé okno latencí a úspěšnosti requestů jednoho poskytovatele."""
+    
+    def __init__(self, window=PROVIDER_STATS_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+    
+    def record(self, latency, success):
+        with self._lock:
+            self.outcomes.append(bool(success))
+            if success:
+                self.latencies.append(latency)
+    
+    def success_rate(self):
+        with self._lock:
+            if not self.outcomes:
+                return 1.0
+            return sum(self.outcomes) / len(self.outcomes)
+    
+    def percentile(self, pct):
+        """Percentil latence úspěšných requestů (None, pokud zatím nejsou data)."""
+        with self._lock:
+            if not self.latencies:
+                return None
+            ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[index]
+    
+    def is_healthy(self):
+        return self.success_rate() >= PROVIDER_MIN_SUCCESS_RATE
+    
+    def snapshot(self):
+        p50, p95 = self.percentile(50), self.percentile(95)
+        return {
+            'p50_ms': round(p50 * 1000) if p50 is not None else None,
+            'p95_ms': round(p95 * 1000) if p95 is not None else None,
+            'success': round(self.success_rate(), 2),
+        }
+
+_provider_stats = {}
+
+def get_provider_stats(name):
+    if name not in _provider_stats:
+        _provider_stats[name] = ProviderStats()
+    return _provider_stats[name]
+
+def get_provider_latency_stats():
+    return {name: stats.snapshot() for name, stats in _provider_stats.items()}
+
+def rank_providers(names):
+    """Seřadí poskytovatele: nejdřív zdraví, pak podle mediánu latence (bez dat = zkusíme je, ať se změří)."""
+    names = list(names)
+    random.shuffle(names)  # Při shodě rozložíme zátěž jako dřív
+    
+    def sort_key(name):
+        stats = get_provider_stats(name)
+        p50 = stats.percentile(50)
+        return (not stats.is_healthy(), p50 if p50 is not None else 0.0)
+    
+    return sorted(names, key=sort_key)
+
+def hedge_delay(name):
+    """Jak dlouho čekat na poskytovatele, než pošleme hedged request dalšímu (jeho p95 latence)."""
+    p95 = get_provider_stats(name).percentile(95)
+    if p95 is None:
+        return HEDGE_DEFAULT_DELAY
+    return min(max(p95, HEDGE_MIN_DELAY), HTTP_TIMEOUT)
+
+async def async_hedged_call(providers, symbol):
+    """Zavolá poskytovatele {jméno: async funkce} v pořadí rank_providers (otevřené jističe přeskočí). Když první
+    neodpoví do hedge_delay, pošle request i dalšímu a vrátí první nalezenou cenu. Funkce vrací (cena, api_name)."""
+    ranked = [name for name in rank_providers(providers) if provider_available(name)]
+    pending = set()
+    try:
+        for i, name in enumerate(ranked):
+            pending.add(asyncio.ensure_future(providers[name](symbol)))
+            delay = hedge_delay(name) if i < len(ranked) - 1 else None
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break  # Pomalá odpověď - hedged request dalšímu poskytovateli
+                for task in done:
+                    if task.exception() is not None:
+                        continue
+                    price, api_name = task.result()
+                    if price is not None:
+                        return price, api_name
+        return None, None
+    finally:
+        # Pomalejší request už nepotřebujeme
+        for task in pending:
+            task.cancel()
+
+# --- Binance snapshot celého trhu ---
+# /api/v3/ticker/price bez parametru vrátí ceny všech párů jedním requestem. Indexujeme je podle base assetu
+# (jen páry kotované v USDT/USDC/BUSD), mapování pár -> base se obnovuje z exchangeInfo s dlouhým TTL.
+
+BINANCE_TICKER_ALL_URL = 'https://api.binance.com/api/v3/ticker/price'
+BINANCE_EXCHANGE_INFO_URL = 'https://api.binance.com/api/v3/exchangeInfo'
+BINANCE_QUOTE_ASSETS = ('USDT', 'USDC', 'BUSD')  # Pořadí = priorita, když má base více párů
+
+class BinanceSnapshot:
+    """Ceny všech Binance párů stažené jedním requestem, indexované podle base assetu."""
+    
+    def __init__(self):
+        self.pairs = {}  # {'BTCUSDT': ('BTC', 'USDT')}
+        self.pairs_loaded_at = None
+        self.prices = {}  # {'BTC': 95000.0}
+        self.fetched_at = 0.0
+        self._lock = threading.Lock()
+    
+    def pairs_expired(self):
+        return self.pairs_loaded_at is None or time.monotonic() - self.pairs_loaded_at >= BINANCE_EXCHANGE_INFO_TTL
+    
+    def is_fresh(self):
+        return bool(self.prices) and time.monotonic() - self.fetched_at < BINANCE_SNAPSHOT_MAX_AGE
+    
+    def _load_pairs(self, data):
+        pairs = {}
+        for info in data.get('symbols', []):
+            if info.get('status') == 'TRADING' and info.get('quoteAsset') in BINANCE_QUOTE_ASSETS:
+                pairs[info['symbol']] = (info['baseAsset'].upper(), info['quoteAsset'])
+        if pairs:
+            with self._lock:
+                self.pairs = pairs
+                self.pairs_loaded_at = time.monotonic()
+            print(f"✅ Binance exchangeInfo: {len(pairs)} párů v {'/'.join(BINANCE_QUOTE_ASSETS)}")
+    
+    def _split_pair(self, pair):
+        if pair in self.pairs:
+            return self.pairs[pair]
+        if self.pairs:
+            return None  # Pár v exchangeInfo není (neobchoduje se nebo jiná kotace)
+        # Bez exchangeInfo odvodíme base z přípony kotace
+        for quote in BINANCE_QUOTE_ASSETS:
+            if pair.endswith(quote) and len(pair) > len(quote):
+                return pair[:-len(quote)], quote
+        return None
+    
+    def _load_prices(self, tickers):
+        best = {}  # base -> (priorita kotace, cena)
+        for ticker in tickers:
+            split = self._split_pair(ticker.get('symbol', ''))
+            if not split:
+                continue
+            base, quote = split
+            try:
+                price = float(ticker['price'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            priority = BINANCE_QUOTE_ASSETS.index(quote)
+            if price > 0 and (base not in best or priority < best[base][0]):
+                best[base] = (priority, price)
+        with self._lock:
+            self.prices = {base: price for base, (priority, price) in best.items()}
+            self.fetched_at = time.monotonic()
+        return self.prices
+    
+    def pair_for(self, symbol):
+        """Binance pár pro symbol podle exchangeInfo (bez něj zkusíme SYMBOLUSDT)."""
+        symbol = symbol.upper()
+        for quote in BINANCE_QUOTE_ASSETS:
+            pair = f'{symbol}{quote}'
+            if pair in self.pairs:
+                return pair
+        return None if self.pairs else f'{symbol}USDT'
+    
+    def get(self, symbol):
+        return self.prices.get(symbol.upper())
+    
+    async def async_refresh(self):
+        """Stáhne snapshot celého trhu (a při vypršení TTL i exchangeInfo). Vrací {base: cena}."""
+        if self.pairs_expired():
+            try:
+                self._load_pairs(await async_get_json('binance', BINANCE_EXCHANGE_INFO_URL, timeout=30))
+            except Exception as e:
+                print(f"⚠️  Chyba Binance exchangeInfo: {e}")
+        try:
+            return self._load_prices(await async_get_json('binance', BINANCE_TICKER_ALL_URL))
+        except Exception as e:
+            print(f"⚠️  Chyba Binance snapshot: {e}")
+            return {}
+
+BINANCE_SNAPSHOT = BinanceSnapshot()
+
+# --- Sdílená cache cen ---
+# Jedna cache pro smyčku, /add i /list: klíč (symbol, asset_type), TTL, LRU limit velikosti
+# a single-flight - souběžné dotazy na stejný chybějící klíč počkají na jeden request.
+
+class PriceCache:
+    """TTL cache cen s LRU vyhazováním a deduplikací souběžných dotazů (single-flight)."""
+    
+    def __init__(self, ttl=PRICE_CACHE_TTL, max_size=PRICE_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # (symbol, asset_type) -> (cena, čas uložení)
+        self._inflight = {}  # (symbol, asset_type) -> asyncio.Future
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+    
+    def _get_locked(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        price, stored_at = entry
+        if time.monotonic() - stored_at >= self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return price
+    
+    def lookup(self, symbol, asset_type=None):
+        """Vrátí (cena, asset_type) z cache, nebo None. Bez typu hledá kryptoměnu i akcii."""
+        symbol = symbol.upper()
+        with self._lock:
+            for candidate in ([asset_type] if asset_type else ['crypto', 'stock']):
+                price = self._get_locked((symbol, candidate))
+                if price is not None:
+                    self.hits += 1
+                    return price, candidate
+            self.misses += 1
+        return None
+    
+    def put(self, symbol, asset_type, price):
+        if price is None or asset_type is None:
+            return
+        with self._lock:
+            key = (symbol.upper(), asset_type)
+            self._entries[key] = (price, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    async def async_get_or_fetch(self, symbol, asset_type, fetch):
+        """Asynchronní read-through: fetch je coroutine funkce vracející (cena, asset_type)."""
+        cached = self.lookup(symbol, asset_type)
+        if cached:
+            return cached
+        key = (symbol.upper(), asset_type)
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await fetch()
+            self.put(symbol, result[1], result[0])
+            future.set_result(result)
+            return result
+        except BaseException:
+            # Čekající dotazy dostanou "cena nenalezena", výjimka jde jen volajícímu, který request vedl
+            future.set_result((None, None))
+            raise
+        finally:
+            self._inflight.pop(key, None)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'evictions': self.evictions,
+            }
+
+PRICE_CACHE = PriceCache()
+
+def _cryptocompare_price_url(symbol):
+    return f'https://min-api.cryptocompare.com/data/price?fsym={symbol}&tsyms=USD'
+
+def _cryptocompare_multi_url(chunk):
+    return f"https://min-api.cryptocompare.com/data/pricemulti?fsyms={','.join(chunk)}&tsyms=USD"
+
+def _binance_price_url(binance_symbol):
+    return f'https://api.binance.com/api/v3/ticker/price?symbol={binance_symbol}'
+
+def _yahoo_endpoints(symbol):
+    """Yahoo Finance endpointy v pořadí, v jakém je zkoušíme (poslední je záložní quote)."""
+    symbol = symbol.upper()
+    return [
+        f'https://query1.finance.yahoo.com/v8/finance/chart/{symbol}',
+        f'https://query2.finance.yahoo.com/v10/finance/quoteSummary/{symbol}?modules=price',
+        f'https://query1.finance.yahoo.com/v7/finance/quote?symbols={symbol}',
+    ]
+
+def _yahoo_quote_url(chunk):
+    return f"https://query1.finance.yahoo.com/v7/finance/quote?symbols={','.join(chunk)}"
+
+def _parse_coingecko_list(data):
+    symbols = set()
+    for coin in data:
+        symbol = coin.get('symbol', '').upper()
+        if symbol and symbol not in STOCK_BLACKLIST:
+            symbols.add(symbol)
+    return symbols
+
+def _parse_cryptocompare_price(data):
+    if 'USD' in data:
+        return float(data['USD'])
+    return None
+
+def _parse_cryptocompare_multi(data, chunk):
+    # Při chybě vrací CryptoCompare {"Response": "Error", ...}, neznámé symboly v odpovědi chybí
+    if data.get('Response') == 'Error':
+        print(f"⚠️  CryptoCompare pricemulti chyba: {data.get('Message')}")
+        return {}
+    prices = {}
+    for symbol in chunk:
+        usd = data.get(symbol, {}).get('USD')
+        if usd is not None:
+            prices[symbol] = float(usd)
+    return prices
+
+def _parse_binance_price(data):
+    if 'price' in data:
+        return float(data['price'])
+    return None
+
+def _parse_yahoo_price(data):
+    """Vytáhne cenu z odpovědi chart, quoteSummary nebo quote endpointu."""
+    # Chart endpoint
+    if 'chart' in data and 'result' in data['chart']:
+        result = data['chart']['result']
+        if result and len(result) > 0:
+            if 'meta' in result[0]:
+                meta = result[0]['meta']
+                # Zkusíme různé možné klíče pro cenu
+                for price_key in ['regularMarketPrice', 'previousClose', 'currentPrice', 'chartPreviousClose']:
+                    if price_key in meta and meta[price_key] is not None:
+                        price_val = meta[price_key]
+                        if isinstance(price_val, (int, float)):
+                            return float(price_val)
+
+    # QuoteSummary endpoint
+    if 'quoteSummary' in data and 'result' in data['quoteSummary']:
+        result = data['quoteSummary']['result']
+        if result and len(result) > 0:
+            if 'price' in result[0]:
+                price_obj = result[0]['price']
+                # Zkusíme různé klíče
+                for price_key in ['regularMarketPrice', 'currentPrice']:
+                    if price_key in price_obj:
+                        price_val = price_obj[price_key]
+                        if isinstance(price_val, dict) and 'raw' in price_val:
+                            return float(price_val['raw'])
+                        elif isinstance(price_val, (int, float)):
+                            return float(price_val)
+
+    # Quote endpoint
+    if 'quoteResponse' in data and 'result' in data['quoteResponse']:
+        result = data['quoteResponse']['result']
+        if result and len(result) > 0:
+            if 'regularMarketPrice' in result[0]:
+                return float(result[0]['regularMarketPrice'])
+    return None
+
+def _parse_yahoo_quotes(data):
+    """Vytáhne {symbol: cena} z hromadné odpovědi quote endpointu."""
+    prices = {}
+    for quote in (data.get('quoteResponse') or {}).get('result') or []:
+        symbol = quote.get('symbol')
+        price_val = quote.get('regularMarketPrice')
+        if symbol and isinstance(price_val, (int, float)):
+            prices[symbol.upper()] = float(price_val)
+    return prices
+
+def _parse_yahoo_name(data, default):
+    if 'chart' in data and 'result' in data['chart']:
+        result = data['chart']['result']
+        if result and len(result) > 0 and 'meta' in result[0]:
+            return result[0]['meta'].get('longName', default)
+    return default
+
+def chunk_symbols(symbols, max_len):
+    """Rozdělí symboly do dávek tak, aby spojený seznam (oddělený čárkou) nepřekročil max_len znaků."""
+    chunks = []
+    current = []
+    current_len = 0
+    for symbol in symbols:
+        added_len = len(symbol) + (1 if current else 0)
+        if current and current_len + added_len > max_len:
+            chunks.append(current)
+            current = []
+            added_len = len(symbol)
+            current_len = 0
+        current.append(symbol)
+        current_len += added_len
+    if current:
+        chunks.append(current)
+    return chunks
+
+# --- Asynchronní API vrstva ---
+# Smyčka i handlery awaitují tyto funkce, HTTP tak neblokuje event loop.
+
+async def async_get_json(provider, url, timeout=None, headers=None):
+    """Stáhne JSON přes pool poskytovatele. Vyhodí výjimku při chybě HTTP nebo sítě."""
+    response = await get_provider_session(provider).async_get(url, timeout=timeout, headers=headers)
+    response.raise_for_status()
+    return response.json()
+
+async def async_load_crypto_list_from_coingecko():
+    """Asynchronní varianta load_crypto_list_from_coingecko."""
+    global KNOWN_CRYPTO, CRYPTO_LIST_LOADED
+    
+    if CRYPTO_LIST_LOADED:
+        return KNOWN_CRYPTO
+    
+    crypto_symbols = set()
+    try:
+        print("📡 Načítám seznam kryptoměn z CoinGecko...")
+        data = await async_get_json('coingecko', 'https://api.coingecko.com/api/v3/coins/list')
+        crypto_symbols = _parse_coingecko_list(data)
+        print(f"✅ Načteno {len(crypto_symbols)} kryptoměn z CoinGecko")
+    except Exception as e:
+        print(f"⚠️  Chyba při načítání z CoinGecko: {e}")
+    
+    KNOWN_CRYPTO = crypto_symbols
+    CRYPTO_LIST_LOADED = True
+    print(f"✅ Celkem {len(KNOWN_CRYPTO)} kryptoměn v seznamu")
+    return KNOWN_CRYPTO
+
+async def async_get_price_from_cryptocompare(symbol):
+    """Získá cenu z CryptoCompare API. Vrací (cena, název API) nebo (None, None)."""
     try:
-        with open(file_name, 'w') as f:
-            json.dump(data, f, indent=2)
+        price = _parse_cryptocompare_price(await async_get_json('cryptocompare', _cryptocompare_price_url(symbol)))
+        if price is not None:
+            return price, 'CryptoCompare'
     except Exception:
         pass
+    return None, None
 
-# Helpery pro přístup k datům konkrétního uživatele
-def get_user_config(chat_id):
-    full_config = load_data('crypto_config', CONFIG_FILE)
-    # Zajistíme, že vracíme dict, i když je prázdný
-    if str(chat_id) not in full_config:
-        full_config[str(chat_id)] = {}
-    
-    # Migrace: doplníme asset_type pro tickery, které ho nemají
-    user_config = full_config[str(chat_id)]
-    config_changed = False
-    for symbol, settings in user_config.items():
-        if 'asset_type' not in settings:
-            # Pokud ticker je v seznamu kryptoměn z CoinGecko, nastavíme crypto
-            if is_crypto_ticker(symbol):
-                settings['asset_type'] = 'crypto'
-                config_changed = True
-            else:
-                # Pro ostatní tickery nastavíme stock (pravděpodobně akcie)
-                settings['asset_type'] = 'stock'
-                config_changed = True
+async def async_get_prices_from_cryptocompare_bulk(symbols):
+    """Získá ceny více kryptoměn najednou přes CryptoCompare pricemulti (dávky souběžně). Vrací {symbol: cena}."""
+    symbols = sorted({s.upper() for s in symbols})
     
-    # Pokud jsme něco změnili, uložíme to
-    if config_changed:
-        save_data('crypto_config', CONFIG_FILE, full_config)
+    async def fetch_chunk(chunk):
+        try:
+            return _parse_cryptocompare_multi(await async_get_json('cryptocompare', _cryptocompare_multi_url(chunk)), chunk)
+        except Exception as e:
+            print(f"⚠️  Chyba CryptoCompare pricemulti ({len(chunk)} symbolů): {e}")
+            return {}
     
-    return full_config[str(chat_id)], full_config
-
-def save_user_config(chat_id, user_config, full_config):
-    full_config[str(chat_id)] = user_config
-    save_data('crypto_config', CONFIG_FILE, full_config)
-
-def get_user_state(chat_id):
-    full_state = load_data('crypto_state', STATE_FILE)
-    if str(chat_id) not in full_state:
-        full_state[str(chat_id)] = {}
-    return full_state[str(chat_id)], full_state
-
-def save_user_state(chat_id, user_state, full_state):
-    full_state[str(chat_id)] = user_state
-    save_data('crypto_state', STATE_FILE, full_state)
-
-# --- API Funkce ---
-def get_price_from_cryptocompare(symbol):
-    """Získá cenu z CryptoCompare API."""
-    url = f'https://min-api.cryptocompare.com/data/price?fsym={symbol}&tsyms=USD'
-    try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        if 'USD' in data:
-            return float(data['USD']), 'CryptoCompare'
-    except:
-        pass
-    return None, None
+    prices = {}
+    for chunk_prices in await asyncio.gather(*(fetch_chunk(c) for c in chunk_symbols(symbols, CRYPTOCOMPARE_FSYMS_MAX_LEN))):
+        prices.update(chunk_prices)
+    return prices
 
-def get_price_from_binance(symbol):
-    """Získá cenu z Binance API."""
-    symbol_map = {
-        'BTC': 'BTCUSDT', 'ETH': 'ETHUSDT', 'AAVE': 'AAVEUSDT',
-        'ZEC': 'ZECUSDT', 'ICP': 'ICPUSDT', 'COW': 'COWUSDT',
-        'GNO': 'GNOUSDT', 'LTC': 'LTCUSDT',
-    }
-    binance_symbol = symbol_map.get(symbol.upper())
+async def async_get_price_from_binance(symbol):
+    """Získá cenu z Binance API (z čerstvého snapshotu celého trhu, jinak requestem na jeden pár)."""
+    if BINANCE_SNAPSHOT.is_fresh():
+        price = BINANCE_SNAPSHOT.get(symbol)
+        return (price, 'Binance') if price is not None else (None, None)
+    binance_symbol = BINANCE_SNAPSHOT.pair_for(symbol)
     if not binance_symbol:
         return None, None
-    url = f'https://api.binance.com/api/v3/ticker/price?symbol={binance_symbol}'
     try:
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        if 'price' in data:
-            return float(data['price']), 'Binance'
-    except:
+        price = _parse_binance_price(await async_get_json('binance', _binance_price_url(binance_symbol)))
+        if price is not None:
+            return price, 'Binance'
+    except Exception:
         pass
     return None, None
 
-def get_crypto_price(symbol):
-    """Získá aktuální cenu kryptoměny z náhodně vybraného API."""
-    api_functions = [get_price_from_cryptocompare, get_price_from_binance]
-    random.shuffle(api_functions)
-    
-    for api_func in api_functions:
+async def async_get_crypto_price(symbol):
+    """Získá aktuální cenu kryptoměny od nejrychlejšího zdravého API (s hedged requestem na druhé)."""
+    providers = {'cryptocompare': async_get_price_from_cryptocompare, 'binance': async_get_price_from_binance}
+    price, api_name = await async_hedged_call(providers, symbol)
+    return price
+
+async def async_get_stock_price(symbol, chart_only=False):
+    """Získá aktuální cenu akcie z Yahoo Finance API. S chart_only zkusí jen chart endpoint (po hromadném quote)."""
+    if not provider_available('yahoo'):
+        return None, None
+    endpoints = _yahoo_endpoints(symbol)
+    for url in (endpoints[:1] if chart_only else endpoints):
         try:
-            price, api_name = api_func(symbol)
+            price = _parse_yahoo_price(await async_get_json('yahoo', url))
             if price is not None:
-                return price
-        except:
+                return price, 'Yahoo Finance'
+        except CircuitOpenError:
+            break
+        except Exception:
             continue
-    return None
+    return None, None
 
-def get_stock_price(symbol):
-    """Získá aktuální cenu akcie z Yahoo Finance API."""
-    # Yahoo Finance API - zkusíme více endpointů
-    endpoints = [
-        f'https://query1.finance.yahoo.com/v8/finance/chart/{symbol.upper()}',
-        f'https://query2.finance.yahoo.com/v10/finance/quoteSummary/{symbol.upper()}?modules=price',
-    ]
-    
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Accept': 'application/json',
-        'Accept-Language': 'en-US,en;q=0.9',
-    }
+async def async_get_stock_prices_bulk(symbols):
+    """Získá ceny více akcií najednou přes Yahoo quote endpoint (dávky souběžně). Vrací {symbol: cena}."""
+    symbols = sorted({s.upper() for s in symbols})
     
-    for url in endpoints:
+    async def fetch_chunk(chunk):
         try:
-            print(f"📡 Zkouším endpoint: {url}")
-            response = requests.get(url, timeout=10, headers=headers, allow_redirects=True)
-            print(f"📊 Status code: {response.status_code}")
-            if response.status_code == 200:
-                try:
-                    data = response.json()
-                except:
-                    continue
-    
-                # Zkusíme první endpoint (chart)
-                if 'chart' in data and 'result' in data['chart']:
-                    result = data['chart']['result']
-                    if result and len(result) > 0:
-                        if 'meta' in result[0]:
-                            meta = result[0]['meta']
-                            # Zkusíme různé možné klíče pro cenu
-                            for price_key in ['regularMarketPrice', 'previousClose', 'currentPrice', 'chartPreviousClose']:
-                                if price_key in meta and meta[price_key] is not None:
-                                    price_val = meta[price_key]
-                                    if isinstance(price_val, (int, float)):
-                                        return float(price_val), 'Yahoo Finance'
-                
-                # Zkusíme druhý endpoint (quoteSummary)
-                if 'quoteSummary' in data and 'result' in data['quoteSummary']:
-                    result = data['quoteSummary']['result']
-                    if result and len(result) > 0:
-                        if 'price' in result[0]:
-                            price_obj = result[0]['price']
-                            # Zkusíme různé klíče
-                            for price_key in ['regularMarketPrice', 'currentPrice']:
-                                if price_key in price_obj:
-                                    price_val = price_obj[price_key]
-                                    if isinstance(price_val, dict) and 'raw' in price_val:
-                                        return float(price_val['raw']), 'Yahoo Finance'
-                                    elif isinstance(price_val, (int, float)):
-                                        return float(price_val), 'Yahoo Finance'
+            return _parse_yahoo_quotes(await async_get_json('yahoo', _yahoo_quote_url(chunk)))
+        except CircuitOpenError:
+            return {}
         except Exception as e:
-            continue
-    
-    # Fallback: Zkusíme jednodušší endpoint
-    try:
-        url = f'https://query1.finance.yahoo.com/v7/finance/quote?symbols={symbol.upper()}'
-        response = requests.get(url, timeout=10, headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            if 'quoteResponse' in data and 'result' in data['quoteResponse']:
-                result = data['quoteResponse']['result']
-                if result and len(result) > 0:
-                    if 'regularMarketPrice' in result[0]:
-                        return float(result[0]['regularMarketPrice']), 'Yahoo Finance'
-    except:
-        pass
+            print(f"⚠️  Chyba Yahoo quote ({len(chunk)} symbolů): {e}")
+            return {}
     
-    return None, None
+    prices = {}
+    for chunk_prices in await asyncio.gather(*(fetch_chunk(c) for c in chunk_symbols(symbols, YAHOO_QUOTE_SYMBOLS_MAX_LEN))):
+        prices.update(chunk_prices)
+    return prices
+
+async def async_get_price(symbol, asset_type=None):
+    """Získá cenu kryptoměny nebo akcie přes sdílenou PRICE_CACHE. Vrací (cena, asset_type)."""
+    return await PRICE_CACHE.async_get_or_fetch(symbol, asset_type, lambda: _async_fetch_price(symbol, asset_type))
 
-def get_price(symbol, asset_type=None):
-    """Získá cenu kryptoměny nebo akcie. Pokud je zadán asset_type, použije ho. Jinak detekuje automaticky."""
+async def _async_fetch_price(symbol, asset_type=None):
+    """Stáhne cenu kryptoměny nebo akcie. Pokud je zadán asset_type, použije ho, jinak zkusí nejdřív kryptoměnu, pak akcii."""
     symbol_upper = symbol.upper()
+    if not CRYPTO_LIST_LOADED:
+        await async_load_crypto_list_from_coingecko()
     
-    # Pokud je ticker v seznamu kryptoměn z CoinGecko, zkusíme jen kryptoměnu
-    if is_crypto_ticker(symbol_upper):
-        print(f"🔍 [{symbol_upper}] Je kryptoměna (CoinGecko), zkouším jen crypto API")
-        price = get_crypto_price(symbol_upper)
-        if price is not None:
-            print(f"✅ Nalezena kryptoměna: {symbol_upper} = ${price}")
-            return price, 'crypto'
-        print(f"❌ Kryptoměna {symbol_upper} nebyla nalezena v crypto API")
-        return None, None
+    if is_crypto_ticker(symbol_upper) or asset_type == 'crypto':
+        price = await async_get_crypto_price(symbol_upper)
+        return (price, 'crypto') if price is not None else (None, None)
     
-    # Pokud je zadán typ, použijeme ho
-    if asset_type == 'crypto':
-        print(f"🔍 [{symbol_upper}] Typ je crypto (z konfigurace), zkouším crypto API")
-        price = get_crypto_price(symbol_upper)
-        if price is not None:
-            return price, 'crypto'
-        return None, None
-    elif asset_type == 'stock':
-        print(f"🔍 [{symbol_upper}] Typ je stock (z konfigurace), zkouším stock API")
-        price, api_name = get_stock_price(symbol_upper)
-        if price is not None:
-            return price, 'stock'
-        return None, None
+    if asset_type == 'stock':
+        price, api_name = await async_get_stock_price(symbol_upper)
+        return (price, 'stock') if price is not None else (None, None)
     
-    # Automatická detekce - nejdřív kryptoměna, pak akcie
-    print(f"🔍 [{symbol_upper}] Automatická detekce - zkouším kryptoměnu")
-    price = get_crypto_price(symbol_upper)
+    # Automatická detekce - nejdřív kryptoměna, pak akcie (při otevřených jističích crypto API typ neurčíme)
+    if not crypto_providers_available():
+        return None, None
+    price = await async_get_crypto_price(symbol_upper)
     if price is not None:
-        print(f"✅ Nalezena kryptoměna: {symbol_upper} = ${price}")
         return price, 'crypto'
-    
-    print(f"🔍 [{symbol_upper}] Není kryptoměna, zkouším akcii")
-    price, api_name = get_stock_price(symbol_upper)
+    price, api_name = await async_get_stock_price(symbol_upper)
     if price is not None:
-        print(f"✅ Nalezena akcie: {symbol_upper} = ${price} z {api_name}")
         return price, 'stock'
-    
     print(f"❌ {symbol_upper} nebyl nalezen ani jako kryptoměna, ani jako akcie")
     return None, None
 
-def validate_ticker(symbol):
+async def async_validate_ticker(symbol):
     """Ověří ticker a vrátí (is_valid, name, price, asset_type)."""
     print(f"🔍 Validuji ticker: {symbol}")
-    price, asset_type = get_price(symbol.upper())
-    print(f"📊 Výsledek get_price: price={price}, asset_type={asset_type}")
-    if price is not None:
-        # Pro kryptoměny použijeme symbol jako název, pro akcie zkusíme získat název
-        name = symbol.upper()
-        if asset_type == 'stock':
-            # Zkusíme získat název akcie z Yahoo Finance
-            try:
-                url = f'https://query1.finance.yahoo.com/v8/finance/chart/{symbol.upper()}'
-                headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
-                response = requests.get(url, timeout=5, headers=headers)
-                if response.status_code == 200:
-                    data = response.json()
-                    if 'chart' in data and 'result' in data['chart']:
-                        result = data['chart']['result']
-                        if result and len(result) > 0 and 'meta' in result[0]:
-                            name = result[0]['meta'].get('longName', symbol.upper())
-            except Exception as e:
-                print(f"⚠️  Chyba při získávání názvu akcie: {e}")
-        return True, name, price, asset_type
-    print(f"❌ Ticker {symbol} nebyl nalezen")
-    return False, None, None, None
+    price, asset_type = await async_get_price(symbol.upper())
+    if price is None:
+        print(f"❌ Ticker {symbol} nebyl nalezen")
+        return False, None, None, None
+    name = symbol.upper()
+    if asset_type == 'stock':
+        try:
+            name = _parse_yahoo_name(await async_get_json('yahoo', _yahoo_endpoints(symbol)[0], timeout=5), name)
+        except Exception as e:
+            print(f"⚠️  Chyba při získávání názvu akcie: {e}")
+    return True, name, price, asset_type
+
+async def async_get_prices(symbol_types):
+    """Stáhne ceny pro {symbol: asset_type}. Kryptoměny ze snapshotu Binance a hromadně z CryptoCompare,
+    akcie hromadně z Yahoo, zbytek souběžně (max PRICE_FETCH_CONCURRENCY najednou). Čerstvé ceny bere z PRICE_CACHE."""
+    current_prices = {}
+    for sym, asset_type in symbol_types.items():
+        cached = PRICE_CACHE.lookup(sym, asset_type)
+        if cached:
+            current_prices[sym] = cached[0]
+    symbol_types = {sym: t for sym, t in symbol_types.items() if sym not in current_prices}
+    crypto_symbols = [sym for sym, asset_type in symbol_types.items() if asset_type == 'crypto']
+    stock_symbols = [sym for sym, asset_type in symbol_types.items() if asset_type == 'stock']
+    
+    # Jeden request na celý Binance trh, CryptoCompare jen pro kryptoměny, které na Binance nejsou
+    snapshot = await BINANCE_SNAPSHOT.async_refresh() if crypto_symbols and provider_available('binance') else {}
+    missing_crypto = [sym for sym in crypto_symbols if sym.upper() not in snapshot]
+    crypto_prices, stock_prices = await asyncio.gather(
+        async_get_prices_from_cryptocompare_bulk(missing_crypto) if missing_crypto else asyncio.sleep(0, {}),
+        async_get_stock_prices_bulk(stock_symbols) if stock_symbols else asyncio.sleep(0, {}),
+    )
+    for sym in crypto_symbols:
+        p = snapshot.get(sym.upper(), crypto_prices.get(sym))
+        if p is not None:
+            current_prices[sym] = p
+            PRICE_CACHE.put(sym, 'crypto', p)
+            print(f"✅ [{sym}] ₿ ${p:,.2f}")
+    for sym in stock_symbols:
+        if sym in stock_prices:
+            current_prices[sym] = stock_prices[sym]
+            PRICE_CACHE.put(sym, 'stock', stock_prices[sym])
+            print(f"✅ [{sym}] 📈 ${current_prices[sym]:,.2f}")
+    
+    semaphore = asyncio.Semaphore(PRICE_FETCH_CONCURRENCY)
+    
+    async def fetch_one(sym, asset_type):
+        async with semaphore:
+            if asset_type == 'stock':
+                # Quote dávka akcii nevrátila, zkusíme už jen chart endpoint
+                p, api_name = await async_get_stock_price(sym, chart_only=True)
+                detected_type = 'stock'
+                PRICE_CACHE.put(sym, 'stock', p)
+            else:
+                p, detected_type = await async_get_price(sym, asset_type=asset_type)
+            if p:
+                current_prices[sym] = p
+                asset_emoji = "₿" if detected_type == 'crypto' else "📈"
+                print(f"✅ [{sym}] {asset_emoji} ${p:,.2f}")
+            else:
+                print(f"❌ [{sym}] Nepodařilo se získat cenu")
+    
+    # Po jednom jen symboly bez typu a ty, které dávky nevrátily
+    await asyncio.gather(*(fetch_one(sym, t) for sym, t in symbol_types.items() if sym not in current_prices))
+    return current_prices
 
 # --- Telegram Handlers ---
 
@@ -474,6 +2383,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "   /add BTC, /add AAPL\n"
         "   Bot se zeptá na prahovou hodnotu (např. 5 pro 5%)\n\n"
         "<b>/list</b> - Zobrazit všechny sledované\n\n"
+        "<b>/history TICKER</b> - Změna ceny za 1h/24h/7d\n\n"
         "<b>/update [TICKER]</b> - Změnit prahovou hodnotu\n\n"
         "<b>/setall %</b> - Nastavit stejnou hodnotu pro všechny\n"
         "   Příklad: /setall 5\n\n"
@@ -490,7 +2400,7 @@ async def add_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     symbol = context.args[0].upper()
     await update.message.reply_text(f"🔍 Ověřuji {symbol}...")
     
-    is_valid, name, price, asset_type = validate_ticker(symbol)
+    is_valid, name, price, asset_type = await async_validate_ticker(symbol)
     
     if not is_valid:
         await update.message.reply_text(f"❌ {symbol} nebyl nalezen.")
@@ -519,22 +2429,24 @@ async def handle_threshold(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         symbol = context.user_data.get('pending_symbol')
         name = context.user_data.get('pending_name')
-        asset_type = context.user_data.get('pending_asset_type', 'crypto')  # Default crypto pro zpětnou kompatibilitu
         
         if not symbol:
             await update.message.reply_text("❌ Chyba kontextu. Zkuste /add znovu.")
             return ConversationHandler.END
         
         # Načtení a úprava konfigurace uživatele
-        user_config, full_config = get_user_config(chat_id)
+        user_config = get_user_config(chat_id)
+        # Typ z /add, jinak uložený typ odběru (/update), jinak crypto pro zpětnou kompatibilitu
+        asset_type = (context.user_data.get('pending_asset_type')
+                      or user_config.get(symbol, {}).get('asset_type') or 'crypto')
         user_config[symbol] = {'name': name, 'threshold': threshold, 'asset_type': asset_type}
-        save_user_config(chat_id, user_config, full_config)
+        save_user_config(chat_id, user_config, [symbol])
         
         # Inicializace stavu
-        user_state, full_state = get_user_state(chat_id)
+        user_state = get_user_state(chat_id)
         if symbol not in user_state:
             user_state[symbol] = {'last_notification_price': context.user_data.get('pending_price')}
-        save_user_state(chat_id, user_state, full_state)
+            save_user_state(chat_id, user_state, [symbol])
         
         await update.message.reply_text(f"✅ <b>{symbol}</b> uloženo s limitem {threshold*100}%", parse_mode='HTML')
         context.user_data.clear()
@@ -546,21 +2458,26 @@ async def handle_threshold(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def list_cryptos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_config, _ = get_user_config(chat_id)
-    user_state, _ = get_user_state(chat_id)
+    user_config = get_user_config(chat_id)
+    user_state = get_user_state(chat_id)
     
     if not user_config:
         await update.message.reply_text("📭 Nemáte nastavené žádné kryptoměny.")
         return
     
+    # Aktuální ceny přes sdílenou cache (většinou je má v cache už smyčka)
+    live_prices = await async_get_prices({symbol: conf.get('asset_type') for symbol, conf in user_config.items()})
+    
     msg = "📋 <b>Vaše kryptoměny:</b>\n\n"
     for symbol, conf in user_config.items():
         last_price = user_state.get(symbol, {}).get('last_notification_price', 0)
         # Pokud last_price neexistuje, je to chyba nebo první běh, zobrazíme 0 nebo ?
         price_display = f"${last_price:,.2f}" if last_price else "?"
+        live_price = live_prices.get(symbol)
+        live_display = f"${live_price:,.2f}" if live_price else "?"
         threshold = conf.get('threshold', 0.05) * 100
         msg += f"• <b>{symbol}</b> (Limit: {threshold}%)\n"
-        msg += f"  Naposledy: {price_display}\n\n"
+        msg += f"  Aktuálně: {live_display} | Naposledy: {price_display}\n\n"
     
     await update.message.reply_text(msg, parse_mode='HTML')
 
@@ -572,11 +2489,11 @@ async def remove_crypto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     symbol = context.args[0].upper()
     chat_id = update.effective_chat.id
     
-    user_config, full_config = get_user_config(chat_id)
+    user_config = get_user_config(chat_id)
     
     if symbol in user_config:
         del user_config[symbol]
-        save_user_config(chat_id, user_config, full_config)
+        save_user_config(chat_id, user_config, [symbol])
         await update.message.reply_text(f"🗑️ {symbol} odstraněno.")
     else:
         await update.message.reply_text(f"❌ {symbol} nesledujete.")
@@ -588,17 +2505,17 @@ async def setall(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     try:
         val = float(context.args[0]) / 100
-        user_config, full_config = get_user_config(chat_id)
+        user_config = get_user_config(chat_id)
         for s in user_config:
             user_config[s]['threshold'] = val
-        save_user_config(chat_id, user_config, full_config)
+        save_user_config(chat_id, user_config, list(user_config))
         await update.message.reply_text(f"✅ Vše nastaveno na {val*100}%")
     except:
         await update.message.reply_text("❌ Chyba formátu.")
 
 async def update_threshold_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    user_config, _ = get_user_config(chat_id)
+    user_config = get_user_config(chat_id)
     
     if not user_config:
         await update.message.reply_text("Nemáte co upravovat.")
@@ -622,9 +2539,12 @@ async def update_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     symbol = query.data.split('_')[1]
+    existing = get_user_config(update.effective_chat.id).get(symbol, {})
     
     context.user_data['pending_symbol'] = symbol
-    context.user_data['pending_name'] = symbol
+    context.user_data['pending_name'] = existing.get('name') or symbol
+    if existing.get('asset_type'):
+        context.user_data['pending_asset_type'] = existing['asset_type']
     
     await query.edit_message_text(f"Zadejte nové % pro {symbol}:")
     return WAITING_UPDATE_THRESHOLD
@@ -638,35 +2558,599 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Zrušeno.")
     return ConversationHandler.END
 
+def is_admin(update: Update):
+    """Admin je uživatel z TELEGRAM_CHAT_ID."""
+    return bool(ADMIN_CHAT_ID) and str(update.effective_chat.id) == str(ADMIN_CHAT_ID)
+
+class EventLoopLagMonitor:
+    """Měří zpoždění event loopu: o kolik později, než měl, se probudí pravidelný krátký sleep."""
+    
+    def __init__(self, interval=LOOP_LAG_INTERVAL, window=240):
+        self.interval = interval
+        self.samples = deque(maxlen=window)
+        self.max_lag = 0.0
+    
+    async def run(self, stop_event):
+        loop = asyncio.get_running_loop()
+        while not stop_event.is_set():
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - started - self.interval, 0.0)
+            self.samples.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+    
+    def stats(self):
+        if not self.samples:
+            return {}
+        ordered = sorted(self.samples)
+        return {
+            'last_ms': round(self.samples[-1] * 1000, 1),
+            'avg_ms': round(sum(ordered) / len(ordered) * 1000, 1),
+            'p99_ms': round(ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)] * 1000, 1),
+            'max_ms': round(self.max_lag * 1000, 1),
+        }
+
+LOOP_LAG_MONITOR = EventLoopLagMonitor()
+
+def collect_metrics():
+    """Sesbírá provozní metriky všech subsystémů do jednoho slovníku {sekce: {klíč: hodnota}}."""
+    return {
+        'http': get_connection_stats(),
+        'providers': get_provider_latency_stats(),
+        'circuit_breakers': get_circuit_breaker_stats(),
+        'rate_limits': get_rate_limit_stats(),
+        'price_cache': PRICE_CACHE.stats(),
+        'database': get_db_pool_stats(),
+        'write_behind': WRITE_QUEUE.stats(),
+        'event_loop': LOOP_LAG_MONITOR.stats(),
+        'alert_index': STORE.index.stats(),
+        'symbols': STORE.symbols.stats(),
+        'notifications': NOTIFIER.stats(),
+        'shards': SHARDS.stats() if SHARDS else {},
+        'price_history': PRICE_HISTORY.stats() if PRICE_HISTORY else {},
+    }
+
+def format_metrics(metrics):
+    lines = []
+    for section, values in metrics.items():
+        lines.append(f"<b>{section}</b>")
+        for key, value in values.items():
+            if isinstance(value, dict):
+                value = ', '.join(f"{k}={v}" for k, v in value.items())
+            lines.append(f"• {key}: {value}")
+        lines.append("")
+    return "\n".join(lines).strip() or "Žádné metriky."
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats - provozní metriky (jen pro admina)."""
+    if not is_admin(update):
+        await update.message.reply_text("❌ Tento příkaz je jen pro admina.")
+        return
+    await update.message.reply_text("📊 <b>Metriky</b>\n\n" + format_metrics(collect_metrics()), parse_mode='HTML')
+
+SYMBOLS_LIST_LIMIT = 50  # Kolik nejsledovanějších symbolů vypsat v /symbols
+
+async def symbols_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/symbols - sledované symboly s typem a počtem odběratelů (jen pro admina)."""
+    if not is_admin(update):
+        await update.message.reply_text("❌ Tento příkaz je jen pro admina.")
+        return
+    registry = STORE.symbol_registry()
+    rows = registry.snapshot()
+    if not rows:
+        await update.message.reply_text("📭 Žádné sledované symboly.")
+        return
+    lines = [f"🔭 <b>Sledované symboly</b> ({len(rows)}, verze {registry.version})\n"]
+    for symbol, asset_type, subscribers in rows[:SYMBOLS_LIST_LIMIT]:
+        emoji = "₿" if asset_type == 'crypto' else "📈" if asset_type == 'stock' else "❔"
+        lines.append(f"{emoji} <b>{symbol}</b>: {subscribers} odběratelů")
+    if len(rows) > SYMBOLS_LIST_LIMIT:
+        lines.append(f"… a dalších {len(rows) - SYMBOLS_LIST_LIMIT}")
+    await update.message.reply_text("\n".join(lines), parse_mode='HTML')
+
+# --- Historie cen ---
+# Každý cyklus price_check_loop uloží ceny do price_ticks (jeden multi-row INSERT). Údržba jednou za
+# PRICE_HISTORY_ROLLUP_EVERY agreguje dokončené minuty do price_rollups (1m/1h/1d: open/high/low/close)
+# a maže surové ticky starší než PRICE_HISTORY_RAW_HORIZON. S DB v PostgreSQL, lokálně v SQLite.
+ROLLUP_RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+
+HISTORY_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS price_ticks (
+        symbol TEXT NOT NULL,
+        ts BIGINT NOT NULL,
+        price DOUBLE PRECISION NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS price_ticks_symbol_ts_idx ON price_ticks (symbol, ts)",
+    """CREATE TABLE IF NOT EXISTS price_rollups (
+        symbol TEXT NOT NULL,
+        resolution TEXT NOT NULL,
+        bucket BIGINT NOT NULL,
+        open DOUBLE PRECISION NOT NULL,
+        high DOUBLE PRECISION NOT NULL,
+        low DOUBLE PRECISION NOT NULL,
+        close DOUBLE PRECISION NOT NULL,
+        samples INTEGER NOT NULL,
+        PRIMARY KEY (symbol, resolution, bucket)
+    )""",
+    """CREATE TABLE IF NOT EXISTS price_history_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )""",
+)
+
+class PostgresHistoryBackend:
+    """Historie ve stejné DB jako config (spojení z DB_POOL)."""
+    greatest, least = 'GREATEST', 'LEAST'
+    
+    def transaction(self, fn):
+        return db_transaction(fn)
+    
+    def sql(self, query):
+        return query
+    
+    def insert_many(self, cur, table, columns, rows):
+        execute_values(cur, f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s", rows)
+    
+    def execute_many(self, cur, query, rows):
+        execute_batch(cur, query, rows)
+
+class SqliteHistoryBackend:
+    """Lokální náhrada PostgreSQL (bez DATABASE_URL)."""
+    greatest, least = 'MAX', 'MIN'
+    
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+    
+    def transaction(self, fn):
+        with self.lock, self.conn:
+            cur = self.conn.cursor()
+            try:
+                return fn(cur)
+            finally:
+                cur.close()
+    
+    def sql(self, query):
+        return query.replace('%s', '?')
+    
+    def insert_many(self, cur, table, columns, rows):
+        cur.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", rows)
+    
+    def execute_many(self, cur, query, rows):
+        cur.executemany(self.sql(query), rows)
+
+class PriceHistory:
+    """Časová řada cen: hromadné ukládání, agregace do 1m/1h/1d a dotazy do minulosti."""
+    
+    def __init__(self, backend, raw_horizon=None, rollup_every=None):
+        self.backend = backend
+        self.raw_horizon = PRICE_HISTORY_RAW_HORIZON if raw_horizon is None else raw_horizon
+        self.rollup_every = PRICE_HISTORY_ROLLUP_EVERY if rollup_every is None else rollup_every
+        self.ready = False
+        self.last_rollup = 0.0
+        self.ticks_written = 0
+        self.rollups_written = 0
+        self.ticks_pruned = 0
+    
+    def _ensure_schema(self):
+        if not self.ready:
+            def create(cur):
+                for statement in HISTORY_SCHEMA:
+                    cur.execute(statement)
+            self.backend.transaction(create)
+            self.ready = True
+    
+    def record(self, prices, now=None):
+        """Uloží ceny jednoho cyklu {symbol: cena} jedním multi-row INSERTem, občas spustí údržbu."""
+        self._ensure_schema()
+        now = int(time.time() if now is None else now)
+        rows = [(symbol, now, float(price)) for symbol, price in prices.items() if price]
+        if rows:
+            self.backend.transaction(lambda cur: self.backend.insert_many(cur, 'price_ticks', ('symbol', 'ts', 'price'), rows))
+            self.ticks_written += len(rows)
+        if now - self.last_rollup >= self.rollup_every:
+            self.roll_up(now)
+    
+    def roll_up(self, now=None):
+        """Agreguje surové ticky dokončených minut od poslední agregace do 1m/1h/1d a smaže staré ticky.
+        Agregace navazuje na značku 'rolled_up_to', takže se žádný tick nezapočítá dvakrát."""
+        self._ensure_schema()
+        now = int(time.time() if now is None else now)
+        cutoff = now - now % 60  # Jen dokončené minuty
+        b = self.backend
+        
+        def run(cur):
+            cur.execute(b.sql("SELECT value FROM price_history_meta WHERE key = %s"), ('rolled_up_to',))
+            row = cur.fetchone()
+            start = int(row[0]) if row else 0
+            cur.execute(b.sql("SELECT symbol, ts, price FROM price_ticks WHERE ts >= %s AND ts < %s ORDER BY symbol, ts"),
+                        (start, cutoff))
+            buckets = {}  # {(symbol, rozlišení, začátek): [open, high, low, close, počet]}
+            for symbol, ts, price in cur.fetchall():
+                for resolution, seconds in ROLLUP_RESOLUTIONS.items():
+                    agg = buckets.get((symbol, resolution, ts - ts % seconds))
+                    if agg is None:
+                        buckets[(symbol, resolution, ts - ts % seconds)] = [price, price, price, price, 1]
+                    else:
+                        agg[1] = max(agg[1], price)
+                        agg[2] = min(agg[2], price)
+                        agg[3] = price
+                        agg[4] += 1
+            if buckets:
+                # Rozpracovaný bucket (hodina, den) se slučuje s tím, co už je uložené
+                b.execute_many(cur, f"""
+                    INSERT INTO price_rollups (symbol, resolution, bucket, open, high, low, close, samples)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (symbol, resolution, bucket) DO UPDATE SET
+                        high = {b.greatest}(price_rollups.high, excluded.high),
+                        low = {b.least}(price_rollups.low, excluded.low),
+                        close = excluded.close,
+                        samples = price_rollups.samples + excluded.samples
+                """, [key + tuple(agg) for key, agg in buckets.items()])
+            cur.execute(b.sql("""
+                INSERT INTO price_history_meta (key, value) VALUES (%s, %s)
+                ON CONFLICT (key) DO UPDATE SET value = excluded.value
+            """), ('rolled_up_to', str(cutoff)))
+            # Surové ticky mažeme jen ty, které už jsou v agregacích
+            cur.execute(b.sql("DELETE FROM price_ticks WHERE ts < %s"), (min(cutoff, now - self.raw_horizon),))
+            return len(buckets), cur.rowcount
+        
+        rollups, pruned = b.transaction(run)
+        self.rollups_written += rollups
+        self.ticks_pruned += max(pruned, 0)
+        self.last_rollup = now
+        return rollups
+    
+    def price_at(self, symbol, ts):
+        """Cena symbolu v čase ts: poslední surový tick do ts, starší data z nejjemnější agregace."""
+        self._ensure_schema()
+        b = self.backend
+        
+        def query(cur):
+            cur.execute(b.sql("SELECT price FROM price_ticks WHERE symbol = %s AND ts <= %s ORDER BY ts DESC LIMIT 1"),
+                        (symbol, int(ts)))
+            row = cur.fetchone()
+            if row:
+                return row[0]
+            for resolution in ROLLUP_RESOLUTIONS:
+                cur.execute(b.sql("""
+                    SELECT close FROM price_rollups WHERE symbol = %s AND resolution = %s AND bucket <= %s
+                    ORDER BY bucket DESC LIMIT 1
+                """), (symbol, resolution, int(ts)))
+                row = cur.fetchone()
+                if row:
+                    return row[0]
+            return None
+        
+        return b.transaction(query)
+    
+    def series(self, symbol, since, resolution='1m'):
+        """Agregovaná řada [(začátek bucketu, open, high, low, close)] od since."""
+        self._ensure_schema()
+        b = self.backend
+        
+        def query(cur):
+            cur.execute(b.sql("""
+                SELECT bucket, open, high, low, close FROM price_rollups
+                WHERE symbol = %s AND resolution = %s AND bucket >= %s ORDER BY bucket
+            """), (symbol, resolution, int(since)))
+            return [tuple(row) for row in cur.fetchall()]
+        
+        return b.transaction(query)
+    
+    def stats(self):
+        return {
+            'backend': 'postgres' if isinstance(self.backend, PostgresHistoryBackend) else 'sqlite',
+            'ticks_written': self.ticks_written,
+            'rollups_written': self.rollups_written,
+            'ticks_pruned': self.ticks_pruned,
+        }
+
+def create_price_history():
+    if DB_POOL:
+        return PriceHistory(PostgresHistoryBackend())
+    return PriceHistory(SqliteHistoryBackend(PRICE_HISTORY_SQLITE))
+
+PRICE_HISTORY = None  # Vytvoří se při startu (main), bez něj se historie neukládá
+
+async def record_price_history(prices):
+    """Uloží ceny cyklu do historie ve vlákně úložiště; chyba historie nezastaví kontrolu cen."""
+    if PRICE_HISTORY is None or not prices:
+        return
+    try:
+        await run_storage(PRICE_HISTORY.record, prices)
+    except Exception as e:
+        print(f"⚠️  Chyba ukládání historie cen: {e}")
+
+HISTORY_LOOKBACKS = (('1h', 3600), ('24h', 86400), ('7d', 7 * 86400))  # Změny ceny vypisované v /history
+
+def history_summary(history, symbol, now):
+    """Poslední cena, ceny před HISTORY_LOOKBACKS a rozpětí za 24h (z hodinových agregací).
+    Vrací (cena, {label: cena nebo None}, (low, high) nebo None). Blokuje, volá se přes run_storage."""
+    current = history.price_at(symbol, now)
+    ago = {label: history.price_at(symbol, now - seconds) for label, seconds in HISTORY_LOOKBACKS}
+    day = history.series(symbol, now - 86400, '1h')
+    day_range = (min(row[3] for row in day), max(row[2] for row in day)) if day else None
+    return current, ago, day_range
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/history TICKER - změna ceny za 1h/24h/7d a rozpětí za 24h z uložené historie (bez dotazu na API)."""
+    if not context.args:
+        await update.message.reply_text("❌ Použití: /history BTC")
+        return
+    if PRICE_HISTORY is None:
+        await update.message.reply_text("ℹ️ Historie cen není k dispozici.")
+        return
+    symbol = context.args[0].upper()
+    try:
+        current, ago, day_range = await run_storage(history_summary, PRICE_HISTORY, symbol, time.time())
+    except Exception as e:
+        print(f"⚠️  Chyba čtení historie cen ({symbol}): {e}")
+        await update.message.reply_text("❌ Historii cen se nepodařilo načíst.")
+        return
+    if current is None:
+        await update.message.reply_text(f"📭 Pro <b>{symbol}</b> zatím nemám historii cen.", parse_mode='HTML')
+        return
+    lines = [f"🕰️ <b>{symbol}</b>: ${current:,.2f}"]
+    for label, price in ago.items():
+        change = f"{(current - price) / price * 100:+.2f}% (${price:,.2f})" if price else "?"
+        lines.append(f"• {label}: {change}")
+    if day_range:
+        lines.append(f"• 24h rozpětí: ${day_range[0]:,.2f} - ${day_range[1]:,.2f}")
+    await update.message.reply_text("\n".join(lines), parse_mode='HTML')
+
+# --- Odesílání notifikací ---
+# Alerty jednoho cyklu se seskupí po chatech (jedna zpráva na chat) a odešlou souběžně v limitech Telegramu:
+# globálně ~30 zpráv/s, do jednoho chatu ~1 zprávu/s. Na RetryAfter se čeká (všichni odesílatelé) a zkusí se znovu.
+# Stav (last_notification_price) se mění až po úspěšném doručení.
+
+class NotificationDispatcher:
+    """Souběžné odesílání sloučených alertů s globálním a per-chat token bucketem. S běžícím run() se zprávy
+    řadí do fronty a odesílá je background task, takže vyhodnocení alertů (smyčka, stream, shard) na čekání
+    v bucketech ani na RetryAfter nestojí. Bez běžícího tasku se odesílá hned."""
+    
+    def __init__(self, global_rate=NOTIFY_GLOBAL_RATE, chat_rate=NOTIFY_CHAT_RATE, max_retries=NOTIFY_MAX_RETRIES):
+        self.global_bucket = TokenBucket('telegram', global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_buckets = {}  # {chat_id: TokenBucket}
+        self.max_retries = max_retries
+        self.in_flight = set()  # {(chat_id, symbol)} - alert se právě odesílá, další tick ho nespouští znovu
+        self.paused_until = 0.0  # Do kdy platí RetryAfter od Telegramu (monotonic)
+        self.queue = deque()  # (app, chat_id, [(symbol, text)], on_delivered) čekající na background task
+        self.senders = set()  # Tasky, které právě odesílají
+        self.running = False
+        self._wakeup = None
+        self.sent = 0
+        self.merged_alerts = 0
+        self.failed = 0
+        self.retries = 0
+    
+    def _chat_bucket(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            if len(self.chat_buckets) >= NOTIFY_CHAT_BUCKETS_MAX:
+                # Plný bucket = chat, kterému jsme dlouho nic neposlali, stav není potřeba držet
+                self.chat_buckets = {c: b for c, b in self.chat_buckets.items() if b.snapshot()['tokens'] < b.burst}
+            self.chat_buckets[chat_id] = TokenBucket(f'chat:{chat_id}', self.chat_rate, 1)
+        return self.chat_buckets[chat_id]
+    
+    @staticmethod
+    def merge(texts):
+        if len(texts) == 1:
+            return texts[0]
+        return f"🔔 <b>{len(texts)} upozornění</b>\n" + "".join(texts)
+    
+    async def _send(self, app, chat_id, text):
+        await self._chat_bucket(chat_id).async_acquire()
+        for attempt in range(self.max_retries + 1):
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.global_bucket.async_acquire()
+            try:
+                await app.bot.send_message(chat_id=int(chat_id), text=text, parse_mode='HTML')
+                self.sent += 1
+                return True
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else float(e.retry_after)
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                self.retries += 1
+                print(f"⏳ Telegram flood control, čekám {retry_after:.1f}s (pokus {attempt + 1}/{self.max_retries + 1})")
+            except Exception as e:
+                print(f"❌ Chyba odeslání uživateli {chat_id}: {e}")
+                break
+        self.failed += 1
+        return False
+    
+    async def _deliver(self, app, chat_id, items, on_delivered=None):
+        """Odešle sloučenou zprávu jednoho chatu; po doručení zavolá on_delivered(chat_id)."""
+        try:
+            ok = await self._send(app, chat_id, self.merge([text for _, text in items]))
+        finally:
+            self.in_flight -= {(chat_id, symbol) for symbol, _ in items}
+        self.merged_alerts += len(items)
+        if ok and on_delivered is not None:
+            try:
+                on_delivered(chat_id)
+            except Exception as e:
+                print(f"❌ Chyba po doručení alertu {chat_id}: {e}")
+        return ok
+    
+    async def deliver(self, app, alerts, on_delivered=None):
+        """Odešle {chat_id: [(symbol, text)]} hned - jednu sloučenou zprávu na chat - a počká na výsledek.
+        Vrací množinu doručených chat_id."""
+        self.in_flight |= {(chat_id, symbol) for chat_id, items in alerts.items() for symbol, _ in items}
+        chat_ids = list(alerts)
+        results = await asyncio.gather(*(self._deliver(app, chat_id, alerts[chat_id], on_delivered) for chat_id in chat_ids))
+        return {chat_id for chat_id, ok in zip(chat_ids, results) if ok}
+    
+    async def submit(self, app, alerts, on_delivered):
+        """Zařadí alerty do fronty background tasku a hned se vrátí; do doručení jsou in_flight.
+        Bez běžícího run() je odešle přes deliver."""
+        if not self.running:
+            await self.deliver(app, alerts, on_delivered)
+            return
+        for chat_id, items in alerts.items():
+            self.in_flight |= {(chat_id, symbol) for symbol, _ in items}
+            self.queue.append((app, chat_id, items, on_delivered))
+        self._wakeup.set()
+    
+    def _start_senders(self):
+        while self.queue:
+            task = asyncio.create_task(self._deliver(*self.queue.popleft()))
+            self.senders.add(task)
+            task.add_done_callback(self.senders.discard)
+    
+    async def run(self, stop_event):
+        """Background task: každou zprávu z fronty odesílá ve vlastním tasku (tempo určují buckety)."""
+        self._wakeup = asyncio.Event()
+        self.running = True
+        try:
+            while not stop_event.is_set():
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    continue
+                self._wakeup.clear()
+                self._start_senders()
+        finally:
+            await self.close()
+    
+    async def close(self, timeout=NOTIFY_CLOSE_TIMEOUT):
+        """Další alerty odesílá hned; zprávy z fronty rozešle a počká na ně (ukončení aplikace nebo shardu)."""
+        self.running = False
+        self._start_senders()
+        if self.senders:
+            _, pending = await asyncio.wait(set(self.senders), timeout=timeout)
+            if pending:
+                print(f"⚠️  {len(pending)} notifikací se do ukončení nestihlo odeslat")
+    
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'alerts': self.merged_alerts,
+            'failed': self.failed,
+            'retries': self.retries,
+            'queued': len(self.queue),
+            'sending': len(self.senders),
+            'in_flight': len(self.in_flight),
+            'global_bucket': self.global_bucket.snapshot(),
+        }
+
+NOTIFIER = NotificationDispatcher()
+
 # --- Background Loop ---
 
+def alert_candidates(current_prices, full_config, index=None, watched=None, verbose=True):
+    """Odběry (chat_id, symbol) k vyhodnocení. S indexem (ThresholdIndex nebo NumpyAlertEngine) jen ty,
+    jejichž práh nová cena překročila."""
+    if index is None:
+        pairs = []
+        for chat_id_str, user_conf in list(full_config.items()):
+            for symbol in list(user_conf):
+                if symbol in current_prices:
+                    pairs.append((chat_id_str, symbol))
+                elif verbose and (watched is None or symbol in watched):
+                    print(f"⚠️  [{chat_id_str}] {symbol}: Cena nedostupná")
+        return pairs
+    
+    if verbose:
+        for symbol in watched or ():
+            if symbol not in current_prices:
+                print(f"⚠️  {symbol}: Cena nedostupná ({index.subscriptions(symbol)} odběrů)")
+    pairs = index.triggered(current_prices)
+    if verbose:
+        print(f"🔎 Překročený práh: {len(pairs)} z {index.subscriptions()} odběrů")
+    return pairs
+
+async def evaluate_alerts(app, current_prices, full_config, full_state, watched=None, verbose=True, index=None,
+                          on_delivered=None):
+    """Porovná ceny s poslední notifikací každého uživatele a pošle alerty (přes NOTIFIER, jedna zpráva na chat).
+    Vrací množinu (chat_id, symbol), jejichž stav ve full_state se změnil hned (první cena). Cena poslední
+    notifikace se posune až po doručení zprávy a změněné klíče dostane on_delivered(keys) - s běžícím
+    NOTIFIER.run() později z jeho tasku. watched = symboly, u kterých hlásit chybějící cenu.
+    S index (ThresholdIndex/NumpyAlertEngine nad full_config/full_state) se projdou jen odběry s překročeným prahem."""
+    changed = set()
+    alerts = {}  # {chat_id: [(symbol, cena, text, popis)]}
+    # Kandidáti se určí předem: během odesílání zpráv může handler config změnit
+    for chat_id_str, symbol in alert_candidates(current_prices, full_config, index, watched, verbose):
+        settings = full_config.get(chat_id_str, {}).get(symbol)
+        if settings is None:
+            continue
+        if chat_id_str not in full_state: full_state[chat_id_str] = {}
+        user_state = full_state[chat_id_str]
+        
+        if (chat_id_str, symbol) in NOTIFIER.in_flight:
+            continue  # Alert se právě odesílá (předchozí tick), stav se změní až po doručení
+        
+        curr_price = current_prices[symbol]
+        last_price = user_state.get(symbol, {}).get('last_notification_price')
+        threshold = settings.get('threshold', 0.05)
+        
+        if last_price is None:
+            # První běh
+            user_state[symbol] = {'last_notification_price': curr_price}
+            changed.add((chat_id_str, symbol))
+            print(f"💾 [{chat_id_str}] {symbol}: První cena uložena ${curr_price:,.2f}")
+            continue
+            
+        change_pct = abs((curr_price - last_price) / last_price)
+        
+        if verbose:
+            print(f"📊 [{chat_id_str}] {symbol}: ${curr_price:,.2f} | Změna: {change_pct*100:.2f}% (limit: {threshold*100}%)")
+        
+        if change_pct >= threshold:
+            # Alert
+            direction = "📈 VZESTUP" if curr_price > last_price else "📉 POKLES"
+            emoji = "🟢" if curr_price > last_price else "🔴"
+            
+            msg = f"""
+{emoji} <b>{settings.get('name', symbol)} ({symbol})</b> {direction} <b>{change_pct*100:.1f}%</b>
+💰 <b>${curr_price:,.2f}</b> (předtím: ${last_price:,.2f})
+"""
+            alerts.setdefault(chat_id_str, []).append((symbol, curr_price, msg, f"{symbol} {direction} {change_pct*100:.1f}%"))
+    
+    def commit(chat_id_str):
+        """Po doručení posune cenu poslední notifikace (jen u odběrů, které mezitím nezmizely)."""
+        delivered = set()
+        for symbol, curr_price, _, description in alerts[chat_id_str]:
+            if symbol not in full_config.get(chat_id_str, {}):
+                continue
+            full_state.setdefault(chat_id_str, {}).setdefault(symbol, {})['last_notification_price'] = curr_price
+            delivered.add((chat_id_str, symbol))
+            print(f"✅ Alert odeslán pro {chat_id_str}: {description}")
+        if delivered and on_delivered is not None:
+            on_delivered(delivered)
+    
+    if alerts:
+        await NOTIFIER.submit(app, {chat_id: [(symbol, text) for symbol, _, text, _ in sorted(items)]
+                                    for chat_id, items in alerts.items()}, commit)
+    return changed
+
+def save_state_changes(changed):
+    """Zapíše skrz jen změněné (chat_id, symbol), aby nepřepsal souběžné změny jiných částí."""
+    STORE.persist_state(changed)
+
 async def price_check_loop(app, stop_event):
     print("🚀 Startuji kontrolu cen...")
     
     while not stop_event.is_set():
         try:
-            # Načteme kompletní data všech uživatelů
-            full_config = load_data('crypto_config', CONFIG_FILE)
-            full_state = load_data('crypto_state', STATE_FILE)
-            state_changed = False
+            # Data všech uživatelů jsou v paměti (STORE), DB se při kontrole nečte
+            full_config = STORE.config
+            full_state = STORE.state
             
             if not full_config:
                 print("⚠️  Žádní uživatelé ke sledování")
                 await asyncio.sleep(CHECK_INTERVAL)
                 continue
             
-            # Získáme seznam všech unikátních symbolů s jejich typy (kryptoměny + akcie) k dotazu (optimalizace API volání)
-            symbol_types = {}  # {symbol: asset_type}
-            for user_conf in full_config.values():
-                for sym, settings in user_conf.items():
-                    # Pokud symbol ještě není v mapě, přidáme ho s typem z konfigurace
-                    if sym not in symbol_types:
-                        # Zkusíme získat typ z konfigurace, pokud není, použijeme CoinGecko seznam nebo None
-                        asset_type = settings.get('asset_type')
-                        if not asset_type:
-                            # Pokud není v konfiguraci, zkontrolujeme CoinGecko seznam
-                            asset_type = 'crypto' if is_crypto_ticker(sym) else None
-                        symbol_types[sym] = asset_type
+            # Unikátní symboly s typy udržuje registr při změnách odběrů (kopie: během stahování se může změnit)
+            symbol_types = dict(STORE.symbol_registry().symbol_types)
+            
+            # Ve streamovacím režimu řeší symboly s čerstvými ticky price_stream_loop
+            if PRICE_STREAM_MODE:
+                covered = stream_covered_symbols()
+                symbol_types = {sym: t for sym, t in symbol_types.items() if sym not in covered}
             
             if not symbol_types:
                 print("⚠️  Žádné symboly ke sledování")
@@ -675,62 +3159,20 @@ async def price_check_loop(app, stop_event):
             
             print(f"📊 Kontroluji {len(symbol_types)} symbolů (kryptoměny + akcie) pro {len(full_config)} uživatelů")
             
-            current_prices = {}
-            for sym, asset_type in symbol_types.items():
-                p, detected_type = get_price(sym, asset_type=asset_type)
-                if p: 
-                    current_prices[sym] = p
-                    asset_emoji = "₿" if detected_type == 'crypto' else "📈"
-                    print(f"✅ [{sym}] {asset_emoji} ${p:,.2f}")
-                else:
-                    print(f"❌ [{sym}] Nepodařilo se získat cenu")
-                await asyncio.sleep(0.5) # Throttle
+            current_prices = await async_get_prices(symbol_types)
+            await record_price_history(current_prices)
             
-            # Kontrola pro každého uživatele
-            for chat_id_str, user_conf in full_config.items():
-                if chat_id_str not in full_state: full_state[chat_id_str] = {}
-                user_state = full_state[chat_id_str]
+            if SHARDS is not None:
+                # Alerty vyhodnotí shardy, změny stavu vrátí přes SHARDS.run
+                SHARDS.publish_prices(current_prices)
+            else:
+                # Kontrola pro každého uživatele
+                changed = await evaluate_alerts(app, current_prices, full_config, full_state, watched=symbol_types,
+                                                index=STORE.threshold_index(), on_delivered=save_state_changes)
                 
-                for symbol, settings in user_conf.items():
-                    if symbol not in current_prices: 
-                        print(f"⚠️  [{chat_id_str}] {symbol}: Cena nedostupná")
-                        continue
-                    
-                    curr_price = current_prices[symbol]
-                    last_price = user_state.get(symbol, {}).get('last_notification_price')
-                    threshold = settings.get('threshold', 0.05)
-                    
-                    if last_price is None:
-                        # První běh
-                        user_state[symbol] = {'last_notification_price': curr_price}
-                        state_changed = True
-                        print(f"💾 [{chat_id_str}] {symbol}: První cena uložena ${curr_price:,.2f}")
-                        continue
-                        
-                    change_pct = abs((curr_price - last_price) / last_price)
-                    
-                    print(f"📊 [{chat_id_str}] {symbol}: ${curr_price:,.2f} | Změna: {change_pct*100:.2f}% (limit: {threshold*100}%)")
-                    
-                    if change_pct >= threshold:
-                        # Alert
-                        direction = "📈 VZESTUP" if curr_price > last_price else "📉 POKLES"
-                        emoji = "🟢" if curr_price > last_price else "🔴"
-                        
-                        msg = f"""
-{emoji} <b>{settings.get('name', symbol)} ({symbol})</b> {direction} <b>{change_pct*100:.1f}%</b>
-💰 <b>${curr_price:,.2f}</b> (předtím: ${last_price:,.2f})
-"""
-                        try:
-                            await app.bot.send_message(chat_id=int(chat_id_str), text=msg, parse_mode='HTML')
-                            user_state[symbol]['last_notification_price'] = curr_price
-                            state_changed = True
-                            print(f"✅ Alert odeslán pro {chat_id_str}: {symbol} {direction} {change_pct*100:.1f}%")
-                        except Exception as e:
-                            print(f"❌ Chyba odeslání uživateli {chat_id_str}: {e}")
-
-            if state_changed:
-                save_data('crypto_state', STATE_FILE, full_state)
-                print("💾 Stav uložen")
+                if changed:
+                    save_state_changes(changed)
+                    print("💾 Stav uložen")
                 
             # Čekání
             print()  # Prázdný řádek
@@ -744,17 +3186,450 @@ async def price_check_loop(app, stop_event):
             traceback.print_exc()
             await asyncio.sleep(30)
 
+# --- Streamovací režim (WebSocket) ---
+# Místo dotazování jednou za minutu odebíráme miniTicker stream Binance pro všechny sledované kryptoměny
+# a alerty vyhodnocujeme na každý tick. Při změně sledovaných symbolů (verze SymbolRegistry) se odběr aktualizuje.
+# Pro testy bez sítě viz fake_price_stream.py (PRICE_STREAM_URL=ws://127.0.0.1:8765).
+
+STREAM_PRICES = {}  # {symbol: (cena, čas posledního ticku)}
+def stream_covered_symbols():
+    """Symboly, pro které má stream čerstvé ceny (polling je může přeskočit)."""
+    now = time.monotonic()
+    return {sym for sym, (price, ts) in STREAM_PRICES.items() if now - ts < STREAM_STALE_AFTER}
+
+def stream_pairs(symbol_types):
+    """{binance pár: symbol} pro všechny sledované kryptoměny ({symbol: asset_type} z registru)."""
+    pairs = {}
+    for sym, asset_type in symbol_types.items():
+        if asset_type == 'crypto':
+            pair = BINANCE_SNAPSHOT.pair_for(sym)
+            if pair:
+                pairs[pair] = sym
+    return pairs
+
+def parse_stream_tick(message):
+    """Vrátí (pár, cena) z miniTicker zprávy (i v obálce kombinovaného streamu), jinak None."""
+    data = message.get('data', message) if isinstance(message, dict) else None
+    if not isinstance(data, dict) or data.get('e') != '24hrMiniTicker':
+        return None
+    try:
+        return data['s'].upper(), float(data['c'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+async def _stream_set_subscription(ws, method, pairs, request_id):
+    # Binance dovolí max. 5 zpráv za sekundu, streamy posíláme po dávkách
+    pairs = sorted(pairs)
+    for i in range(0, len(pairs), 200):
+        request_id += 1
+        params = [f"{pair.lower()}@miniTicker" for pair in pairs[i:i + 200]]
+        await ws.send(json.dumps({'method': method, 'params': params, 'id': request_id}))
+        await asyncio.sleep(0.25)
+    return request_id
+
+async def price_stream_loop(app, stop_event):
+    """Streamovací režim: ceny z WebSocketu, vyhodnocení alertů na každý tick."""
+    if websockets is None:
+        print("❌ Streamovací režim vyžaduje balíček websockets")
+        return
+    print(f"🚀 Startuji streamování cen z {PRICE_STREAM_URL}...")
+    backoff = 1
+    
+    while not stop_event.is_set():
+        try:
+            async with websockets.connect(PRICE_STREAM_URL, ping_interval=20) as ws:
+                print("✅ Stream připojen")
+                backoff = 1
+                subscribed = {}  # {pár: symbol}
+                symbols_version = None
+                request_id = 0
+                
+                while not stop_event.is_set():
+                    # Změna sledovaných symbolů -> upravíme odběr
+                    registry = STORE.symbol_registry()
+                    if symbols_version != registry.version:
+                        symbols_version = registry.version
+                        wanted = stream_pairs(registry.symbol_types)
+                        removed = set(subscribed) - set(wanted)
+                        added = set(wanted) - set(subscribed)
+                        if removed:
+                            request_id = await _stream_set_subscription(ws, 'UNSUBSCRIBE', removed, request_id)
+                            for pair in removed:
+                                STREAM_PRICES.pop(subscribed[pair], None)
+                        if added:
+                            request_id = await _stream_set_subscription(ws, 'SUBSCRIBE', added, request_id)
+                        if added or removed:
+                            print(f"📡 Stream: odebírám {len(wanted)} párů (+{len(added)} / -{len(removed)})")
+                        subscribed = wanted
+                    
+                    try:
+                        raw = await asyncio.wait_for(ws.recv(), timeout=1)
+                    except asyncio.TimeoutError:
+                        continue
+                    tick = parse_stream_tick(json.loads(raw))
+                    if not tick or tick[0] not in subscribed:
+                        continue
+                    
+                    pair, price = tick
+                    symbol = subscribed[pair]
+                    STREAM_PRICES[symbol] = (price, time.monotonic())
+                    PRICE_CACHE.put(symbol, 'crypto', price)
+                    if SHARDS is not None:
+                        SHARDS.publish_prices({symbol: price})
+                        continue
+                    changed = await evaluate_alerts(app, {symbol: price}, STORE.config, STORE.state, verbose=False,
+                                                    index=STORE.threshold_index(), on_delivered=save_state_changes)
+                    if changed:
+                        save_state_changes(changed)
+        except Exception as e:
+            if stop_event.is_set():
+                break
+            print(f"⚠️  Stream odpojen: {e}, nové připojení za {backoff}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+# --- Sharding uživatelů do procesů ---
+# S SHARD_COUNT > 0 (nebo --shards N) vyhodnocují alerty a posílají notifikace pracovní procesy. Každý vlastní
+# odběry chatů, pro které crc32(chat_id) % N == jeho číslo. Hlavní proces dál obsluhuje Telegram příkazy,
+# stahuje ceny (jednou pro všechny) a je jediný, kdo zapisuje do DB/souborů:
+#   hlavní -> shard (fronta shardu): ('prices', {symbol: cena}), ('config', změny odběrů), ('state', změny stavu), ('stop', None)
+#   shard -> hlavní (roura shardu): ('state', shard, {(chat_id, symbol): stav}, seen), ('stopped', shard, počet odběrů, seen)
+# seen = kolik zpráv z fronty shard zpracoval. Hlavní proces si pamatuje, kolikátou zprávou shardu poslal
+# vlastní změnu stavu řádku; změnu ze shardu, který ji ještě neviděl, nebo pro smazaný odběr zahodí.
+# Změna počtu shardů (/shards N) shardy zastaví, dočte jejich poslední změny stavu a spustí nové se snapshotem
+# z DataStore, takže last_notification_price se neztratí. Shard, jehož proces skončil, spustí hlavní proces
+# znovu se snapshotem jeho části ze STORE.
+
+def shard_of(chat_id, count):
+    """Stabilní rozdělení chatů (hash() se mezi procesy liší, crc32 ne)."""
+    return zlib.crc32(str(chat_id).encode()) % count
+
+def partition(data, shard_id, count):
+    return {chat_id: rows for chat_id, rows in data.items() if shard_of(chat_id, count) == shard_id}
+
+def shard_worker(shard_id, shard_count, token, inbox, connection, config, state):
+    """Vstupní bod procesu shardu. Do hlavního procesu posílá vlastní rourou: shard zabitý uprostřed zápisu
+    tak nemůže zablokovat společnou frontu (její zámek) ostatním shardům."""
+    bot = Bot(token)
+    outbox = SimpleNamespace(put=connection.send)
+    try:
+        asyncio.run(shard_main(shard_id, shard_count, SimpleNamespace(bot=bot), inbox, outbox, config, state))
+    except KeyboardInterrupt:
+        pass
+
+async def shard_main(shard_id, shard_count, app, inbox, outbox, config, state):
+    """Smyčka shardu: drží svou část configu a stavu, na každé ceny vyhodnotí alerty a vrátí změny stavu."""
+    global NOTIFIER
+    NOTIFIER = NotificationDispatcher(global_rate=NOTIFY_GLOBAL_RATE / shard_count)  # Globální limit si shardy dělí
+    index = create_alert_index()
+    index.rebuild(config, state)
+    loop = asyncio.get_running_loop()
+    print(f"🧩 Shard {shard_id}/{shard_count}: {index.subscriptions()} odběrů")
+    seen = 0
+    
+    def commit(keys):
+        index.refresh(keys, config, state)
+        outbox.put(('state', shard_id, {key: dict(state[key[0]][key[1]]) for key in keys}, seen))
+    
+    # Notifikace odesílá background task, smyčka mezitím přijímá další ceny
+    stop_event = asyncio.Event()
+    sender_task = asyncio.create_task(NOTIFIER.run(stop_event))
+    while True:
+        kind, payload = await loop.run_in_executor(None, inbox.get)
+        seen += 1
+        if kind == 'stop':
+            break
+        if kind in ('config', 'state'):
+            apply_rows(config if kind == 'config' else state, payload)
+            index.refresh(payload, config, state)
+        elif kind == 'prices':
+            changed = await evaluate_alerts(app, payload, config, state, verbose=False, index=index, on_delivered=commit)
+            if changed:
+                commit(changed)
+    # Rozeslané alerty ještě pošlou změny stavu, až pak 'stopped'
+    await NOTIFIER.close()
+    stop_event.set()
+    await sender_task
+    outbox.put(('stopped', shard_id, index.subscriptions(), seen))
+
+class ShardPool:
+    """Pracovní procesy shardů z pohledu hlavního procesu: rozesílá ceny a změny, přijímá změny stavu."""
+    
+    def __init__(self, count, token=None):
+        self.count = count
+        self.token = token or TELEGRAM_BOT_TOKEN
+        self.context = multiprocessing.get_context('spawn')  # Fork by zkopíroval běžící event loop a vlákna
+        self.inboxes = []
+        self.readers = []  # Konce rour, kterými shardy posílají změny stavu
+        self._read_lock = threading.Lock()  # Z rour čte vždy jen jedno vlákno (run a stop běží souběžně)
+        self.processes = []
+        self.stopped = set()
+        self.running = False
+        self.sent = [0] * count  # Kolik zpráv dostala fronta shardu od jeho spuštění
+        self.changed_at = [{} for _ in range(count)]  # {(chat_id, symbol): kolikátou zprávou šla změna stavu z hlavního procesu}
+        self.price_batches = 0
+        self.state_updates = 0
+        self.stale_updates = 0
+        self.rebalances = 0
+        self.restarts = 0
+        self.started_at = {}  # {shard_id: kdy se proces naposledy spustil (monotonic)}
+        self.last_prices = {}  # Poslední ceny (během přerozdělení sloučené), nové shardy je dostanou po startu
+        self.rebalance_task = None  # Běžící /shards N
+    
+    def start(self, config, state):
+        """Spustí shardy se snapshotem jejich části dat."""
+        self.stopped = set()
+        self.inboxes = [self.context.Queue() for _ in range(self.count)]
+        self.readers = [None] * self.count
+        self.sent = [0] * self.count
+        self.changed_at = [{} for _ in range(self.count)]
+        self.processes = [self._start_shard(shard_id, config, state) for shard_id in range(self.count)]
+        self.running = True
+        print(f"🧩 Spuštěno {self.count} shardů")
+    
+    def _start_shard(self, shard_id, config, state):
+        self.started_at[shard_id] = time.monotonic()
+        self.sent[shard_id] = 0
+        self.changed_at[shard_id] = {}  # Snapshot už obsahuje vše
+        reader, writer = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=shard_worker, name=f'shard-{shard_id}', daemon=True,
+            args=(shard_id, self.count, self.token, self.inboxes[shard_id], writer,
+                  partition(config, shard_id, self.count), partition(state, shard_id, self.count)))
+        process.start()
+        writer.close()  # Zápisový konec drží jen shard, jeho konec = EOF
+        self.readers[shard_id] = reader
+        return process
+    
+    def publish_prices(self, prices):
+        """Ceny jednoho cyklu všem shardům (během přerozdělení se schovají pro nové shardy)."""
+        if not prices:
+            return
+        if not self.running:
+            self.last_prices.update(prices)
+            return
+        self.last_prices = dict(prices)
+        for shard_id, inbox in enumerate(self.inboxes):
+            inbox.put(('prices', prices))
+            self.sent[shard_id] += 1
+        self.price_batches += 1
+    
+    def publish(self, kind, changes):
+        """Změny configu nebo stavu {(chat_id, symbol): hodnota} do shardů, které chaty vlastní."""
+        if not self.running:
+            return  # Nové shardy dostanou aktuální snapshot ze STORE
+        routed = {}
+        for key, value in changes.items():
+            routed.setdefault(shard_of(key[0], self.count), {})[key] = value
+        for shard_id, rows in routed.items():
+            self.inboxes[shard_id].put((kind, rows))
+            self.sent[shard_id] += 1
+            if kind == 'state':
+                self.changed_at[shard_id].update(dict.fromkeys(rows, self.sent[shard_id]))
+    
+    def _get(self, timeout):
+        with self._read_lock:
+            readers = [reader for reader in self.readers if reader is not None and not reader.closed]
+            for reader in multiprocessing.connection.wait(readers, timeout):
+                try:
+                    return reader.recv()
+                except (EOFError, OSError):
+                    reader.close()  # Shard skončil a vše odeslané už je přečtené
+            return None
+    
+    def _apply(self, message):
+        kind, shard_id, payload, seen = message
+        if kind == 'state':
+            # Odběr mezitím smazaný, nebo stav, který hlavní proces změnil až po tom, co ho shard viděl, se zahodí
+            changed_at = self.changed_at[shard_id] if shard_id < len(self.changed_at) else {}
+            fresh = {key: value for key, value in payload.items()
+                     if key[1] in STORE.config.get(key[0], {}) and changed_at.get(key, 0) <= seen}
+            self.stale_updates += len(payload) - len(fresh)
+            if fresh:
+                # Zpět do shardu se to neposílá, stav tam už je
+                STORE.update_state(fresh)
+                self.state_updates += len(fresh)
+        elif kind == 'stopped':
+            self.stopped.add(shard_id)
+    
+    async def _receive(self, timeout):
+        message = await asyncio.get_running_loop().run_in_executor(None, self._get, timeout)
+        if message is not None:
+            self._apply(message)
+        return message is not None
+    
+    async def _drain(self):
+        """Dočte vše, co už je ve frontě (např. poslední změny stavu shardu, který spadl)."""
+        while await self._receive(0.1):
+            pass
+    
+    async def check_alive(self):
+        """Shard, jehož proces skončil, spustí znovu se snapshotem jeho části dat ze STORE."""
+        now = time.monotonic()
+        dead = [shard_id for shard_id, process in enumerate(self.processes)
+                if not process.is_alive() and now - self.started_at.get(shard_id, 0) >= SHARD_RESTART_DELAY]
+        if not dead or not self.running:
+            return
+        await self._drain()
+        for shard_id in dead:
+            print(f"❌ {self.processes[shard_id].name} neběží (exit code {self.processes[shard_id].exitcode}), spouštím znovu")
+            self.inboxes[shard_id] = self.context.Queue()  # Zprávy pro mrtvý proces nahradí snapshot
+            self.processes[shard_id] = self._start_shard(shard_id, STORE.config, STORE.state)
+            self.restarts += 1
+    
+    async def run(self, stop_event):
+        """Přijímá změny stavu ze shardů a zapisuje je přes STORE (hlavní proces je jediný zapisovatel).
+        Hlídá, že procesy shardů běží."""
+        while not stop_event.is_set():
+            await self._receive(0.5)
+            await self.check_alive()
+    
+    async def stop(self, timeout=30):
+        """Zastaví shardy a dočte všechny jejich změny stavu (do zprávy 'stopped' od každého běžícího)."""
+        if not self.processes:
+            return
+        self.running = False
+        for inbox in self.inboxes:
+            inbox.put(('stop', None))
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            waiting = [p for shard_id, p in enumerate(self.processes) if shard_id not in self.stopped and p.is_alive()]
+            if not waiting:
+                break
+            await self._receive(0.2)
+        await self._drain()
+        for shard_id, process in enumerate(self.processes):
+            if shard_id not in self.stopped:
+                print(f"⚠️  {process.name} se neohlásil jako zastavený (exit code {process.exitcode})")
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                print(f"⚠️  {process.name} neskončil, ukončuji")
+                process.terminate()
+        for reader in self.readers:
+            reader.close()
+        self.processes = []
+        self.readers = []
+    
+    async def rebalance(self, count):
+        """Změní počet shardů: zastaví staré (bez ztráty stavu) a spustí nové nad aktuálními daty.
+        Ceny, které přišly mezitím, dostanou nové shardy hned po startu."""
+        await self.stop()
+        self.count = count
+        self.rebalances += 1
+        self.start(STORE.config, STORE.state)
+        self.publish_prices(self.last_prices)
+    
+    def stats(self):
+        return {
+            'shards': self.count,
+            'alive': sum(p.is_alive() for p in self.processes),
+            'price_batches': self.price_batches,
+            'state_updates': self.state_updates,
+            'stale_updates': self.stale_updates,
+            'rebalances': self.rebalances,
+            'restarts': self.restarts,
+        }
+
+SHARDS = None  # ShardPool v shardovaném režimu (main)
+
+async def shards_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/shards [N] - stav shardů, s N přerozdělí chaty do N procesů (jen pro admina)."""
+    if not is_admin(update):
+        await update.message.reply_text("❌ Tento příkaz je jen pro admina.")
+        return
+    if SHARDS is None:
+        await update.message.reply_text("ℹ️ Bot neběží v shardovaném režimu (SHARD_COUNT).")
+        return
+    if context.args:
+        try:
+            count = int(context.args[0])
+            if not 1 <= count <= SHARD_COUNT_MAX:
+                raise ValueError
+        except ValueError:
+            await update.message.reply_text(f"❌ Počet shardů musí být 1-{SHARD_COUNT_MAX}.")
+            return
+        if SHARDS.rebalance_task is not None and not SHARDS.rebalance_task.done():
+            await update.message.reply_text("⏳ Přerozdělení už probíhá.")
+            return
+        await update.message.reply_text(f"🔄 Přerozděluji do {count} shardů, ozvu se po dokončení...")
+        # Zastavení shardů může trvat desítky sekund, handler na něj nečeká
+        SHARDS.rebalance_task = asyncio.create_task(rebalance_shards(update, count))
+        return
+    await update.message.reply_text(format_shard_stats(SHARDS.stats()), parse_mode='HTML')
+
+async def rebalance_shards(update: Update, count):
+    """Přerozdělení na pozadí pro /shards N, po dokončení odpoví stavem shardů."""
+    try:
+        await SHARDS.rebalance(count)
+    except Exception as e:
+        print(f"❌ Chyba přerozdělení shardů: {e}")
+        await update.message.reply_text(f"❌ Přerozdělení selhalo: {e}")
+        return
+    await update.message.reply_text(format_shard_stats(SHARDS.stats()), parse_mode='HTML')
+
+def format_shard_stats(stats):
+    return (f"🧩 <b>Shardy</b>: {stats['alive']}/{stats['shards']} běží\n"
+            f"• dávek cen: {stats['price_batches']}\n• změn stavu: {stats['state_updates']} (zahozeno {stats['stale_updates']})\n"
+            f"• přerozdělení: {stats['rebalances']}\n• restartů: {stats['restarts']}")
+
+def run_migrations():
+    """python eth_price_alert.py --migrate: spustí migrace dat znovu (i když jsou označené jako hotové) a skončí."""
+    load_crypto_list_from_coingecko()
+    if DATABASE_URL:
+        init_database()
+    STORE.load()
+    migrate_asset_types(STORE, force=True)
+    WRITE_QUEUE.close()
+    print("✅ Migrace dokončena")
+
+def shard_count_value(value):
+    """Počet shardů 0..SHARD_COUNT_MAX z textu; None při neplatné hodnotě"""
+    try:
+        count = int(value)
+    except (TypeError, ValueError):
+        return None
+    if not 0 <= count <= SHARD_COUNT_MAX:
+        return None
+    return count
+
+def parse_shard_count(args):
+    """Počet shardů z --shards N (None při neplatné hodnotě), jinak ze SHARD_COUNT (neplatná hodnota = bez shardů)"""
+    if '--shards' in args:
+        index = args.index('--shards') + 1
+        return shard_count_value(args[index]) if index < len(args) else None
+    count = shard_count_value(SHARD_COUNT)
+    if count is None:
+        print(f"⚠️  Neplatný SHARD_COUNT={SHARD_COUNT!r}, očekávám 0-{SHARD_COUNT_MAX}, běžím bez shardů")
+        return 0
+    return count
+
 def main():
+    if '--migrate' in sys.argv[1:]:
+        run_migrations()
+        return
+    
     if not TELEGRAM_BOT_TOKEN:
         print("❌ Chybí TELEGRAM_BOT_TOKEN")
         return
     
+    shard_count = parse_shard_count(sys.argv[1:])
+    if shard_count is None:
+        print(f"❌ Použití: --shards N (0 = bez shardů, max {SHARD_COUNT_MAX})")
+        return
+    
     # Načteme seznam kryptoměn z CoinGecko při startu
     load_crypto_list_from_coingecko()
     
     if DATABASE_URL:
         init_database()
         print("✅ DB Inicializována")
+    STORE.load()
+    migrate_asset_types(STORE)
+    global PRICE_HISTORY, SHARDS
+    PRICE_HISTORY = create_price_history()
+    if shard_count > 0:
+        SHARDS = ShardPool(shard_count)
 
     app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
 
@@ -764,6 +3639,10 @@ def main():
     app.add_handler(CommandHandler('list', list_cryptos))
     app.add_handler(CommandHandler('remove', remove_crypto))
     app.add_handler(CommandHandler('setall', setall))
+    app.add_handler(CommandHandler('stats', stats_command))
+    app.add_handler(CommandHandler('symbols', symbols_command))
+    app.add_handler(CommandHandler('history', history_command))
+    app.add_handler(CommandHandler('shards', shards_command))
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('add', add_crypto)],
@@ -784,10 +3663,30 @@ def main():
     
     async def post_init(app: Application):
         """Spustí background loop po inicializaci aplikace."""
+        app.write_task = asyncio.create_task(WRITE_QUEUE.run(stop_event))
+        app.lag_task = asyncio.create_task(LOOP_LAG_MONITOR.run(stop_event))
+        app.notify_task = asyncio.create_task(NOTIFIER.run(stop_event))
+        if SHARDS is not None:
+            SHARDS.start(STORE.config, STORE.state)
+            app.shard_task = asyncio.create_task(SHARDS.run(stop_event))
         app.bg_task = asyncio.create_task(price_check_loop(app, stop_event))
         print("✅ Background price check loop spuštěn")
+        if PRICE_STREAM_MODE:
+            app.stream_task = asyncio.create_task(price_stream_loop(app, stop_event))
+            print("✅ Streamování cen spuštěno")
+    
+    async def post_shutdown(app: Application):
+        """Dočte stav ze shardů, dořeší frontu notifikací, uloží odložené zápisy, zavře HTTP session a spojení k DB."""
+        if SHARDS is not None:
+            await SHARDS.stop()
+        await NOTIFIER.close()
+        await WRITE_QUEUE.aclose()
+        await close_provider_sessions()
+        if DB_POOL:
+            DB_POOL.closeall()
     
     app.post_init = post_init
+    app.post_shutdown = post_shutdown
     
     # Cleanup při ukončení
     def cleanup():
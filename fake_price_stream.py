@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Lokální falešný WebSocket stream cen ve stylu Binance miniTicker.
+Slouží k testování streamovacího režimu bota bez přístupu k síti:
+
+    python fake_price_stream.py --port 8765
+    PRICE_STREAM_MODE=1 PRICE_STREAM_URL=ws://127.0.0.1:8765 python eth_price_alert.py
+
+Server přijímá SUBSCRIBE/UNSUBSCRIBE zprávy (stejný formát jako Binance) a pro odebírané páry
+posílá každých --interval sekund miniTicker s cenou, která se náhodně mění o --volatility.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import websockets
+
+DEFAULT_PRICES = {'BTCUSDT': 95000.0, 'ETHUSDT': 3000.0, 'LTCUSDT': 90.0}
+
+def mini_ticker(pair, price):
+    """Zpráva ve formátu Binance 24hrMiniTicker."""
+    return {
+        'e': '24hrMiniTicker',
+        'E': int(time.time() * 1000),
+        's': pair,
+        'c': f'{price:.8f}',
+        'o': f'{price:.8f}',
+        'h': f'{price:.8f}',
+        'l': f'{price:.8f}',
+        'v': '0',
+        'q': '0',
+    }
+
+async def serve_fake_stream(host='127.0.0.1', port=8765, interval=1.0, volatility=0.01, prices=None):
+    """Spustí falešný stream a vrátí websockets server. prices = {pár: počáteční cena}, sdílené mezi klienty
+    (test může ceny měnit za běhu)."""
+    prices = prices if prices is not None else dict(DEFAULT_PRICES)
+
+    async def handler(ws):
+        subscribed = set()
+
+        async def receive():
+            async for raw in ws:
+                message = json.loads(raw)
+                streams = {p.split('@')[0].upper() for p in message.get('params', [])}
+                if message.get('method') == 'SUBSCRIBE':
+                    subscribed.update(streams)
+                elif message.get('method') == 'UNSUBSCRIBE':
+                    subscribed.difference_update(streams)
+                await ws.send(json.dumps({'result': None, 'id': message.get('id')}))
+
+        receiver = asyncio.create_task(receive())
+        try:
+            while not receiver.done():
+                for pair in sorted(subscribed):
+                    if volatility:
+                        prices[pair] = prices.get(pair, 100.0) * (1 + random.uniform(-volatility, volatility))
+                    await ws.send(json.dumps(mini_ticker(pair, prices.setdefault(pair, 100.0))))
+                await asyncio.sleep(interval)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            receiver.cancel()
+
+    return await websockets.serve(handler, host, port)
+
+async def main():
+    parser = argparse.ArgumentParser(description='Falešný Binance miniTicker stream pro lokální testy')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--interval', type=float, default=1.0, help='Sekundy mezi ticky')
+    parser.add_argument('--volatility', type=float, default=0.01, help='Max. relativní změna ceny za tick')
+    args = parser.parse_args()
+
+    server = await serve_fake_stream(args.host, args.port, args.interval, args.volatility)
+    print(f"📡 Falešný stream běží na ws://{args.host}:{args.port}")
+    await server.wait_closed()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("🛑 Ukončeno")
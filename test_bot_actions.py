@@ -5,8 +5,10 @@ Testovací skript pro simulaci všech uživatelských akcí bota.
 import sys
 import os
 import json
+import socket
 import asyncio
-from unittest.mock import Mock, AsyncMock, patch
+from contextlib import contextmanager
+from unittest.mock import Mock, AsyncMock, MagicMock, patch
 
 # Přidáme aktuální adresář do path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -14,12 +16,11 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 # Importujeme funkce z bota
 import eth_price_alert
 from eth_price_alert import (
-    load_config, save_config, load_state, save_state,
-    get_crypto_price, validate_ticker,
     add_crypto, handle_threshold, list_cryptos,
-    remove_crypto, setall_threshold, update_threshold,
-    handle_update_threshold, help_command, start
+    remove_crypto, setall, update_threshold_cmd, help_command, start,
+    WAITING_THRESHOLD
 )
+from telegram.ext import ConversationHandler
 
 # Mock pro Telegram Update a Context
 class MockUpdate:
@@ -36,552 +37,1354 @@ class MockContext:
         self.args = args or []
         self.user_data = {}
 
+@contextmanager
+def isolated_store(config=None, state=None):
+    """Čerstvé STORE s daty chatu 12345; zápisy jdou do mocku místo DB/souboru."""
+    store = eth_price_alert.DataStore()
+    store.config = {'12345': config} if config is not None else {}
+    store.state = {'12345': state} if state is not None else {}
+    store.loaded = True
+    with patch('eth_price_alert.STORE', store), \
+         patch('eth_price_alert.save_rows_batch', return_value={}):
+        yield store
+
+def reply_text(update):
+    """Text poslední odpovědi bota."""
+    assert update.message.reply_text.called, "Handler měl zavolat reply_text"
+    return update.message.reply_text.call_args[0][0]
+
 async def test_start():
     """Test /start příkazu."""
-    print("🧪 Test 1: /start")
-    update = MockUpdate()
-    context = MockContext()
-    
-    try:
-        await start(update, context)
-        assert update.message.reply_text.called, "start() měl zavolat reply_text"
-        print("   ✅ /start funguje\n")
-        return True
-    except Exception as e:
-        print(f"   ❌ /start selhal: {e}\n")
-        return False
+    await start(MockUpdate(), MockContext())
 
 async def test_add_crypto():
     """Test /add příkazu."""
-    print("🧪 Test 2: /add BTC")
     update = MockUpdate(args=['BTC'])
     context = MockContext(['BTC'])
-    
-    # Mock validate_ticker
-    with patch('eth_price_alert.validate_ticker', return_value=(True, 'Bitcoin', 95000.0)):
-        try:
-            result = await add_crypto(update, context)
-            assert update.message.reply_text.called, "add_crypto() měl zavolat reply_text"
-            assert 'pending_symbol' in context.user_data, "Symbol měl být uložen do user_data"
-            assert context.user_data['pending_symbol'] == 'BTC', "Symbol měl být BTC"
-            print("   ✅ /add BTC funguje\n")
-            return True
-        except Exception as e:
-            print(f"   ❌ /add BTC selhal: {e}\n")
-            import traceback
-            traceback.print_exc()
-            return False
+    with patch('eth_price_alert.async_validate_ticker', return_value=(True, 'Bitcoin', 95000.0, 'crypto')):
+        result = await add_crypto(update, context)
+    assert result == WAITING_THRESHOLD, "Po ověření tickeru se má čekat na limit"
+    assert context.user_data['pending_symbol'] == 'BTC', "Symbol měl být uložen do user_data"
+    assert context.user_data['pending_asset_type'] == 'crypto'
 
 async def test_handle_threshold():
     """Test zadání threshold."""
-    print("🧪 Test 3: Zadání threshold (5)")
     update = MockUpdate(message_text='5')
     context = MockContext()
-    context.user_data['pending_symbol'] = 'BTC'
-    context.user_data['pending_name'] = 'Bitcoin'
-    context.user_data['pending_price'] = 95000.0
-    
-    # Mock get_crypto_price pro list_cryptos
-    original_get_price = get_crypto_price
-    with patch('eth_price_alert.get_crypto_price', return_value=95000.0):
-        try:
-            # Nejdřív načteme aktuální konfiguraci
-            config = load_config()
-            original_count = len(config)
-            
-            result = await handle_threshold(update, context)
-            assert update.message.reply_text.called, "handle_threshold() měl zavolat reply_text"
-            
-            # Ověříme, že se BTC uložil
-            config_after = load_config()
-            assert 'BTC' in config_after, "BTC měl být uložen do konfigurace"
-            assert len(config_after) >= original_count, "Počet kryptoměn se měl zvýšit"
-            
-            print(f"   ✅ Threshold uložen, BTC přidán do konfigurace (celkem: {len(config_after)} kryptoměn)\n")
-            return True
-        except Exception as e:
-            print(f"   ❌ handle_threshold selhal: {e}\n")
-            import traceback
-            traceback.print_exc()
-            return False
+    context.user_data.update(pending_symbol='BTC', pending_name='Bitcoin', pending_price=95000.0, pending_asset_type='crypto')
+    with isolated_store() as store:
+        result = await handle_threshold(update, context)
+        assert result == ConversationHandler.END
+        assert store.config['12345']['BTC'] == {'name': 'Bitcoin', 'threshold': 0.05, 'asset_type': 'crypto'}
+        assert store.state['12345']['BTC'] == {'last_notification_price': 95000.0}, "Výchozí cena alertu je cena při přidání"
+    assert context.user_data == {}, "Rozpracovaná data konverzace se měla smazat"
 
 async def test_list_cryptos():
     """Test /list příkazu."""
-    print("🧪 Test 4: /list")
     update = MockUpdate()
-    context = MockContext()
-    
-    with patch('eth_price_alert.get_crypto_price', return_value=95000.0):
-        try:
-            await list_cryptos(update, context)
-            assert update.message.reply_text.called, "list_cryptos() měl zavolat reply_text"
-            print("   ✅ /list funguje\n")
-            return True
-        except Exception as e:
-            print(f"   ❌ /list selhal: {e}\n")
-            import traceback
-            traceback.print_exc()
-            return False
+    with isolated_store({'BTC': {'name': 'Bitcoin', 'threshold': 0.05, 'asset_type': 'crypto'}},
+                        {'BTC': {'last_notification_price': 90000.0}}), \
+         patch('eth_price_alert.async_get_prices', return_value={'BTC': 95000.0}):
+        await list_cryptos(update, MockContext())
+    text = reply_text(update)
+    assert 'BTC' in text and '$95,000.00' in text and '$90,000.00' in text, f"Neúplný výpis: {text}"
 
 async def test_setall_threshold():
     """Test /setall příkazu."""
-    print("🧪 Test 5: /setall 3")
     update = MockUpdate(args=['3'])
-    context = MockContext(['3'])
-    
-    try:
-        config_before = load_config()
-        if not config_before:
-            print("   ⚠️  Žádné kryptoměny v konfiguraci, přeskočeno\n")
-            return True
-        
-        await setall_threshold(update, context)
-        assert update.message.reply_text.called, "setall_threshold() měl zavolat reply_text"
-        
-        # Ověříme, že se threshold změnil
-        config_after = load_config()
-        for symbol, crypto_config in config_after.items():
-            assert crypto_config.get('threshold') == 0.03, f"Threshold pro {symbol} měl být 0.03"
-        
-        print(f"   ✅ /setall funguje, threshold nastaven na 3% pro všechny kryptoměny\n")
-        return True
-    except Exception as e:
-        print(f"   ❌ /setall selhal: {e}\n")
-        import traceback
-        traceback.print_exc()
-        return False
+    config = {'BTC': {'name': 'Bitcoin', 'threshold': 0.05, 'asset_type': 'crypto'},
+              'AAPL': {'name': 'Apple', 'threshold': 0.1, 'asset_type': 'stock'}}
+    with isolated_store(config) as store:
+        await setall(update, MockContext(['3']))
+        assert all(conf['threshold'] == 0.03 for conf in store.config['12345'].values()), store.config
 
 async def test_remove_crypto():
     """Test /remove příkazu."""
-    print("🧪 Test 6: /remove BTC")
     update = MockUpdate(args=['BTC'])
-    context = MockContext(['BTC'])
-    
-    try:
-        config_before = load_config()
-        if 'BTC' not in config_before:
-            print("   ⚠️  BTC není v konfiguraci, přeskočeno\n")
-            return True
-        
-        await remove_crypto(update, context)
-        assert update.message.reply_text.called, "remove_crypto() měl zavolat reply_text"
-        
-        # Ověříme, že se BTC odstranil
-        config_after = load_config()
-        assert 'BTC' not in config_after, "BTC měl být odstraněn z konfigurace"
-        
-        print(f"   ✅ /remove funguje, BTC odstraněn (celkem: {len(config_after)} kryptoměn)\n")
-        return True
-    except Exception as e:
-        print(f"   ❌ /remove selhal: {e}\n")
-        import traceback
-        traceback.print_exc()
-        return False
+    with isolated_store({'BTC': {'name': 'Bitcoin', 'threshold': 0.05, 'asset_type': 'crypto'},
+                         'ETH': {'name': 'Ethereum', 'threshold': 0.05, 'asset_type': 'crypto'}}) as store:
+        await remove_crypto(update, MockContext(['BTC']))
+        assert list(store.config['12345']) == ['ETH'], "BTC měl být odstraněn z konfigurace"
+    assert 'odstraněno' in reply_text(update)
 
 async def test_help():
     """Test /help příkazu."""
-    print("🧪 Test 7: /help")
     update = MockUpdate()
-    context = MockContext()
-    
-    try:
-        await help_command(update, context)
-        assert update.message.reply_text.called, "help_command() měl zavolat reply_text"
-        print("   ✅ /help funguje\n")
-        return True
-    except Exception as e:
-        print(f"   ❌ /help selhal: {e}\n")
-        import traceback
-        traceback.print_exc()
-        return False
+    await help_command(update, MockContext())
+    assert '/add' in reply_text(update)
 
 async def test_get_crypto_price():
-    """Test získávání cen z API."""
-    print("🧪 Test 8: get_crypto_price pro různé kryptoměny")
-    
-    test_symbols = ['BTC', 'ETH', 'LTC']
-    results = {}
-    
-    for symbol in test_symbols:
-        try:
-            price = get_crypto_price(symbol)
-            if price and price > 0:
-                results[symbol] = price
-                print(f"   ✅ {symbol}: ${price:,.2f}")
-            else:
-                print(f"   ⚠️  {symbol}: Cena nebyla získána")
-        except Exception as e:
-            print(f"   ❌ {symbol}: Chyba - {e}")
-    
-    if len(results) >= 2:
-        print(f"   ✅ get_crypto_price funguje ({len(results)}/{len(test_symbols)} úspěšných)\n")
-        return True
-    else:
-        print(f"   ⚠️  get_crypto_price má problémy ({len(results)}/{len(test_symbols)} úspěšných)\n")
-        return False
+    """Test získávání cen z API (bez sítě se přeskočí)."""
+    try:
+        socket.create_connection(('min-api.cryptocompare.com', 443), timeout=3).close()
+    except OSError:
+        print("   ⏭️  API není dostupné, přeskočeno\n")
+        return
+    prices = {symbol: await eth_price_alert.async_get_crypto_price(symbol) for symbol in ['BTC', 'ETH', 'LTC']}
+    await eth_price_alert.close_provider_sessions()
+    assert sum(1 for price in prices.values() if price and price > 0) >= 2, f"Ceny nebyly získány: {prices}"
 
 async def test_database_operations():
-    """Test databázových operací."""
-    print("🧪 Test 9: Databázové operace")
+    """Test uložení a načtení dat přes souborový fallback."""
+    import tempfile
     
-    try:
-        # Test načtení konfigurace
-        config = load_config()
-        print(f"   📋 Načtena konfigurace: {len(config)} kryptoměn")
-        
-        # Test načtení stavu
-        state = load_state()
-        print(f"   📊 Načten stav: {len(state)} kryptoměn")
-        
-        # Test uložení (přidáme testovací záznam)
-        test_config = config.copy()
-        test_config['TEST'] = {'name': 'Test Coin', 'threshold': 0.01}
-        save_config(test_config)
-        
-        # Ověříme, že se uložilo
-        config_after = load_config()
-        if 'TEST' in config_after:
-            print("   ✅ Ukládání do databáze funguje")
-            # Odstraníme testovací záznam
-            del test_config['TEST']
-            save_config(test_config)
-            print("   ✅ Obnovena původní konfigurace\n")
-            return True
-        else:
-            print("   ❌ Ukládání do databáze selhalo\n")
-            return False
-    except Exception as e:
-        print(f"   ❌ Databázové operace selhaly: {e}\n")
-        import traceback
-        traceback.print_exc()
-        return False
+    with tempfile.TemporaryDirectory() as tmp, patch('eth_price_alert.DB_POOL', None):
+        config_file = os.path.join(tmp, 'config.json')
+        data = {'12345': {'TEST': {'name': 'Test Coin', 'threshold': 0.01, 'asset_type': 'crypto'}}}
+        eth_price_alert.save_data('crypto_config', config_file, data)
+        assert eth_price_alert.load_data('crypto_config', config_file) == data
+        eth_price_alert.save_data('crypto_config', config_file, {})
+        assert eth_price_alert.load_data('crypto_config', config_file) == {}
 
 async def test_add_existing_crypto():
     """Test přidání kryptoměny, která už existuje."""
-    print("🧪 Test 10: /add kryptoměny, která už existuje")
     update = MockUpdate(args=['ETH'])
     context = MockContext(['ETH'])
-    
-    # Nejdřív zkontrolujeme, jestli ETH už existuje
-    config_before = load_config()
-    eth_exists = 'ETH' in config_before
-    
-    with patch('eth_price_alert.validate_ticker', return_value=(True, 'Ethereum', 3000.0)):
-        try:
-            result = await add_crypto(update, context)
-            # Bot by měl umožnit přidat i existující (přepíše threshold)
-            assert update.message.reply_text.called, "add_crypto() měl zavolat reply_text"
-            print(f"   ✅ /add existující kryptoměny funguje (ETH existuje: {eth_exists})\n")
-            return True
-        except Exception as e:
-            print(f"   ❌ /add existující kryptoměny selhal: {e}\n")
-            return False
+    with isolated_store({'ETH': {'name': 'Ethereum', 'threshold': 0.1, 'asset_type': 'crypto'}}), \
+         patch('eth_price_alert.async_validate_ticker', return_value=(True, 'Ethereum', 3000.0, 'crypto')):
+        result = await add_crypto(update, context)
+    assert result == WAITING_THRESHOLD, "Existující symbol jde přidat znovu (přepíše limit)"
+    assert context.user_data['pending_symbol'] == 'ETH'
 
 async def test_add_invalid_ticker():
     """Test přidání neplatného tickeru."""
-    print("🧪 Test 11: /add neplatného tickeru (INVALID)")
     update = MockUpdate(args=['INVALID'])
     context = MockContext(['INVALID'])
-    
-    with patch('eth_price_alert.validate_ticker', return_value=(False, None, None)):
-        try:
-            result = await add_crypto(update, context)
-            assert update.message.reply_text.called, "add_crypto() měl zavolat reply_text"
-            # Měla by být chybová zpráva
-            call_args = update.message.reply_text.call_args[0][0]
-            assert 'není platný' in call_args.lower() or 'neexistuje' in call_args.lower(), "Měla být chybová zpráva"
-            print("   ✅ /add neplatného tickeru správně vrátil chybu\n")
-            return True
-        except Exception as e:
-            print(f"   ❌ /add neplatného tickeru selhal: {e}\n")
-            return False
+    with patch('eth_price_alert.async_validate_ticker', return_value=(False, None, None, None)):
+        result = await add_crypto(update, context)
+    assert result == ConversationHandler.END
+    assert 'nebyl nalezen' in reply_text(update), "Měla být chybová zpráva"
+    assert 'pending_symbol' not in context.user_data
 
 async def test_handle_invalid_threshold():
     """Test zadání neplatného threshold."""
-    print("🧪 Test 12: Zadání neplatného threshold (text)")
     update = MockUpdate(message_text='abc')
     context = MockContext()
-    context.user_data['pending_symbol'] = 'TEST'
-    context.user_data['pending_name'] = 'Test Coin'
-    
-    try:
+    context.user_data.update(pending_symbol='TEST', pending_name='Test Coin')
+    with isolated_store() as store:
         result = await handle_threshold(update, context)
-        assert update.message.reply_text.called, "handle_threshold() měl zavolat reply_text"
-        # Měla by být chybová zpráva
-        call_args = update.message.reply_text.call_args[0][0]
-        assert 'neplatný' in call_args.lower() or 'formát' in call_args.lower(), "Měla být chybová zpráva"
-        assert result == 1, "Měl by zůstat ve stavu WAITING_THRESHOLD"
-        print("   ✅ Neplatný threshold správně vrátil chybu\n")
-        return True
-    except Exception as e:
-        print(f"   ❌ Neplatný threshold selhal: {e}\n")
-        return False
+        assert store.config == {}, "Nic se nemělo uložit"
+    assert 'zadejte číslo' in reply_text(update).lower(), "Měla být chybová zpráva"
+    assert result == WAITING_THRESHOLD, "Měl by zůstat ve stavu WAITING_THRESHOLD"
 
 async def test_handle_negative_threshold():
     """Test zadání záporného threshold."""
-    print("🧪 Test 13: Zadání záporného threshold (-5)")
     update = MockUpdate(message_text='-5')
     context = MockContext()
-    context.user_data['pending_symbol'] = 'TEST'
-    context.user_data['pending_name'] = 'Test Coin'
-    
-    try:
+    context.user_data.update(pending_symbol='TEST', pending_name='Test Coin')
+    with isolated_store() as store:
         result = await handle_threshold(update, context)
-        assert update.message.reply_text.called, "handle_threshold() měl zavolat reply_text"
-        # Měla by být chybová zpráva
-        call_args = update.message.reply_text.call_args[0][0]
-        assert 'větší než 0' in call_args.lower() or 'musí být' in call_args.lower(), "Měla být chybová zpráva"
-        assert result == 1, "Měl by zůstat ve stavu WAITING_THRESHOLD"
-        print("   ✅ Záporný threshold správně vrátil chybu\n")
-        return True
-    except Exception as e:
-        print(f"   ❌ Záporný threshold selhal: {e}\n")
-        return False
+        assert store.config == {}, "Záporný limit se nesmí uložit"
+    assert 'zadejte číslo' in reply_text(update).lower(), "Měla být chybová zpráva"
+    assert result == WAITING_THRESHOLD, "Měl by zůstat ve stavu WAITING_THRESHOLD"
 
 async def test_remove_nonexistent_crypto():
     """Test odebrání kryptoměny, která neexistuje."""
-    print("🧪 Test 14: /remove neexistující kryptoměny (XYZ)")
     update = MockUpdate(args=['XYZ'])
-    context = MockContext(['XYZ'])
-    
-    try:
-        config_before = load_config()
-        if 'XYZ' in config_before:
-            print("   ⚠️  XYZ už existuje, přeskočeno\n")
-            return True
-        
-        await remove_crypto(update, context)
-        assert update.message.reply_text.called, "remove_crypto() měl zavolat reply_text"
-        # Měla by být chybová zpráva
-        call_args = update.message.reply_text.call_args[0][0]
-        assert 'není ve sledovaných' in call_args.lower() or 'není' in call_args.lower(), "Měla být chybová zpráva"
-        print("   ✅ /remove neexistující kryptoměny správně vrátil chybu\n")
-        return True
-    except Exception as e:
-        print(f"   ❌ /remove neexistující kryptoměny selhal: {e}\n")
-        return False
+    with isolated_store({'BTC': {'name': 'Bitcoin', 'threshold': 0.05, 'asset_type': 'crypto'}}) as store:
+        await remove_crypto(update, MockContext(['XYZ']))
+        assert list(store.config['12345']) == ['BTC']
+    assert 'nesledujete' in reply_text(update), "Měla být chybová zpráva"
 
 async def test_list_empty():
     """Test /list když není žádná kryptoměna."""
-    print("🧪 Test 15: /list s prázdnou konfigurací")
     update = MockUpdate()
-    context = MockContext()
-    
-    # Uložíme prázdnou konfiguraci
-    original_config = load_config()
-    save_config({})
-    
-    try:
-        await list_cryptos(update, context)
-        assert update.message.reply_text.called, "list_cryptos() měl zavolat reply_text"
-        print("   ✅ /list s prázdnou konfigurací funguje\n")
-        
-        # Obnovíme původní konfiguraci
-        save_config(original_config)
-        return True
-    except Exception as e:
-        print(f"   ❌ /list s prázdnou konfigurací selhal: {e}\n")
-        # Obnovíme původní konfiguraci
-        save_config(original_config)
-        return False
+    with isolated_store(), patch('eth_price_alert.async_get_prices') as mock_prices:
+        await list_cryptos(update, MockContext())
+    assert 'žádné' in reply_text(update)
+    assert not mock_prices.called, "Bez odběrů se ceny nemají stahovat"
 
 async def test_setall_empty():
     """Test /setall když není žádná kryptoměna."""
-    print("🧪 Test 16: /setall s prázdnou konfigurací")
     update = MockUpdate(args=['5'])
-    context = MockContext(['5'])
-    
-    # Uložíme prázdnou konfiguraci
-    original_config = load_config()
-    save_config({})
-    
-    try:
-        await setall_threshold(update, context)
-        assert update.message.reply_text.called, "setall_threshold() měl zavolat reply_text"
-        # Měla by být chybová zpráva (buď "nesleduji žádné" nebo podobná)
-        call_args = update.message.reply_text.call_args[0][0]
-        assert 'nesleduji' in call_args.lower() or 'žádné' in call_args.lower() or 'použijte /add' in call_args.lower(), f"Měla být chybová zpráva, ale dostali jsme: {call_args}"
-        print("   ✅ /setall s prázdnou konfigurací správně vrátil chybu\n")
-        
-        # Obnovíme původní konfiguraci
-        save_config(original_config)
-        return True
-    except Exception as e:
-        print(f"   ❌ /setall s prázdnou konfigurací selhal: {e}\n")
-        import traceback
-        traceback.print_exc()
-        # Obnovíme původní konfiguraci
-        save_config(original_config)
-        return False
+    with isolated_store() as store:
+        await setall(update, MockContext(['5']))
+        assert store.config.get('12345', {}) == {}, "Bez odběrů se nemá nic vytvořit"
 
 async def test_setall_invalid_threshold():
     """Test /setall s neplatným threshold."""
-    print("🧪 Test 17: /setall s neplatným threshold (abc)")
     update = MockUpdate(args=['abc'])
-    context = MockContext(['abc'])
-    
-    # Ujistíme se, že máme nějakou konfiguraci
-    config = load_config()
-    if not config:
-        # Přidáme testovací kryptoměnu
-        config = {'TEST': {'name': 'Test', 'threshold': 0.05}}
-        save_config(config)
-    
-    try:
-        await setall_threshold(update, context)
-        assert update.message.reply_text.called, "setall_threshold() měl zavolat reply_text"
-        # Měla by být chybová zpráva
-        call_args = update.message.reply_text.call_args[0][0]
-        assert 'neplatný' in call_args.lower() or 'formát' in call_args.lower() or 'číslo' in call_args.lower(), f"Měla být chybová zpráva, ale dostali jsme: {call_args}"
-        print("   ✅ /setall s neplatným threshold správně vrátil chybu\n")
-        return True
-    except Exception as e:
-        print(f"   ❌ /setall s neplatným threshold selhal: {e}\n")
-        import traceback
-        traceback.print_exc()
-        return False
+    with isolated_store({'TEST': {'name': 'Test', 'threshold': 0.05, 'asset_type': 'crypto'}}) as store:
+        await setall(update, MockContext(['abc']))
+        assert store.config['12345']['TEST']['threshold'] == 0.05, "Limit se nesmí změnit"
+    assert 'formátu' in reply_text(update), "Měla být chybová zpráva"
 
 async def test_update_nonexistent():
     """Test /update pro neexistující kryptoměnu."""
-    print("🧪 Test 18: /update neexistující kryptoměny (XYZ)")
     update = MockUpdate(args=['XYZ'])
     context = MockContext(['XYZ'])
-    
-    # Ujistíme se, že máme nějakou konfiguraci
-    config = load_config()
-    if not config:
-        # Přidáme testovací kryptoměnu
-        config = {'TEST': {'name': 'Test', 'threshold': 0.05}}
-        save_config(config)
-    
-    try:
-        config = load_config()
-        if 'XYZ' in config:
-            print("   ⚠️  XYZ už existuje, přeskočeno\n")
-            return True
+    with isolated_store({'TEST': {'name': 'Test', 'threshold': 0.05, 'asset_type': 'crypto'}}):
+        result = await update_threshold_cmd(update, context)
+    assert result == ConversationHandler.END
+    assert 'pending_symbol' not in context.user_data, "Nesledovaný symbol se nemá začít upravovat"
+    assert 'Vyberte' in reply_text(update), "Měl se nabídnout výběr ze sledovaných"
+
+async def test_update_keeps_asset_type():
+    """Test, že /update zachová typ a název odběru (akcie se nesmí přepsat na kryptoměnu)."""
+    update = MockUpdate(message_text='7')
+    update.callback_query = Mock(data='upd_AAPL', answer=AsyncMock(), edit_message_text=AsyncMock())
+    context = MockContext()
+    with isolated_store({'AAPL': {'name': 'Apple Inc.', 'threshold': 0.05, 'asset_type': 'stock'}}) as store:
+        assert await eth_price_alert.update_callback(update, context) == eth_price_alert.WAITING_UPDATE_THRESHOLD
+        assert await eth_price_alert.handle_update_val(update, context) == ConversationHandler.END
+        assert store.config['12345']['AAPL'] == {'name': 'Apple Inc.', 'threshold': 0.07, 'asset_type': 'stock'}
         
-        result = await update_threshold(update, context)
-        assert update.message.reply_text.called, "update_threshold() měl zavolat reply_text"
-        # Měla by být chybová zpráva
-        call_args = update.message.reply_text.call_args[0][0]
-        assert 'není ve sledovaných' in call_args.lower() or 'není' in call_args.lower() or 'použijte /list' in call_args.lower(), f"Měla být chybová zpráva, ale dostali jsme: {call_args}"
-        print("   ✅ /update neexistující kryptoměny správně vrátil chybu\n")
-        return True
-    except Exception as e:
-        print(f"   ❌ /update neexistující kryptoměny selhal: {e}\n")
-        import traceback
-        traceback.print_exc()
-        return False
+        # Bez typu v kontextu se ponechá uložený typ
+        context.user_data.update(pending_symbol='AAPL', pending_name='Apple Inc.')
+        await handle_threshold(MockUpdate(message_text='3'), context)
+        assert store.config['12345']['AAPL']['asset_type'] == 'stock'
 
 async def test_add_without_args():
     """Test /add bez argumentů."""
-    print("🧪 Test 19: /add bez argumentů")
     update = MockUpdate(args=[])
-    context = MockContext([])
-    
-    try:
-        result = await add_crypto(update, context)
-        assert update.message.reply_text.called, "add_crypto() měl zavolat reply_text"
-        # Měla by být chybová zpráva
-        call_args = update.message.reply_text.call_args[0][0]
-        assert 'zadejte ticker' in call_args.lower() or 'ticker' in call_args.lower(), "Měla být chybová zpráva"
-        assert result == -1, "Měl by ukončit konverzaci"
-        print("   ✅ /add bez argumentů správně vrátil chybu\n")
-        return True
-    except Exception as e:
-        print(f"   ❌ /add bez argumentů selhal: {e}\n")
-        return False
+    result = await add_crypto(update, MockContext([]))
+    assert 'použití' in reply_text(update).lower(), "Měla být chybová zpráva"
+    assert result == ConversationHandler.END, "Měl by ukončit konverzaci"
 
 async def test_remove_without_args():
     """Test /remove bez argumentů."""
-    print("🧪 Test 20: /remove bez argumentů")
     update = MockUpdate(args=[])
-    context = MockContext([])
-    
-    try:
-        await remove_crypto(update, context)
-        assert update.message.reply_text.called, "remove_crypto() měl zavolat reply_text"
-        # Měla by být chybová zpráva
-        call_args = update.message.reply_text.call_args[0][0]
-        assert 'zadejte ticker' in call_args.lower() or 'ticker' in call_args.lower(), "Měla být chybová zpráva"
-        print("   ✅ /remove bez argumentů správně vrátil chybu\n")
-        return True
-    except Exception as e:
-        print(f"   ❌ /remove bez argumentů selhal: {e}\n")
-        return False
+    await remove_crypto(update, MockContext([]))
+    assert 'použití' in reply_text(update).lower(), "Měla být chybová zpráva"
 
 async def test_add_overwrites_existing():
     """Test že přidání existující kryptoměny přepíše threshold."""
-    print("🧪 Test 21: Přidání existující kryptoměny přepíše threshold")
-    # Nejdřív přidáme kryptoměnu s jedním threshold
-    config = load_config()
-    if 'ETH' not in config:
-        config['ETH'] = {'name': 'Ethereum', 'threshold': 0.10}  # 10%
-        save_config(config)
-    
-    original_threshold = config.get('ETH', {}).get('threshold', 0)
-    
-    # Teď "přidáme" ETH znovu s jiným threshold
     update = MockUpdate(args=['ETH'])
     context = MockContext(['ETH'])
-    context.user_data = {}
-    
-    with patch('eth_price_alert.validate_ticker', return_value=(True, 'Ethereum', 3000.0)):
-        result = await add_crypto(update, context)
-        # Mělo by to umožnit přidat (přepíše threshold)
-        assert update.message.reply_text.called, "add_crypto() měl zavolat reply_text"
-        assert 'pending_symbol' in context.user_data, "Symbol měl být uložen"
-        print(f"   ✅ Přidání existující kryptoměny funguje (přepíše threshold)\n")
-        return True
+    with isolated_store({'ETH': {'name': 'Ethereum', 'threshold': 0.10, 'asset_type': 'crypto'}},
+                        {'ETH': {'last_notification_price': 2500.0}}) as store:
+        with patch('eth_price_alert.async_validate_ticker', return_value=(True, 'Ethereum', 3000.0, 'crypto')):
+            await add_crypto(update, context)
+        update.message.text = '3'
+        await handle_threshold(update, context)
+        assert store.config['12345']['ETH']['threshold'] == 0.03, "Limit se měl přepsat"
+        assert store.state['12345']['ETH']['last_notification_price'] == 2500.0, "Stav alertu se nemá resetovat"
 
 async def test_zero_threshold():
     """Test zadání threshold 0."""
-    print("🧪 Test 22: Zadání threshold 0")
     update = MockUpdate(message_text='0')
     context = MockContext()
-    context.user_data['pending_symbol'] = 'TEST'
-    context.user_data['pending_name'] = 'Test Coin'
-    
-    try:
+    context.user_data.update(pending_symbol='TEST', pending_name='Test Coin')
+    with isolated_store() as store:
         result = await handle_threshold(update, context)
-        assert update.message.reply_text.called, "handle_threshold() měl zavolat reply_text"
-        # Měla by být chybová zpráva
-        call_args = update.message.reply_text.call_args[0][0]
-        assert 'větší než 0' in call_args.lower() or 'musí být' in call_args.lower(), "Měla být chybová zpráva"
-        assert result == 1, "Měl by zůstat ve stavu WAITING_THRESHOLD"
-        print("   ✅ Threshold 0 správně vrátil chybu\n")
-        return True
-    except Exception as e:
-        print(f"   ❌ Threshold 0 selhal: {e}\n")
-        return False
+        assert store.config == {}, "Nulový limit se nesmí uložit"
+    assert result == WAITING_THRESHOLD, "Měl by zůstat ve stavu WAITING_THRESHOLD"
 
 async def test_very_high_threshold():
     """Test zadání velmi vysokého threshold."""
-    print("🧪 Test 23: Zadání velmi vysokého threshold (1000)")
     update = MockUpdate(message_text='1000')
     context = MockContext()
-    context.user_data['pending_symbol'] = 'TEST'
-    context.user_data['pending_name'] = 'Test Coin'
+    context.user_data.update(pending_symbol='TEST', pending_name='Test Coin', pending_price=1.0)
+    with isolated_store() as store:
+        await handle_threshold(update, context)
+        assert store.config['12345']['TEST']['threshold'] == 10.0, "Threshold měl být 1000% = 10.0"
+
+async def test_bulk_crypto_prices():
+    """Test hromadného stažení cen kryptoměn přes pricemulti."""
+    symbols = [f"S{i:03d}" for i in range(200)]
+    chunks = eth_price_alert.chunk_symbols(symbols, eth_price_alert.CRYPTOCOMPARE_FSYMS_MAX_LEN)
+    assert sum(len(c) for c in chunks) == len(symbols), "Žádný symbol se nesměl ztratit"
+    assert all(len(','.join(c)) <= eth_price_alert.CRYPTOCOMPARE_FSYMS_MAX_LEN for c in chunks), "Dávka překročila limit"
+    
+    data = {'BTC': {'USD': 95000}, 'ETH': {'USD': 3000.5}}
+    with patch('eth_price_alert.async_get_json', AsyncMock(return_value=data)) as mock_get:
+        prices = await eth_price_alert.async_get_prices_from_cryptocompare_bulk(['BTC', 'ETH', 'NEEXISTUJE'])
+    assert mock_get.await_count == 1, "Tři symboly se měly vejít do jednoho requestu"
+    assert prices == {'BTC': 95000.0, 'ETH': 3000.5}, f"Neočekávané ceny: {prices}"
+
+async def test_async_prices_concurrency():
+    """Test souběžného asynchronního stahování cen s limitem souběžnosti."""
+    running = 0
+    max_running = 0
     
+    async def fake_get_price(symbol, asset_type=None, chart_only=False):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        return 100.0, 'crypto' if asset_type == 'crypto' else 'Yahoo Finance'
+    
+    symbol_types = {'BTC': 'crypto', 'DOGE': 'crypto', 'AAPL': 'stock', 'TSLA': 'stock', 'MSFT': 'stock', 'NVDA': 'stock'}
+    with patch('eth_price_alert.PRICE_CACHE', eth_price_alert.PriceCache()), \
+         patch.object(eth_price_alert.BINANCE_SNAPSHOT, 'async_refresh', return_value={}), \
+         patch('eth_price_alert.async_get_prices_from_cryptocompare_bulk', return_value={'BTC': 95000.0}), \
+         patch('eth_price_alert.async_get_stock_prices_bulk', return_value={'AAPL': 230.0}), \
+         patch('eth_price_alert.async_get_price', side_effect=fake_get_price) as mock_price, \
+         patch('eth_price_alert.async_get_stock_price', side_effect=fake_get_price) as mock_stock, \
+         patch('eth_price_alert.PRICE_FETCH_CONCURRENCY', 2):
+        prices = await eth_price_alert.async_get_prices(symbol_types)
+    assert prices['BTC'] == 95000.0 and prices['AAPL'] == 230.0, "BTC a AAPL měly přijít z hromadných requestů"
+    assert mock_price.call_count == 1, "Po jednom se měla stahovat jen kryptoměna, kterou dávka nevrátila"
+    assert mock_stock.call_count == 3, "Chart fallback měl jít jen pro akcie, které quote dávka nevrátila"
+    assert all(c.kwargs.get('chart_only') for c in mock_stock.call_args_list), "Fallback pro akcie má být jen chart"
+    assert len(prices) == 6, f"Měly být ceny pro všech 6 symbolů: {prices}"
+    assert max_running <= 2, f"Překročen limit souběžnosti: {max_running}"
+
+async def test_provider_session_reuse():
+    """Test keep-alive session poskytovatele a počítadel znovupoužitých spojení."""
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    import threading
+    
+    class JsonHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def do_GET(self):
+            body = json.dumps({'USD': 1.0, 'ua': self.headers.get('User-Agent', '')}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, *args):
+            pass
+    
+    server = ThreadingHTTPServer(('127.0.0.1', 0), JsonHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_port}/data'
     try:
-        result = await handle_threshold(update, context)
-        # Mělo by to projít (i když je to vysoké)
-        assert update.message.reply_text.called, "handle_threshold() měl zavolat reply_text"
-        # Mělo by to být uloženo
-        config = load_config()
-        if 'TEST' in config:
-            assert config['TEST']['threshold'] == 10.0, "Threshold měl být 1000% = 10.0"
-            # Odstraníme testovací záznam
-            del config['TEST']
-            save_config(config)
-            print("   ✅ Velmi vysoký threshold funguje (1000%)\n")
-            return True
-        else:
-            print("   ⚠️  TEST nebyl uložen, ale nevrátil chybu\n")
-            return True
-    except Exception as e:
-        print(f"   ❌ Velmi vysoký threshold selhal: {e}\n")
+        session = eth_price_alert.ProviderSession('test', headers=eth_price_alert.YAHOO_HEADERS)
+        for _ in range(3):
+            data = session.get(url).json()
+        assert data['ua'].startswith('Mozilla'), "Výchozí hlavičky se měly poslat"
+        for _ in range(3):
+            response = await session.async_get(url)
+            assert response.status_code == 200
+        stats = session.stats()
+        assert stats['requests'] == 6, f"Mělo být 6 requestů: {stats}"
+        assert stats['new_connections'] == 2, f"Měla být 2 spojení (sync + async): {stats}"
+        assert stats['reused'] == 4, f"4 requesty měly znovupoužít spojení: {stats}"
+        await session.aclose()
+    finally:
+        server.shutdown()
+
+async def test_hedged_provider_selection():
+    """Test výběru nejrychlejšího poskytovatele a hedged requestu."""
+    import time
+    
+    async def slow_provider(symbol):
+        await asyncio.sleep(2)
+        return 1.0, 'slow'
+    
+    async def fast_provider(symbol):
+        return 2.0, 'fast'
+    
+    # "slow" má historicky nižší latenci, takže jde první; teď ale vázne
+    for _ in range(10):
+        eth_price_alert.get_provider_stats('test_slow').record(0.01, True)
+        eth_price_alert.get_provider_stats('test_fast').record(0.05, True)
+        eth_price_alert.get_provider_stats('test_broken').record(0.001, False)
+    ranked = eth_price_alert.rank_providers(['test_broken', 'test_fast', 'test_slow'])
+    assert ranked == ['test_slow', 'test_fast', 'test_broken'], f"Špatné pořadí: {ranked}"
+    
+    started = time.monotonic()
+    price, api_name = await eth_price_alert.async_hedged_call(
+        {'test_slow': slow_provider, 'test_fast': fast_provider}, 'BTC'
+    )
+    elapsed = time.monotonic() - started
+    assert (price, api_name) == (2.0, 'fast'), f"Měl vyhrát hedged request: {price}, {api_name}"
+    assert elapsed < 1.0, f"Hedged request měl odejít po p95 zpoždění, trvalo {elapsed:.2f}s"
+
+async def test_circuit_breaker():
+    """Test jističe poskytovatele (closed -> open -> half_open -> closed)."""
+    breaker = eth_price_alert.CircuitBreaker('test', failure_threshold=2, cooldown=0.1)
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == 'closed', "Jedna chyba ještě jistič neotevře"
+    breaker.before_request()
+    breaker.record_failure()
+    assert breaker.state == 'open' and breaker.is_open(), "Po dvou chybách měl být jistič otevřený"
+    try:
+        breaker.before_request()
+        assert False, "Otevřený jistič měl request odmítnout"
+    except eth_price_alert.CircuitOpenError:
+        pass
+    
+    await asyncio.sleep(0.15)
+    assert not breaker.is_open(), "Po cooldownu se má poskytovatel znovu zkusit"
+    breaker.before_request()
+    assert breaker.state == 'half_open', "Po cooldownu měl jít zkušební request"
+    try:
+        breaker.before_request()
+        assert False, "V half_open smí běžet jen jeden zkušební request"
+    except eth_price_alert.CircuitOpenError:
+        pass
+    breaker.record_success()
+    assert breaker.state == 'closed', "Úspěšný zkušební request měl jistič zavřít"
+    
+    # Zrušený request, který nebyl zkušební, nesmí uvolnit běžící zkušební request
+    release = asyncio.Event()
+    
+    async def hanging_get(url, **kwargs):
+        await release.wait()
+    
+    session = eth_price_alert.ProviderSession('test_probe')
+    probe_breaker = eth_price_alert.get_circuit_breaker('test_probe')
+    with patch.object(session, 'get_async_client', return_value=Mock(get=hanging_get)):
+        loser = asyncio.create_task(session.async_get('http://127.0.0.1/'))
+        await asyncio.sleep(0.01)
+        probe_breaker.state, probe_breaker.opened_at = 'open', eth_price_alert.time.monotonic() - probe_breaker.cooldown
+        probe = asyncio.create_task(session.async_get('http://127.0.0.1/'))
+        await asyncio.sleep(0.01)
+        assert probe_breaker.state == 'half_open' and probe_breaker.probe_in_flight
+        loser.cancel()
+        await asyncio.gather(loser, return_exceptions=True)
+        assert probe_breaker.probe_in_flight, "Zrušený běžný request uvolnil cizí zkušební request"
+        probe.cancel()
+        await asyncio.gather(probe, return_exceptions=True)
+        assert not probe_breaker.probe_in_flight, "Zrušený zkušební request se měl uvolnit"
+    probe_breaker.record_success()
+    
+    # Otevřený jistič Yahoo -> async_get_stock_price vrátí hned None bez HTTP
+    yahoo = eth_price_alert.get_circuit_breaker('yahoo')
+    yahoo.state, yahoo.opened_at = 'open', eth_price_alert.time.monotonic()
+    with patch('eth_price_alert.async_get_json', AsyncMock()) as mock_get:
+        assert await eth_price_alert.async_get_stock_price('AAPL') == (None, None)
+        assert not mock_get.called, "Při otevřeném jističi nesmí odejít request"
+    yahoo.record_success()
+
+async def test_bulk_stock_prices():
+    """Test hromadného stažení cen akcií přes Yahoo quote."""
+    data = {'quoteResponse': {'result': [
+        {'symbol': 'AAPL', 'regularMarketPrice': 230.5},
+        {'symbol': 'TSLA', 'regularMarketPrice': 410},
+        {'symbol': 'XYZ'},
+    ]}}
+    with patch('eth_price_alert.async_get_json', AsyncMock(return_value=data)) as mock_get:
+        prices = await eth_price_alert.async_get_stock_prices_bulk(['AAPL', 'TSLA', 'XYZ'])
+    assert mock_get.await_count == 1, "Tři akcie se měly vejít do jednoho requestu"
+    assert 'symbols=AAPL,TSLA,XYZ' in mock_get.call_args[0][1], "Symboly měly jít v jednom seznamu"
+    assert prices == {'AAPL': 230.5, 'TSLA': 410.0}, f"Neočekávané ceny: {prices}"
+
+async def test_binance_snapshot():
+    """Test snapshotu celého Binance trhu indexovaného podle base assetu."""
+    snapshot = eth_price_alert.BinanceSnapshot()
+    snapshot._load_pairs({'symbols': [
+        {'symbol': 'BTCUSDT', 'baseAsset': 'BTC', 'quoteAsset': 'USDT', 'status': 'TRADING'},
+        {'symbol': 'BTCUSDC', 'baseAsset': 'BTC', 'quoteAsset': 'USDC', 'status': 'TRADING'},
+        {'symbol': 'PEPEUSDC', 'baseAsset': 'PEPE', 'quoteAsset': 'USDC', 'status': 'TRADING'},
+        {'symbol': 'ETHBTC', 'baseAsset': 'ETH', 'quoteAsset': 'BTC', 'status': 'TRADING'},
+        {'symbol': 'OLDUSDT', 'baseAsset': 'OLD', 'quoteAsset': 'USDT', 'status': 'BREAK'},
+    ]})
+    prices = snapshot._load_prices([
+        {'symbol': 'BTCUSDC', 'price': '95010.00'},
+        {'symbol': 'BTCUSDT', 'price': '95000.00'},
+        {'symbol': 'PEPEUSDC', 'price': '0.00001'},
+        {'symbol': 'ETHBTC', 'price': '0.03'},
+        {'symbol': 'OLDUSDT', 'price': '1.0'},
+    ])
+    assert prices == {'BTC': 95000.0, 'PEPE': 0.00001}, f"Neočekávaný snapshot: {prices}"
+    assert snapshot.pair_for('pepe') == 'PEPEUSDC', "Pár se měl najít i mimo USDT"
+    assert snapshot.pair_for('OLD') is None, "Neobchodovaný pár se nemá použít"
+    
+    with patch('eth_price_alert.BINANCE_SNAPSHOT', snapshot):
+        assert await eth_price_alert.async_get_price_from_binance('BTC') == (95000.0, 'Binance')
+        assert await eth_price_alert.async_get_price_from_binance('ZZZ') == (None, None)
+    
+    # async_refresh: exchangeInfo jen po vypršení TTL, ceny celého trhu jedním requestem
+    responses = {
+        eth_price_alert.BINANCE_EXCHANGE_INFO_URL: {'symbols': [
+            {'symbol': 'ETHUSDT', 'baseAsset': 'ETH', 'quoteAsset': 'USDT', 'status': 'TRADING'}]},
+        eth_price_alert.BINANCE_TICKER_ALL_URL: [{'symbol': 'ETHUSDT', 'price': '3000.5'}, {'symbol': 'BTCUSDT', 'price': '1'}],
+    }
+    snapshot = eth_price_alert.BinanceSnapshot()
+    with patch('eth_price_alert.async_get_json', AsyncMock(side_effect=lambda provider, url, **kwargs: responses[url])) as mock_get:
+        assert await snapshot.async_refresh() == {'ETH': 3000.5}, "BTCUSDT v exchangeInfo není, nemá se použít"
+        assert await snapshot.async_refresh() == {'ETH': 3000.5}
+    assert [c[0][1] for c in mock_get.call_args_list] == [eth_price_alert.BINANCE_EXCHANGE_INFO_URL] + [eth_price_alert.BINANCE_TICKER_ALL_URL] * 2
+    assert snapshot.is_fresh()
+
+async def test_price_cache():
+    """Test sdílené cache cen (TTL, LRU, single-flight)."""
+    fetches = 0
+    
+    async def slow_fetch():
+        nonlocal fetches
+        fetches += 1
+        await asyncio.sleep(0.05)
+        return 95000.0, 'crypto'
+    
+    cache = eth_price_alert.PriceCache(ttl=0.2, max_size=2)
+    results = await asyncio.gather(*(cache.async_get_or_fetch('BTC', None, slow_fetch) for _ in range(10)))
+    assert fetches == 1, f"Souběžné dotazy měly vyvolat jen jeden request, bylo jich {fetches}"
+    assert all(r == (95000.0, 'crypto') for r in results), "Všichni měli dostat stejnou cenu"
+    assert cache.lookup('btc') == (95000.0, 'crypto'), "Cena měla být v cache pod kryptoměnou"
+    
+    cache.put('AAPL', 'stock', 230.0)
+    cache.put('TSLA', 'stock', 410.0)
+    assert cache.lookup('BTC', 'crypto') is None, "Nejstarší záznam měl vypadnout (LRU)"
+    assert cache.stats()['evictions'] == 1
+    
+    await asyncio.sleep(0.25)
+    assert cache.lookup('AAPL', 'stock') is None, "Po TTL měla cena vypršet"
+    
+    with patch('eth_price_alert.PRICE_CACHE', cache), \
+         patch('eth_price_alert._async_fetch_price', AsyncMock(return_value=(3000.0, 'crypto'))) as mock_fetch:
+        assert await eth_price_alert.async_get_price('ETH') == (3000.0, 'crypto')
+        assert await eth_price_alert.async_get_price('ETH', 'crypto') == (3000.0, 'crypto')
+        assert mock_fetch.await_count == 1, "Druhý dotaz měl přijít z cache"
+
+async def test_price_stream():
+    """Test streamovacího režimu proti lokálnímu falešnému streamu."""
+    from fake_price_stream import serve_fake_stream
+    
+    prices = {'BTCUSDT': 95000.0, 'ETHUSDT': 3000.0}
+    server = await serve_fake_stream(port=0, interval=0.05, volatility=0, prices=prices)
+    port = next(iter(server.sockets)).getsockname()[1]
+    
+    full_config = {'111': {'BTC': {'name': 'Bitcoin', 'threshold': 0.05, 'asset_type': 'crypto'}}}
+    full_state = {'111': {'BTC': {'last_notification_price': 90000.0}}}
+    app = Mock()
+    app.bot.send_message = AsyncMock()
+    stop_event = asyncio.Event()
+    
+    store = eth_price_alert.DataStore()
+    store.config, store.state, store.loaded = full_config, full_state, True
+    
+    async def wait_for(condition, timeout=5):
+        for _ in range(int(timeout / 0.05)):
+            if condition():
+                return True
+            await asyncio.sleep(0.05)
         return False
+    
+    try:
+        with patch('eth_price_alert.PRICE_STREAM_URL', f'ws://127.0.0.1:{port}'), \
+             patch('eth_price_alert.STORE', store), \
+             patch('eth_price_alert.save_rows_batch', return_value={}), \
+             patch('eth_price_alert.save_state_changes') as mock_save:
+            task = asyncio.create_task(eth_price_alert.price_stream_loop(app, stop_event))
+            assert await wait_for(lambda: app.bot.send_message.called), "Tick BTC měl vyvolat alert (+5.6%)"
+            assert mock_save.called, "Nová cena notifikace se měla uložit"
+            
+            # Přidání ETH do configu -> stream se musí přihlásit k ETHUSDT
+            store.update_config({('111', 'ETH'): {'name': 'Ethereum', 'threshold': 0.05, 'asset_type': 'crypto'}})
+            assert await wait_for(lambda: 'ETH' in eth_price_alert.STREAM_PRICES), "Po změně configu měl přijít tick ETH"
+            
+            stop_event.set()
+            await asyncio.wait_for(task, timeout=5)
+        alert_text = app.bot.send_message.call_args.kwargs['text']
+        assert 'BTC' in alert_text and '95,000.00' in alert_text, f"Neočekávaný alert: {alert_text}"
+    finally:
+        stop_event.set()
+        server.close()
+        await server.wait_closed()
+
+async def test_token_bucket():
+    """Test token bucketu poskytovatele (burst, čekání, váhy endpointů)."""
+    import time
+    
+    bucket = eth_price_alert.TokenBucket('test', rate=20, burst=5)
+    started = time.monotonic()
+    for _ in range(5):
+        await bucket.async_acquire()
+    assert time.monotonic() - started < 0.05, "Burst měl projít bez čekání"
+    
+    started = time.monotonic()
+    await asyncio.gather(*(bucket.async_acquire() for _ in range(4)))
+    elapsed = time.monotonic() - started
+    assert 0.15 <= elapsed < 0.4, f"4 requesty nad burst měly čekat ~0.2s, čekaly {elapsed:.2f}s"
+    assert bucket.snapshot()['waits'] == 4
+    
+    assert eth_price_alert.endpoint_weight('binance', 'https://api.binance.com/api/v3/ticker/price') == 4
+    assert eth_price_alert.endpoint_weight('binance', 'https://api.binance.com/api/v3/ticker/price?symbol=BTCUSDT') == 2
+    assert eth_price_alert.endpoint_weight('yahoo', 'https://query1.finance.yahoo.com/v7/finance/quote?symbols=AAPL') == 1
+    with patch.dict(os.environ, {'RATE_LIMIT_TESTPROVIDER': '7/14'}):
+        limiter = eth_price_alert.get_rate_limiter('testprovider')
+    assert (limiter.rate, limiter.burst) == (7.0, 14.0), "Limit měl jít přepsat proměnnou prostředí"
+
+async def test_normalized_storage():
+    """Test řádkového ukládání (UPSERT/DELETE jen změněných řádků) a migrace z JSONB."""
+    import tempfile
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        config_file = os.path.join(tmp, 'config.json')
+        with open(config_file, 'w') as f:
+            json.dump({'1': {'BTC': {'threshold': 0.05, 'asset_type': 'crypto'}},
+                       '2': {'ETH': {'threshold': 0.1, 'asset_type': 'crypto'}}}, f)
+        with patch('eth_price_alert.DATABASE_URL', None), \
+             patch('eth_price_alert.CONFIG_FILE', config_file), \
+             patch('eth_price_alert.STORE', eth_price_alert.DataStore()):
+            user_config = eth_price_alert.get_user_config(1)
+            user_config['AAPL'] = {'threshold': 0.02, 'asset_type': 'stock'}
+            del user_config['BTC']
+            eth_price_alert.save_user_config(1, user_config, ['AAPL', 'BTC'])
+            saved = eth_price_alert.load_data('crypto_config', config_file)
+        assert saved['1'] == {'AAPL': {'threshold': 0.02, 'asset_type': 'stock'}}, saved
+        assert saved['2'] == {'ETH': {'threshold': 0.1, 'asset_type': 'crypto'}}, "Jiný uživatel se neměl změnit"
+    
+    # DB: zápis je UPSERT/DELETE jen změněných řádků, nikdy DELETE celé tabulky
+    statements = []
+    cur = MagicMock()
+    cur.execute.side_effect = lambda sql, params=None: statements.append(' '.join(sql.split()))
+    conn = MagicMock()
+    conn.closed = 0
+    conn.cursor.return_value = cur
+    batches = []
+    with patch('eth_price_alert.DB_POOL', eth_price_alert.DatabasePool('postgres://test', 1, 1)), \
+         patch('eth_price_alert.psycopg2.connect', return_value=conn), \
+         patch('eth_price_alert.execute_batch', side_effect=lambda c, sql, rows: batches.append((' '.join(sql.split()), rows))):
+        eth_price_alert.save_rows('crypto_state', 'unused.json', {
+            ('1', 'BTC'): {'last_notification_price': 95000.0},
+            ('1', 'ETH'): None,
+        })
+    assert conn.commit.called, "Změny měly být commitnuty"
+    assert batches[0][0].startswith('INSERT INTO alert_state') and 'ON CONFLICT (chat_id, symbol) DO UPDATE' in batches[0][0]
+    assert batches[0][1] == [(1, 'BTC', 95000.0)], batches[0][1]
+    assert batches[1] == ('DELETE FROM alert_state WHERE chat_id = %s AND symbol = %s', [(1, 'ETH')])
+    assert not statements, f"Nečekané SQL: {statements}"
+    
+    # Migrace z posledního JSONB řádku, jen jednou (podle schema_meta)
+    results = iter([None, ('crypto_config',), ({'1': {'BTC': {'threshold': 0.05, 'name': 'Bitcoin'}}},),
+                    ('crypto_state',), ({'1': {'BTC': {'last_notification_price': 90000.0}}},)])
+    cur = MagicMock()
+    cur.fetchone.side_effect = lambda: next(results)
+    batches.clear()
+    with patch('eth_price_alert.execute_batch', side_effect=lambda c, sql, rows: batches.append((' '.join(sql.split()), rows))):
+        eth_price_alert.migrate_jsonb_tables(cur)
+    assert batches[0][1] == [(1, 'BTC', 0.05, None, 'Bitcoin')], batches[0][1]
+    assert batches[1][1] == [(1, 'BTC', 90000.0)], batches[1][1]
+    assert "INSERT INTO schema_meta" in cur.execute.call_args_list[-1][0][0]
+    
+    cur = MagicMock()
+    cur.fetchone.return_value = ('2026-01-01T00:00:00',)
+    eth_price_alert.migrate_jsonb_tables(cur)
+    assert cur.execute.call_count == 1, "Hotová migrace se neměla opakovat"
+
+async def test_db_pool():
+    """Test poolu DB spojení (čekání na volné spojení, health check, reconnect po OperationalError)."""
+    import threading
+    import time
+    
+    def fake_connect(*args, **kwargs):
+        conn = MagicMock()
+        conn.closed = 0
+        return conn
+    
+    pool = eth_price_alert.DatabasePool('postgres://test', 1, 2, timeout=5)
+    with patch('eth_price_alert.DB_POOL', pool), \
+         patch('eth_price_alert.psycopg2.connect', side_effect=fake_connect) as mock_connect:
+        pool.open()
+        assert mock_connect.call_count == 1, "open() měl otevřít minconn spojení"
+        
+        threads = [threading.Thread(target=eth_price_alert.db_transaction, args=(lambda cur: time.sleep(0.1),))
+                   for _ in range(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        stats = pool.stats()
+        assert stats['connects'] == 2, f"Pool neměl překročit max 2 spojení: {stats}"
+        assert stats['waits'] >= 2 and stats['wait_max_ms'] >= 50, f"Volající nad max měli čekat: {stats}"
+        
+        # Spadlé spojení: OperationalError → zahodit a zkusit znovu s novým
+        calls = []
+        def flaky(cur):
+            calls.append(cur)
+            if len(calls) == 1:
+                raise eth_price_alert.OperationalError("server closed the connection unexpectedly")
+            return 'ok'
+        assert eth_price_alert.db_transaction(flaky) == 'ok'
+        assert pool.stats()['reconnects'] == 1
+        
+        # Chyba při commitu se neopakuje (commit mohl na server dojít), spojení se zahodí
+        calls = []
+        failing_commit = fake_connect()
+        failing_commit.commit.side_effect = eth_price_alert.OperationalError("server closed the connection unexpectedly")
+        with patch.object(pool, 'getconn', return_value=failing_commit), patch.object(pool, 'putconn') as mock_put:
+            try:
+                eth_price_alert.db_transaction(lambda cur: calls.append(cur))
+                assert False, "Chyba commitu se měla propagovat"
+            except eth_price_alert.OperationalError:
+                pass
+        assert len(calls) == 1, "Po chybě commitu se dávka nesměla spustit znovu"
+        assert mock_put.call_args.kwargs['broken'] is True
+        
+        # Spojení, které nejde otevřít, se zkusí otevřít ještě jednou
+        with patch.object(pool, 'getconn', side_effect=[eth_price_alert.OperationalError("could not connect"), fake_connect()]), \
+             patch.object(pool, 'putconn'):
+            assert eth_price_alert.db_transaction(lambda cur: 'ok') == 'ok'
+        
+        # Zavřené spojení v poolu neprojde kontrolou a nahradí se
+        for conn, _ in pool._idle:
+            conn.closed = 1
+        before = pool.stats()['connects']
+        conn = pool.getconn()
+        assert not conn.closed and pool.stats()['connects'] == before + 1
+        pool.putconn(conn)
+        assert pool.stats()['size'] <= 2
+
+async def test_data_store():
+    """Test paměťového úložiště (jedno načtení, čtení z paměti, zápis skrz)."""
+    data = {
+        'crypto_config': {'1': {'BTC': {'name': 'Bitcoin', 'threshold': 0.05, 'asset_type': 'crypto'}}},
+        'crypto_state': {'1': {'BTC': {'last_notification_price': 90000.0}}},
+    }
+    store = eth_price_alert.DataStore()
+    with patch('eth_price_alert.STORE', store), \
+         patch('eth_price_alert.load_data', side_effect=lambda table, file, versions: json.loads(json.dumps(data[table]))) as mock_load, \
+         patch('eth_price_alert.save_rows_batch', return_value={}) as mock_save:
+        for _ in range(3):
+            user_config = eth_price_alert.get_user_config(1)
+            user_state = eth_price_alert.get_user_state(1)
+        assert mock_load.call_count == 2, f"Data se měla načíst jen jednou, load_data volán {mock_load.call_count}x"
+        
+        user_config['BTC']['threshold'] = 0.5
+        assert store.config['1']['BTC']['threshold'] == 0.05, "Úprava kopie nesmí změnit store bez uložení"
+        
+        version = store.symbols.version
+        user_config['ETH'] = {'name': 'Ethereum', 'threshold': 0.1, 'asset_type': 'crypto'}
+        eth_price_alert.save_user_config(1, user_config, ['ETH'])
+        assert mock_save.call_args[0][0] == {('crypto_config', eth_price_alert.CONFIG_FILE): {('1', 'ETH'): user_config['ETH']}}
+        assert eth_price_alert.get_user_config(1)['ETH']['threshold'] == 0.1
+        assert store.symbols.version == version + 1, "Nový symbol měl zvýšit verzi registru"
+        
+        del user_config['BTC']
+        eth_price_alert.save_user_config(1, user_config, ['BTC'])
+        assert 'BTC' not in store.config['1']
+        assert mock_save.call_args[0][0] == {('crypto_config', eth_price_alert.CONFIG_FILE): {('1', 'BTC'): None}}
+        assert user_state['BTC']['last_notification_price'] == 90000.0
+        assert mock_load.call_count == 2
+
+async def test_file_journal():
+    """Test souborového fallbacku: změny jako append do journalu, kompaktace, poškozený řádek."""
+    import tempfile
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        state_file = os.path.join(tmp, 'state.json')
+        journal = state_file + '.journal'
+        with patch('eth_price_alert.DB_POOL', None), \
+             patch('eth_price_alert.JOURNAL_COMPACT_EVERY', 4):
+            eth_price_alert.save_data('crypto_state', state_file, {'1': {'BTC': {'last_notification_price': 1.0}}})
+            snapshot = open(state_file).read()
+            
+            eth_price_alert.save_rows('crypto_state', state_file, {('1', 'BTC'): {'last_notification_price': 2.0},
+                                                                   ('2', 'ETH'): {'last_notification_price': 3.0}})
+            assert open(state_file).read() == snapshot, "Změna neměla přepsat snapshot"
+            assert len(open(journal).readlines()) == 2, "Každý změněný řádek = jeden záznam v journalu"
+            assert eth_price_alert.load_data('crypto_state', state_file) == {
+                '1': {'BTC': {'last_notification_price': 2.0}}, '2': {'ETH': {'last_notification_price': 3.0}}}
+            
+            # Nedopsaný řádek (pád během zápisu) se přeskočí a journal se zkompaktuje
+            with open(journal, 'a') as f:
+                f.write('{"c":"2","s":"ET')
+            assert eth_price_alert.load_data('crypto_state', state_file)['2']['ETH'] == {'last_notification_price': 3.0}
+            assert not os.path.exists(journal), "Poškozený journal se měl zkompaktovat"
+            
+            for price in (4.0, 5.0, 6.0, 7.0):
+                eth_price_alert.save_rows('crypto_state', state_file, {('1', 'BTC'): {'last_notification_price': price}})
+            assert not os.path.exists(journal), "Po 4 záznamech se měl journal zkompaktovat"
+            with open(state_file) as f:
+                assert json.load(f)['1']['BTC'] == {'last_notification_price': 7.0}
+            eth_price_alert.save_rows('crypto_state', state_file, {('2', 'ETH'): None})
+            assert eth_price_alert.load_data('crypto_state', state_file) == {
+                '1': {'BTC': {'last_notification_price': 7.0}}, '2': {}}
+
+async def test_write_behind_queue():
+    """Test odloženého zápisu (sloučení změn v okně, jeden flush, flush při ukončení)."""
+    queue = eth_price_alert.WriteBehindQueue(window=0.1)
+    stop_event = asyncio.Event()
+    with patch('eth_price_alert.save_rows_batch', return_value={}) as mock_batch:
+        task = asyncio.create_task(queue.run(stop_event))
+        await asyncio.sleep(0)
+        for i in range(50):
+            queue.submit('crypto_config', 'config.json', {(str(i % 5), 'BTC'): {'threshold': i / 100}})
+        queue.submit('crypto_state', 'state.json', {('1', 'BTC'): {'last_notification_price': 1.0}})
+        assert queue.stats()['depth'] == 6 and not mock_batch.called, "Změny měly čekat ve frontě"
+        
+        await asyncio.sleep(0.3)
+        assert mock_batch.call_count == 1, f"Očekáván jeden flush, bylo {mock_batch.call_count}"
+        batch = mock_batch.call_args[0][0]
+        assert len(batch[('crypto_config', 'config.json')]) == 5
+        assert batch[('crypto_config', 'config.json')][('4', 'BTC')] == {'threshold': 0.49}, "Měla vyhrát poslední hodnota"
+        assert batch[('crypto_state', 'state.json')] == {('1', 'BTC'): {'last_notification_price': 1.0}}
+        stats = queue.stats()
+        assert stats['depth'] == 0 and stats['coalesced'] == 45 and stats['flushed_rows'] == 6, stats
+        
+        # Při ukončení se čekající změny uloží a další zápisy jdou hned
+        queue.submit('crypto_state', 'state.json', {('2', 'ETH'): None})
+        stop_event.set()
+        await asyncio.wait_for(task, timeout=5)
+        assert mock_batch.call_count == 2 and mock_batch.call_args[0][0] == {('crypto_state', 'state.json'): {('2', 'ETH'): None}}
+        queue.submit('crypto_state', 'state.json', {('3', 'ETH'): None})
+        assert mock_batch.call_count == 3 and mock_batch.call_args[0][0] == {('crypto_state', 'state.json'): {('3', 'ETH'): None}}
+
+async def test_storage_off_event_loop():
+    """Test, že pomalé úložiště neblokuje event loop (zápis ve vlákně úložiště, měření zpoždění loopu)."""
+    import threading
+    import time
+    
+    flush_threads = []
+    def slow_save(batch, versions=None, fields=None):
+        flush_threads.append(threading.current_thread().name)
+        time.sleep(0.3)  # Pomalá DB
+        return {}
+    
+    queue = eth_price_alert.WriteBehindQueue(window=0.01)
+    monitor = eth_price_alert.EventLoopLagMonitor(interval=0.01)
+    stop_event = asyncio.Event()
+    with patch('eth_price_alert.save_rows_batch', side_effect=slow_save):
+        tasks = [asyncio.create_task(queue.run(stop_event)), asyncio.create_task(monitor.run(stop_event))]
+        await asyncio.sleep(0.05)
+        for i in range(3):
+            queue.submit('crypto_state', 'state.json', {(str(i), 'BTC'): {'last_notification_price': 1.0}})
+            await asyncio.sleep(0.2)
+        await asyncio.sleep(0.3)
+        stop_event.set()
+        await asyncio.wait_for(asyncio.gather(*tasks), timeout=5)
+    stats = monitor.stats()
+    assert flush_threads and all(name.startswith('storage') for name in flush_threads), flush_threads
+    assert queue.stats()['flush_max_ms'] >= 300, queue.stats()
+    assert stats['max_ms'] < 100, f"Event loop byl blokován: {stats}"
+    
+    # Ukončení v event loopu (post_shutdown): aclose() uloží čekající změny bez blokování, close() tam nejde
+    queue = eth_price_alert.WriteBehindQueue(window=60)
+    monitor = eth_price_alert.EventLoopLagMonitor(interval=0.01)
+    stop_event = asyncio.Event()
+    flush_threads.clear()
+    with patch('eth_price_alert.save_rows_batch', side_effect=slow_save):
+        tasks = [asyncio.create_task(queue.run(stop_event)), asyncio.create_task(monitor.run(stop_event))]
+        await asyncio.sleep(0.05)
+        queue.submit('crypto_state', 'state.json', {('9', 'BTC'): {'last_notification_price': 1.0}})
+        await queue.aclose()
+        assert len(flush_threads) == 1 and not queue.running and queue.stats()['depth'] == 0
+        try:
+            queue.close()
+            assert False, "Blokující close() se v event loopu nemá dát zavolat"
+        except RuntimeError:
+            pass
+        tasks[0].cancel()
+        stop_event.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    assert len(flush_threads) == 1, "Task neměl po aclose() nic dalšího ukládat"
+    stats = monitor.stats()
+    assert stats['max_ms'] < 100, f"aclose() blokoval event loop: {stats}"
+
+async def test_atomic_snapshot_files():
+    """Test atomického zápisu snapshotu, binárního formátu s CRC a hlášení poškozeného souboru."""
+    import tempfile
+    
+    data = {'1': {'BTC': {'name': 'Bitcoin', 'threshold': 0.05, 'asset_type': 'crypto'}}}
+    with tempfile.TemporaryDirectory() as tmp:
+        config_file = os.path.join(tmp, 'config.json')
+        with patch('eth_price_alert.DB_POOL', None):
+            eth_price_alert.save_data('crypto_config', config_file, data)
+            assert sorted(os.listdir(tmp)) == ['config.json'], f"Po zápisu nemá zůstat dočasný soubor: {os.listdir(tmp)}"
+            
+            # Binární formát: .bin s řádky pevné délky, JSON snapshot se při přechodu ještě přečte
+            with patch('eth_price_alert.STORAGE_FILE_FORMAT', 'binary'):
+                assert eth_price_alert.load_data('crypto_config', config_file) == data
+                eth_price_alert.save_data('crypto_config', config_file, data)
+                bin_file = os.path.join(tmp, 'config.bin')
+                raw = open(bin_file, 'rb').read()
+                magic, version, count, names_length, _ = eth_price_alert.SNAPSHOT_HEADER.unpack_from(raw, 0)
+                assert (magic, version, count, names_length) == (b'EPAS', 2, 1, len('Bitcoin'))
+                assert len(raw) == eth_price_alert.SNAPSHOT_HEADER.size + eth_price_alert.SNAPSHOT_ROW.size + names_length
+                row = eth_price_alert.SNAPSHOT_ROW.unpack_from(raw, eth_price_alert.SNAPSHOT_HEADER.size)
+                assert row[:2] == (1, b'BTC'.ljust(16, b'\0')) and row[3] == 0.05, f"Neočekávaný záznam: {row}"
+                assert eth_price_alert.load_data('crypto_config', config_file) == data
+                
+                # Stav i None hodnoty projdou beze změny; co se do záznamu nevejde, uloží se jako JSON
+                state = {'-100123': {'ETH': {'last_notification_price': 3000.5}, 'AAPL': {'last_notification_price': None}}}
+                state_file = os.path.join(tmp, 'state.bin')
+                eth_price_alert.write_snapshot(state_file, state)
+                assert eth_price_alert.read_snapshot(state_file) == state
+                odd = {'1': {'X' * 20: {'threshold': 0.05}}}
+                eth_price_alert.write_snapshot(state_file, odd)
+                assert eth_price_alert.read_snapshot(state_file) == odd
+                
+                with open(bin_file, 'r+b') as f:
+                    f.seek(-3, os.SEEK_END)
+                    f.write(b'XYZ')
+                try:
+                    eth_price_alert.load_data('crypto_config', config_file)
+                    raise AssertionError("Poškozené CRC se nesmí načíst jako prázdná data")
+                except eth_price_alert.CorruptDataError:
+                    pass
+                assert any(name.startswith('config.bin.corrupt-') for name in os.listdir(tmp)), "Chybí kopie poškozeného souboru"
+                os.remove(bin_file)
+            
+            # Přepnutí json -> binary -> json nesmí ztratit změny zapsané v binárním formátu
+            eth_price_alert.save_data('crypto_config', config_file, data)
+            changed = {'1': {'BTC': dict(data['1']['BTC'], threshold=0.1)}}
+            with patch('eth_price_alert.STORAGE_FILE_FORMAT', 'binary'):
+                eth_price_alert.save_data('crypto_config', config_file, changed)
+                assert not os.path.exists(config_file), "Snapshot ve starém formátu se měl po zápisu smazat"
+            # Starší snapshot, který po pádu mezi zápisem a smazáním zůstal ležet, nevyhraje
+            eth_price_alert.write_snapshot(config_file, data)
+            os.utime(config_file, (0, 0))
+            assert eth_price_alert.load_data('crypto_config', config_file) == changed
+            eth_price_alert.save_data('crypto_config', config_file, data)
+            assert not os.path.exists(bin_file)
+            assert eth_price_alert.load_data('crypto_config', config_file) == data
+            
+            # Nedopsaný JSON snapshot také není "prázdný config"
+            with open(config_file, 'w') as f:
+                f.write('{"1": {"BTC": {"name": "Bitc')
+            try:
+                eth_price_alert.load_data('crypto_config', config_file)
+                raise AssertionError("Nedopsaný JSON se nesmí načíst jako prázdná data")
+            except eth_price_alert.CorruptDataError:
+                pass
+
+async def test_asset_type_migration():
+    """Test jednorázové migrace asset_type při startu (handlery už nic neklasifikují)."""
+    import tempfile
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        store = eth_price_alert.DataStore()
+        store.config = {
+            '1': {'BTC': {'name': 'Bitcoin', 'threshold': 0.05}, 'AAPL': {'name': 'Apple', 'threshold': 0.05}},
+            '2': {'ETH': {'name': 'Ethereum', 'threshold': 0.1, 'asset_type': 'crypto'}},
+        }
+        store.loaded = True
+        with patch('eth_price_alert.DB_POOL', None), \
+             patch('eth_price_alert.SCHEMA_META_FILE', os.path.join(tmp, 'schema_meta.json')), \
+             patch('eth_price_alert.STORE', store), \
+             patch('eth_price_alert.save_rows_batch', return_value={}) as mock_save, \
+             patch('eth_price_alert.is_crypto_ticker', side_effect=lambda s: s in ('BTC', 'ETH')) as mock_classify:
+            assert eth_price_alert.migrate_asset_types(store) == 2
+            assert store.config['1']['BTC']['asset_type'] == 'crypto' and store.config['1']['AAPL']['asset_type'] == 'stock'
+            assert mock_save.call_count == 1, "Migrace měla uložit obě změny najednou"
+            assert len(mock_save.call_args[0][0][('crypto_config', eth_price_alert.CONFIG_FILE)]) == 2
+            assert eth_price_alert.get_schema_version() == eth_price_alert.SCHEMA_VERSION
+            
+            # Druhý start: označeno jako hotové, nic se neklasifikuje ani neukládá
+            store.config['1']['DOGE'] = {'name': 'Doge', 'threshold': 0.05}
+            mock_classify.reset_mock()
+            assert eth_price_alert.migrate_asset_types(store) == 0 and not mock_classify.called
+            
+            # Handler jen čte z paměti
+            assert 'asset_type' not in eth_price_alert.get_user_config(1)['DOGE'] and not mock_classify.called
+            
+            # --migrate (force) doběhne znovu
+            assert eth_price_alert.migrate_asset_types(store, force=True) == 1
+            assert store.config['1']['DOGE']['asset_type'] == 'stock'
+
+async def test_optimistic_concurrency():
+    """Test zápisu s verzemi řádků (compare-and-swap, sloučení polí při konfliktu) a souběžných úprav chatu."""
+    columns = ('threshold', 'asset_type', 'name')
+    # Řádky v "DB": jiný proces mezitím změnil název BTC (verze 3) a založil ETH
+    db = {
+        (1, 'BTC'): {'version': 3, 'threshold': 0.05, 'asset_type': 'crypto', 'name': 'Bitcoin (jiný proces)'},
+        (1, 'ETH'): {'version': 0, 'threshold': 0.2, 'asset_type': 'crypto', 'name': 'Ethereum'},
+    }
+    
+    def fake_execute_values(cur, sql, argslist, template=None, page_size=100, fetch=False):
+        statement, returned = sql.split()[0], []
+        for row in argslist:
+            key = tuple(row[:2])
+            if statement == 'UPDATE' and key in db and db[key]['version'] == row[2]:
+                db[key].update(zip(columns, row[3:]), version=row[2] + 1)
+                returned.append(key + (db[key]['version'],))
+            elif statement == 'INSERT' and key not in db:
+                db[key] = dict(zip(columns, row[2:]), version=0)
+                returned.append(key + (0,))
+            elif statement == 'SELECT' and key in db:
+                returned.append(key + (db[key]['version'],) + tuple(db[key][c] for c in columns))
+        return returned
+    
+    store = eth_price_alert.DataStore()
+    store.config = {'1': {'BTC': {'name': 'Bitcoin', 'threshold': 0.05, 'asset_type': 'crypto'}}}
+    store.versions['crypto_config'] = {('1', 'BTC'): 2}
+    store.loaded = True
+    with patch('eth_price_alert.STORE', store), \
+         patch('eth_price_alert.DB_POOL', MagicMock()), \
+         patch('eth_price_alert.db_transaction', side_effect=lambda fn: fn(MagicMock())), \
+         patch('eth_price_alert.execute_values', side_effect=fake_execute_values):
+        store.update_config({
+            ('1', 'BTC'): {'name': 'Bitcoin', 'threshold': 0.1, 'asset_type': 'crypto'},
+            ('1', 'ETH'): {'name': 'Ethereum', 'threshold': 0.03, 'asset_type': 'crypto'},
+        })
+    assert db[(1, 'BTC')] == {'version': 4, 'threshold': 0.1, 'asset_type': 'crypto', 'name': 'Bitcoin (jiný proces)'}, \
+        f"Naše pole (threshold) a cizí pole (name) se měla sloučit: {db[(1, 'BTC')]}"
+    assert db[(1, 'ETH')]['version'] == 1 and db[(1, 'ETH')]['threshold'] == 0.03
+    assert store.versions['crypto_config'] == {('1', 'BTC'): 4, ('1', 'ETH'): 1}
+    assert store.config['1']['BTC']['name'] == 'Bitcoin (jiný proces)', "Cizí změna se měla promítnout do paměti"
+    
+    # Souběžné úpravy téhož chatu se neztratí (čtení -> změna -> uložení v handleru neobsahuje await)
+    async def add(symbol, text):
+        update = MockUpdate(message_text=text)
+        context = MockContext()
+        context.user_data.update(pending_symbol=symbol, pending_name=symbol, pending_price=1.0, pending_asset_type='crypto')
+        await handle_threshold(update, context)
+    with isolated_store() as store:
+        await asyncio.gather(add('BTC', '5'), add('ETH', '7'), remove_crypto(MockUpdate(args=['XRP']), MockContext(['XRP'])))
+        assert {s: c['threshold'] for s, c in store.config['12345'].items()} == {'BTC': 0.05, 'ETH': 0.07}
+
+async def test_price_history():
+    """Test historie cen (hromadné ukládání, agregace 1m/1h/1d, mazání starých ticků)."""
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        backend = eth_price_alert.SqliteHistoryBackend(os.path.join(tmp, 'history.sqlite3'))
+        history = eth_price_alert.PriceHistory(backend, raw_horizon=3600, rollup_every=10 ** 9)
+        base = 1_700_000_000 - 1_700_000_000 % 86400  # Začátek dne
+        for i, price in enumerate([100.0, 105.0, 95.0, 101.0]):
+            history.record({'BTC': price, 'ETH': price / 10, 'XRP': None}, now=base + i * 20)
+        assert history.ticks_written == 8, f"Ceny bez hodnoty se neukládají: {history.ticks_written}"
+        assert history.price_at('BTC', base + 25) == 105.0
+        assert history.price_at('BTC', base - 1) is None
+        
+        # Agregace bere jen dokončené minuty: ticky 0/20/40 do první minuty, 60 čeká
+        history.roll_up(now=base + 70)
+        assert history.series('BTC', base, '1m') == [(base, 100.0, 105.0, 95.0, 95.0)]
+        history.roll_up(now=base + 130)
+        assert history.series('BTC', base, '1m')[1] == (base + 60, 101.0, 101.0, 101.0, 101.0)
+        assert history.series('BTC', base, '1h') == [(base, 100.0, 105.0, 95.0, 101.0)], \
+            "Hodinový bucket se měl sloučit z obou agregací"
+        assert history.series('ETH', base, '1d')[0][2] == 10.5
+        
+        # Po uplynutí horizontu zůstanou jen agregace a price_at z nich odpovídá
+        history.roll_up(now=base + 2 * 3600)
+        assert history.ticks_pruned == 8, f"Staré ticky se měly smazat: {history.ticks_pruned}"
+        assert history.price_at('BTC', base + 90) == 101.0
+        assert history.stats()['backend'] == 'sqlite'
+        
+        # /history čte z uložené historie: poslední tick, agregace před hodinou, rozpětí z hodinových agregací
+        now = base + 2 * 3600
+        history.record({'BTC': 110.0}, now=now)
+        update = MockUpdate(args=['btc'])
+        with patch('eth_price_alert.PRICE_HISTORY', history), patch('eth_price_alert.time.time', return_value=now + 1):
+            await eth_price_alert.history_command(update, MockContext(['btc']))
+            assert reply_text(update).split('\n') == [
+                '🕰️ <b>BTC</b>: $110.00', '• 1h: +8.91% ($101.00)', '• 24h: ?', '• 7d: ?', '• 24h rozpětí: $95.00 - $105.00'
+            ], reply_text(update)
+            await eth_price_alert.history_command(update, MockContext(['DOGE']))
+            assert 'zatím nemám historii' in reply_text(update)
+        with patch('eth_price_alert.PRICE_HISTORY', None):
+            await eth_price_alert.history_command(update, MockContext(['BTC']))
+            assert 'není k dispozici' in reply_text(update)
+        backend.conn.close()
+
+async def test_threshold_index():
+    """Test indexu prahů (stejné alerty jako průchod všemi odběry, údržba při změnách)."""
+    import random
+    rng = random.Random(7)
+    symbols = ['BTC', 'ETH', 'SOL', 'AAPL']
+    config, state = {}, {}
+    for chat in range(1, 200):
+        for symbol in rng.sample(symbols, 2):
+            config.setdefault(str(chat), {})[symbol] = {'name': symbol, 'threshold': rng.choice([0.01, 0.05, 0.1])}
+            if chat % 10:
+                state.setdefault(str(chat), {})[symbol] = {'last_notification_price': rng.uniform(90, 110)}
+    prices = {'BTC': 100.0, 'ETH': 105.0, 'SOL': 91.0}  # AAPL bez ceny
+    
+    async def run(index):
+        app = MagicMock()
+        app.bot.send_message = AsyncMock()
+        full_state = json.loads(json.dumps(state))
+        # Stovky alertů: limity Telegramu tu neověřujeme (viz test dispatcheru)
+        delivered = set()
+        with patch('eth_price_alert.NOTIFIER', eth_price_alert.NotificationDispatcher(global_rate=1e6, chat_rate=1e6)):
+            changed = await eth_price_alert.evaluate_alerts(app, prices, config, full_state, verbose=False, index=index,
+                                                            on_delivered=delivered.update)
+        sent = sorted((c.kwargs['chat_id'], c.kwargs['text']) for c in app.bot.send_message.call_args_list)
+        return changed | delivered, sent, full_state
+    
+    index = eth_price_alert.ThresholdIndex()
+    index.rebuild(config, state)
+    assert await run(None) == await run(index), "Index musí dát stejné alerty i změny stavu jako plný průchod"
+    assert len(index.candidates('BTC', 100.0)) < index.subscriptions('BTC')
+    
+    # Údržba přes DataStore: /add, odeslaný alert, /remove
+    store = eth_price_alert.DataStore()
+    store.config = {'1': {'BTC': {'name': 'Bitcoin', 'threshold': 0.1}}}
+    store.state = {'1': {'BTC': {'last_notification_price': 100.0}}}
+    store.loaded = True
+    with patch('eth_price_alert.STORE', store), \
+         patch('eth_price_alert.save_rows_batch', return_value={}):
+        index = store.threshold_index()
+        assert index.candidates('BTC', 109.0) == [] and index.candidates('BTC', 110.0) == ['1']
+        store.update_config({('2', 'BTC'): {'name': 'Bitcoin', 'threshold': 0.05}})
+        assert index.candidates('BTC', 100.0) == ['2'], "Nový odběr bez ceny je kandidát"
+        store.state['2'] = {'BTC': {'last_notification_price': 100.0}}
+        store.persist_state([('2', 'BTC')])
+        assert index.candidates('BTC', 94.0) == ['2']
+        store.update_config({('1', 'BTC'): {'name': 'Bitcoin', 'threshold': 0.01}})
+        assert sorted(index.candidates('BTC', 101.0)) == ['1']
+        store.update_config({('1', 'BTC'): None, ('2', 'BTC'): None})
+        assert index.candidates('BTC', 1.0) == [] and index.subscriptions() == 0
+
+async def test_numpy_alert_engine():
+    """Test NumPy enginu (stejní kandidáti jako index prahů, sloupce sledují změny)."""
+    if eth_price_alert.np is None:
+        print("   ⏭️  numpy není nainstalované, přeskočeno\n")
+        return
+    import random
+    rng = random.Random(3)
+    config, state = {}, {}
+    for chat in range(1, 300):
+        for symbol in rng.sample(['BTC', 'ETH', 'SOL', 'AAPL'], 2):
+            config.setdefault(str(chat), {})[symbol] = {'threshold': rng.choice([0.01, 0.05])}
+            if chat % 7:
+                state.setdefault(str(chat), {})[symbol] = {'last_notification_price': rng.uniform(95, 105)}
+    config['@kanal'] = {'BTC': {'threshold': 0.01}}  # Nečíselný klíč chatu zvládá i souborové úložiště
+    prices = {'BTC': 100.0, 'ETH': 103.0, 'SOL': 96.0}
+    
+    engine = eth_price_alert.NumpyAlertEngine(capacity=4)
+    engine.rebuild(config, state)
+    index = eth_price_alert.ThresholdIndex()
+    index.rebuild(config, state)
+    assert sorted(engine.triggered(prices)) == sorted(index.triggered(prices))
+    
+    # Přidání (růst polí), změna, smazání (přesun posledního řádku) i první cena
+    for chat in range(1, 300, 3):
+        config[str(chat)].pop(next(iter(config[str(chat)])))
+        config.setdefault(str(chat + 1000), {})['BTC'] = {'threshold': 0.02}
+    config['kanal-2'] = {'ETH': {'threshold': 0.02}}
+    state['2'] = {s: {'last_notification_price': 100.0} for s in config['2']}
+    keys = [(c, s) for c in list(config) for s in ['BTC', 'ETH', 'SOL', 'AAPL']]
+    engine.refresh(keys, config, state)
+    index.refresh(keys, config, state)
+    assert engine.subscriptions() == index.subscriptions() == sum(len(c) for c in config.values())
+    assert sorted(engine.triggered(prices)) == sorted(index.triggered(prices))
+    assert engine.subscriptions('AAPL') == index.subscriptions('AAPL')
+    
+    with patch('eth_price_alert.ALERT_ENGINE', 'numpy'):
+        assert isinstance(eth_price_alert.DataStore().index, eth_price_alert.NumpyAlertEngine)
+
+async def test_symbol_registry():
+    """Test registru symbolů (počty odběratelů, typ, okamžité odebrání, /symbols)."""
+    store = eth_price_alert.DataStore()
+    store.config = {
+        '1': {'BTC': {'threshold': 0.05, 'asset_type': 'crypto'}, 'AAPL': {'threshold': 0.05, 'asset_type': 'stock'}},
+        '2': {'BTC': {'threshold': 0.1, 'asset_type': 'crypto'}},
+    }
+    store.loaded = True
+    with patch('eth_price_alert.STORE', store), \
+         patch('eth_price_alert.save_rows_batch', return_value={}):
+        registry = store.symbol_registry()
+        assert registry.symbol_types == {'BTC': 'crypto', 'AAPL': 'stock'}
+        assert registry.subscribers('BTC') == 2
+        
+        version = registry.version
+        store.update_config({('3', 'DOGE'): {'threshold': 0.05}})
+        assert registry.symbol_types['DOGE'] is None, "Bez typu se symbol detekuje automaticky"
+        store.update_config({('3', 'DOGE'): {'threshold': 0.05, 'asset_type': 'crypto'}})
+        assert registry.symbol_types['DOGE'] == 'crypto' and registry.subscribers('DOGE') == 1
+        store.update_config({('1', 'BTC'): {'threshold': 0.2, 'asset_type': 'crypto'}})
+        assert registry.subscribers('BTC') == 2, "Změna prahu nemění počet odběratelů"
+        store.update_config({('1', 'AAPL'): None})
+        assert 'AAPL' not in registry.symbol_types, "Symbol bez odběratelů se má hned odebrat"
+        assert registry.version > version
+        
+        update = MagicMock()
+        update.effective_chat.id = 42
+        update.message.reply_text = AsyncMock()
+        with patch('eth_price_alert.ADMIN_CHAT_ID', '42'):
+            await eth_price_alert.symbols_command(update, MagicMock())
+        text = update.message.reply_text.call_args[0][0]
+        assert '<b>BTC</b>: 2 odběratelů' in text and 'DOGE' in text and 'AAPL' not in text, text
+        update.effective_chat.id = 7
+        with patch('eth_price_alert.ADMIN_CHAT_ID', '42'):
+            await eth_price_alert.symbols_command(update, MagicMock())
+        assert 'jen pro admina' in update.message.reply_text.call_args[0][0]
+
+async def test_notification_dispatcher():
+    """Test dispatcheru notifikací (jedna zpráva na chat, limity, RetryAfter, fronta, stav až po doručení)."""
+    import time
+    from telegram.error import RetryAfter
+    config = {
+        '1': {'BTC': {'name': 'Bitcoin', 'threshold': 0.05}, 'ETH': {'name': 'Ethereum', 'threshold': 0.05}},
+        '2': {'BTC': {'name': 'Bitcoin', 'threshold': 0.05}},
+    }
+    state = {'1': {'BTC': {'last_notification_price': 100.0}, 'ETH': {'last_notification_price': 10.0}},
+             '2': {'BTC': {'last_notification_price': 100.0}}}
+    prices = {'BTC': 110.0, 'ETH': 9.0}
+    app = MagicMock()
+    # Chat 1: nejdřív flood control, pak doručeno; chat 2: zablokovaný bot
+    async def send(chat_id, text, parse_mode):
+        if chat_id == 2:
+            raise Exception('Forbidden: bot was blocked by the user')
+        if send.flood:
+            send.flood = False
+            raise RetryAfter(0.1)
+    send.flood = True
+    app.bot.send_message = AsyncMock(side_effect=send)
+    
+    dispatcher = eth_price_alert.NotificationDispatcher()
+    delivered = set()
+    with patch('eth_price_alert.NOTIFIER', dispatcher):
+        changed = await eth_price_alert.evaluate_alerts(app, prices, config, state, verbose=False, on_delivered=delivered.update)
+    texts = [c.kwargs['text'] for c in app.bot.send_message.call_args_list if c.kwargs['chat_id'] == 1]
+    assert len(texts) == 2 and texts[0] == texts[1], "Chat 1 měl dostat jednu sloučenou zprávu (2 pokusy)"
+    assert 'BTC' in texts[0] and 'ETH' in texts[0] and '2 upozornění' in texts[0]
+    assert changed == set() and delivered == {('1', 'BTC'), ('1', 'ETH')}, f"Stav jen po doručení: {delivered}"
+    assert state['1']['BTC']['last_notification_price'] == 110.0
+    assert state['2']['BTC']['last_notification_price'] == 100.0, "Nedoručený alert nesmí změnit stav"
+    assert dispatcher.stats()['retries'] == 1 and dispatcher.stats()['failed'] == 1
+    
+    # Globální limit: 25 chatů při 20 zprávách/s -> 5 zpráv čeká na tokeny
+    dispatcher = eth_price_alert.NotificationDispatcher(global_rate=20)
+    app.bot.send_message = AsyncMock()
+    started = time.monotonic()
+    delivered = await dispatcher.deliver(app, {str(chat): [('BTC', 'x')] for chat in range(25)})
+    elapsed = time.monotonic() - started
+    assert len(delivered) == 25 and 0.2 <= elapsed < 0.6, f"Měl čekat ~0.25s, čekal {elapsed:.2f}s"
+    
+    # Per-chat limit
+    started = time.monotonic()
+    await dispatcher.deliver(app, {'0': [('BTC', 'y')]})
+    assert time.monotonic() - started >= 0.5, "Druhá zpráva do stejného chatu měla čekat na per-chat limit"
+    
+    # Fronta s background taskem: vyhodnocení na odeslání nečeká, alert v odesílání další tick nespustí znovu
+    release = asyncio.Event()
+    async def slow_send(**kwargs):
+        await release.wait()
+    app.bot.send_message = AsyncMock(side_effect=slow_send)
+    state = {'2': {'BTC': {'last_notification_price': 100.0}}}
+    dispatcher = eth_price_alert.NotificationDispatcher()
+    stop_event = asyncio.Event()
+    sender_task = asyncio.create_task(dispatcher.run(stop_event))
+    await asyncio.sleep(0)
+    delivered = []
+    with patch('eth_price_alert.NOTIFIER', dispatcher):
+        for _ in range(2):
+            tick = eth_price_alert.evaluate_alerts(app, prices, {'2': config['2']}, state, verbose=False, on_delivered=delivered.append)
+            assert await asyncio.wait_for(tick, timeout=0.5) == set()
+            await asyncio.sleep(0.05)
+        assert dispatcher.in_flight == {('2', 'BTC')} and dispatcher.stats()['sending'] == 1
+        assert state['2']['BTC']['last_notification_price'] == 100.0, "Stav se nesmí změnit před doručením"
+        release.set()
+        await dispatcher.close()
+        stop_event.set()
+        await sender_task
+    assert delivered == [{('2', 'BTC')}] and state['2']['BTC']['last_notification_price'] == 110.0
+    assert app.bot.send_message.await_count == 1, "Alert v odesílání se neměl poslat podruhé"
+
+async def test_sharded_workers():
+    """Test shardingu (smyčka shardu, procesy s rozdělenými chaty, přerozdělení bez ztráty stavu)."""
+    import queue
+    import time
+    
+    async def wait_for(condition, timeout=30):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            await pool._receive(0.1)
+        return condition()
+    
+    # Argument --shards
+    parse = eth_price_alert.parse_shard_count
+    assert parse(['--shards', '4']) == 4 and parse(['--shards', '0']) == 0
+    for env, expected in (('0', 0), ('3', 3), ('abc', 0), ('-1', 0), (str(eth_price_alert.SHARD_COUNT_MAX + 1), 0)):
+        with patch('eth_price_alert.SHARD_COUNT', env):
+            assert parse([]) == expected, env
+    for args in (['--shards'], ['--shards', 'x'], ['--shards', '-1'], ['--shards', str(eth_price_alert.SHARD_COUNT_MAX + 1)]):
+        assert parse(args) is None, args
+    
+    # /shards N: handler nečeká na přerozdělení, odpoví až po jeho dokončení
+    release = asyncio.Event()
+    
+    async def slow_rebalance(count):
+        await release.wait()
+    
+    fake_pool = MagicMock(rebalance_task=None)
+    fake_pool.rebalance = AsyncMock(side_effect=slow_rebalance)
+    fake_pool.stats.return_value = {'shards': 3, 'alive': 3, 'price_batches': 0, 'state_updates': 0,
+                                    'stale_updates': 0, 'rebalances': 1, 'restarts': 0}
+    update = MagicMock()
+    update.effective_chat.id = 42
+    update.message.reply_text = AsyncMock()
+    with patch('eth_price_alert.ADMIN_CHAT_ID', '42'), patch('eth_price_alert.SHARDS', fake_pool):
+        context = MagicMock(args=['3'])
+        await eth_price_alert.shards_command(update, context)
+        await asyncio.sleep(0.05)
+        assert 'Přerozděluji' in reply_text(update) and not fake_pool.rebalance_task.done()
+        await eth_price_alert.shards_command(update, context)
+        assert 'už probíhá' in reply_text(update)
+        release.set()
+        await fake_pool.rebalance_task
+        assert '3/3 běží' in reply_text(update)
+    fake_pool.rebalance.assert_awaited_once_with(3)
+    
+    pool = None
+    try:
+        # Smyčka shardu v tomto procesu: alert, změna configu od hlavního procesu, zastavení
+        inbox, outbox = queue.Queue(), queue.Queue()
+        app = MagicMock()
+        app.bot.send_message = AsyncMock()
+        config = {'5': {'BTC': {'name': 'Bitcoin', 'threshold': 0.05}}}
+        state = {'5': {'BTC': {'last_notification_price': 100.0}}}
+        for message in [('prices', {'BTC': 110.0}), ('config', {('5', 'ETH'): {'name': 'Ethereum', 'threshold': 0.05}}),
+                        ('prices', {'ETH': 10.0}), ('stop', None)]:
+            inbox.put(message)
+        with patch('eth_price_alert.NOTIFIER', eth_price_alert.NOTIFIER):
+            await eth_price_alert.shard_main(0, 1, app, inbox, outbox, config, state)
+        messages = [outbox.get_nowait() for _ in range(outbox.qsize())]
+        # Alert doručuje background task, pořadí vůči první ceně ETH není dané; 'stopped' až po všem
+        assert messages[-1] == ('stopped', 0, 2, 4), messages
+        assert ('state', 0, {('5', 'ETH'): {'last_notification_price': 10.0}}, 3) in messages, messages
+        assert sorted((message[:3] for message in messages[:-1]), key=repr) == [
+            ('state', 0, {('5', 'BTC'): {'last_notification_price': 110.0}}),
+            ('state', 0, {('5', 'ETH'): {'last_notification_price': 10.0}})], messages
+        assert app.bot.send_message.await_count == 1
+        
+        # Hlavní proces zahodí změnu stavu ze shardu, která předchází jeho vlastní změně, a změnu smazaného odběru
+        store = eth_price_alert.DataStore()
+        store.config = {'7': {'BTC': {'name': 'Bitcoin', 'threshold': 0.05, 'asset_type': 'crypto'}}}
+        store.state = {'7': {'BTC': {'last_notification_price': 100.0}}}
+        store.loaded = True
+        pool = eth_price_alert.ShardPool(2, token='123:test')
+        pool.inboxes, pool.running = [queue.Queue(), queue.Queue()], True
+        shard = eth_price_alert.shard_of('7', 2)
+        with patch('eth_price_alert.STORE', store), \
+             patch('eth_price_alert.save_rows_batch', return_value={}):
+            pool.publish_prices({'BTC': 110.0})
+            pool.publish('state', {('7', 'BTC'): {'last_notification_price': 105.0}})
+            pool._apply(('state', shard, {('7', 'BTC'): {'last_notification_price': 110.0}}, 1))
+            assert store.state['7']['BTC']['last_notification_price'] == 100.0, "Změna ze staršího pohledu shardu se měla zahodit"
+            pool._apply(('state', shard, {('7', 'BTC'): {'last_notification_price': 120.0}}, 2))
+            assert store.state['7']['BTC']['last_notification_price'] == 120.0
+            pool._apply(('state', shard, {('8', 'BTC'): {'last_notification_price': 1.0}}, 2))
+            assert '8' not in store.state, "Změna stavu smazaného odběru se neměla zapsat"
+        assert pool.stats()['stale_updates'] == 2 and pool.stats()['state_updates'] == 1
+        pool = None
+        
+        # Skutečné procesy: 12 chatů bez první ceny ve 2 shardech
+        chats = [str(1000 + i) for i in range(12)]
+        assert len({eth_price_alert.shard_of(c, 2) for c in chats}) == 2, "Chaty se mají rozdělit do obou shardů"
+        store = eth_price_alert.DataStore()
+        store.config = {c: {'BTC': {'name': 'Bitcoin', 'threshold': 0.5, 'asset_type': 'crypto'}} for c in chats}
+        store.loaded = True
+        with patch('eth_price_alert.STORE', store), \
+             patch('eth_price_alert.save_rows_batch', return_value={}):
+            pool = eth_price_alert.ShardPool(2, token='123:test')
+            with patch('eth_price_alert.SHARDS', pool):
+                pool.start(store.config, store.state)
+                pool.publish_prices({'BTC': 100.0})
+                assert await wait_for(lambda: len(store.state) == 12), f"Shardy měly vrátit první ceny: {len(store.state)}"
+                
+                # Přerozdělení do 3 shardů: stav jde do nových shardů ze snapshotu, ceny z jeho průběhu se neztratí
+                task = asyncio.create_task(pool.rebalance(3))
+                await asyncio.sleep(0)
+                assert not pool.running
+                eth_price_alert.save_user_config('2000', {'BTC': {'name': 'Bitcoin', 'threshold': 0.5}}, ['BTC'])
+                pool.publish_prices({'BTC': 110.0})  # Pod prahem: existující odběry se nemění, nový dostane cenu
+                await task
+                assert pool.stats()['shards'] == 3 and all(p.is_alive() for p in pool.processes)
+                assert await wait_for(lambda: '2000' in store.state), "Ceny z průběhu přerozdělení měly dojít novým shardům"
+                
+                # Spadlý shard se spustí znovu se snapshotem ze STORE; zastavení na mrtvý proces nečeká
+                victim = eth_price_alert.shard_of('2001', 3)
+                pool.processes[victim].kill()
+                pool.processes[victim].join()
+                with patch('eth_price_alert.SHARD_RESTART_DELAY', 0):
+                    await pool.check_alive()
+                assert pool.stats()['restarts'] == 1 and all(p.is_alive() for p in pool.processes)
+                eth_price_alert.save_user_config('2001', {'BTC': {'name': 'Bitcoin', 'threshold': 0.5}}, ['BTC'])
+                pool.publish_prices({'BTC': 120.0})
+                assert await wait_for(lambda: '2001' in store.state), "Restartovaný shard měl zpracovat ceny"
+                pool.processes[victim].kill()
+                pool.processes[victim].join()
+                started = time.monotonic()
+                await pool.stop()
+                assert time.monotonic() - started < 10, "stop() neměl čekat na mrtvý shard"
+            assert all(s['BTC']['last_notification_price'] == 100.0 for c, s in store.state.items() if c not in ('2000', '2001')), \
+                "Po přerozdělení se last_notification_price nesmí ztratit"
+            assert store.state['2000']['BTC']['last_notification_price'] == 110.0
+    finally:
+        if pool is not None:
+            for process in pool.processes:
+                process.terminate()
 
 async def main():
     """Spustí všechny testy."""
@@ -609,15 +1412,42 @@ async def main():
         ("Setall Empty", test_setall_empty),
         ("Setall Invalid Threshold", test_setall_invalid_threshold),
         ("Update Nonexistent", test_update_nonexistent),
+        ("Update Keeps Asset Type", test_update_keeps_asset_type),
         ("Add Without Args", test_add_without_args),
         ("Remove Without Args", test_remove_without_args),
         ("Add Overwrites Existing", test_add_overwrites_existing),
         ("Zero Threshold", test_zero_threshold),
         ("Very High Threshold", test_very_high_threshold),
+        ("Bulk Crypto Prices", test_bulk_crypto_prices),
+        ("Async Prices Concurrency", test_async_prices_concurrency),
+        ("Provider Session Reuse", test_provider_session_reuse),
+        ("Hedged Provider Selection", test_hedged_provider_selection),
+        ("Circuit Breaker", test_circuit_breaker),
+        ("Bulk Stock Prices", test_bulk_stock_prices),
+        ("Binance Snapshot", test_binance_snapshot),
+        ("Price Cache", test_price_cache),
+        ("Price Stream", test_price_stream),
+        ("Token Bucket", test_token_bucket),
+        ("Normalized Storage", test_normalized_storage),
+        ("DB Pool", test_db_pool),
+        ("Data Store", test_data_store),
+        ("File Journal", test_file_journal),
+        ("Write-Behind Queue", test_write_behind_queue),
+        ("Storage Off Event Loop", test_storage_off_event_loop),
+        ("Atomic Snapshot Files", test_atomic_snapshot_files),
+        ("Asset Type Migration", test_asset_type_migration),
+        ("Optimistic Concurrency", test_optimistic_concurrency),
+        ("Price History", test_price_history),
+        ("Threshold Index", test_threshold_index),
+        ("NumPy Alert Engine", test_numpy_alert_engine),
+        ("Symbol Registry", test_symbol_registry),
+        ("Notification Dispatcher", test_notification_dispatcher),
+        ("Sharded Workers", test_sharded_workers),
     ]
     
     results = {}
     for name, test_func in tests:
+        print(f"🧪 {name}")
         try:
             result = await test_func()
             results[name] = result
@@ -631,11 +1461,11 @@ async def main():
     print("📊 VÝSLEDKY TESTOVÁNÍ")
     print("="*80)
     
-    passed = sum(1 for v in results.values() if v)
+    passed = sum(1 for v in results.values() if v is not False)
     total = len(results)
     
     for name, result in results.items():
-        status = "✅ PASS" if result else "❌ FAIL"
+        status = "✅ PASS" if result is not False else "❌ FAIL"
         print(f"{status}: {name}")
     
     print()